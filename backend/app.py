@@ -1,22 +1,106 @@
 import os
-from flask import Flask, jsonify
+from flask import Flask, jsonify, Response, request
 from flask_cors import CORS
 from blueprints.mqtt import mqtt_bp
-from blueprints.mqtt.routes import initialize_mqtt_client
+from blueprints.mqtt.routes import (initialize_mqtt_client, initialize_ingest_queue, initialize_analytics, initialize_cluster,
+                                    restore_state, begin_startup, finish_startup)
 from models import db
+from models.storage import storage_options, tune_engines
+from metrics import registry
+from profiling import install_profiling, authorized, sample_stacks
 
 def create_app(test_config=None):
+    begin_startup()
     app = Flask(__name__)
     
     # Configure app from environment variables
     app.config.from_mapping(
         BROKER_ADDRESS=os.environ.get('BROKER_ADDRESS', 'localhost'),
-        BROKER_PORT=int(os.environ.get('BROKER_PORT', 9001)),
+        BROKER_PORT=int(os.environ.get('BROKER_PORT', 8080)),
         USE_WEBSOCKETS=os.environ.get('USE_WEBSOCKETS', 'true').lower() == 'true',
+        # Set to false to run without a broker, e.g. when a benchmark feeds on_message directly
+        MQTT_ENABLED=os.environ.get('MQTT_ENABLED', 'true').lower() == 'true',
+        # How the MQTT client runs: on paho's network thread, or on the event loop of asgi.py
+        MQTT_LOOP=os.environ.get('MQTT_LOOP', 'thread'),
+        # Threads running Flask requests in asyncio serving mode (asgi.py)
+        ASGI_THREADS=int(os.environ.get('ASGI_THREADS', 64)),
         DEBUG=os.environ.get('FLASK_DEBUG', 'true').lower() == 'true',
         # Database configuration
         SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URI', 'sqlite:///iot_data.db'),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # Write-behind ingestion: rows are flushed every INGEST_BATCH_SIZE rows or INGEST_FLUSH_INTERVAL_MS
+        INGEST_QUEUE_SIZE=int(os.environ.get('INGEST_QUEUE_SIZE', 10000)),
+        INGEST_BATCH_SIZE=int(os.environ.get('INGEST_BATCH_SIZE', 500)),
+        INGEST_FLUSH_INTERVAL_MS=int(os.environ.get('INGEST_FLUSH_INTERVAL_MS', 500)),
+        # What to do when the queue is full: block, drop_oldest or drop_newest
+        INGEST_OVERFLOW_POLICY=os.environ.get('INGEST_OVERFLOW_POLICY', 'block'),
+        # Compact telemetry timestamps further than this from the receive time are re-anchored to it (0 trusts the device clock)
+        TELEMETRY_MAX_CLOCK_SKEW_SECONDS=float(os.environ.get('TELEMETRY_MAX_CLOCK_SKEW_SECONDS', 300)),
+        # Recent samples kept in memory per device/metric for history queries (0 disables the cache)
+        HOT_CACHE_SIZE=int(os.environ.get('HOT_CACHE_SIZE', 10000)),
+        HOT_CACHE_MAX_SERIES=int(os.environ.get('HOT_CACHE_MAX_SERIES', 64)),
+        # Newest stored samples per series loaded into the hot cache at startup (0 starts it empty)
+        HOT_CACHE_PRELOAD=int(os.environ.get('HOT_CACHE_PRELOAD', 1000)),
+        # File the latest state is checkpointed to, so a restart answers with it straight away (empty disables)
+        STATE_CHECKPOINT_PATH=os.environ.get('STATE_CHECKPOINT_PATH', 'latest_state.json'),
+        # Seconds between checkpoints; one is also written on shutdown
+        STATE_CHECKPOINT_INTERVAL_SECONDS=float(os.environ.get('STATE_CHECKPOINT_INTERVAL_SECONDS', 30)),
+        # Memory budget for rendered history and /stats responses (0 disables the cache)
+        RESULT_CACHE_MAX_BYTES=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+        # Seconds between keepalive comments on idle /stream connections
+        STREAM_KEEPALIVE_SECONDS=int(os.environ.get('STREAM_KEEPALIVE_SECONDS', 15)),
+        # Longest time a /snapshot?since= long-poll waits for a newer state
+        SNAPSHOT_LONG_POLL_SECONDS=float(os.environ.get('SNAPSHOT_LONG_POLL_SECONDS', 30)),
+        # History responses at least this large are gzipped for clients that accept it
+        HISTORY_GZIP_MIN_BYTES=int(os.environ.get('HISTORY_GZIP_MIN_BYTES', 1024)),
+        # Rows fetched per keyset page by /export
+        EXPORT_PAGE_SIZE=int(os.environ.get('EXPORT_PAGE_SIZE', 1000)),
+        # Recompute /stats totals from the daily rollups at startup instead of only for missing metrics
+        STATS_REBUILD_ON_STARTUP=os.environ.get('STATS_REBUILD_ON_STARTUP', 'false').lower() == 'true',
+        # Control commands for one actuator within this window are coalesced to the newest one
+        COMMAND_WINDOW_MS=int(os.environ.get('COMMAND_WINDOW_MS', 50)),
+        # Maximum control commands published per second to one device (0 for no limit)
+        COMMAND_MAX_RATE=float(os.environ.get('COMMAND_MAX_RATE', 20)),
+        # Append " #<command id>" to control commands: on, off, or auto for the devices that announced acknowledgements
+        COMMAND_IDS=os.environ.get('COMMAND_IDS', 'auto').lower(),
+        # How long POST /light and /motion with wait_for_ack wait for the device by default, and at most
+        COMMAND_ACK_TIMEOUT_SECONDS=float(os.environ.get('COMMAND_ACK_TIMEOUT_SECONDS', 2)),
+        COMMAND_ACK_MAX_WAIT_SECONDS=float(os.environ.get('COMMAND_ACK_MAX_WAIT_SECONDS', 10)),
+        # Days to keep raw readings and minute/hourly rollups (0 keeps them forever); daily rollups are never pruned
+        RETENTION_RAW_DAYS=float(os.environ.get('RETENTION_RAW_DAYS', 0)),
+        RETENTION_MINUTE_ROLLUP_DAYS=float(os.environ.get('RETENTION_MINUTE_ROLLUP_DAYS', 0)),
+        RETENTION_HOURLY_ROLLUP_DAYS=float(os.environ.get('RETENTION_HOURLY_ROLLUP_DAYS', 0)),
+        # Seconds between retention runs, and rows deleted per writer transaction
+        RETENTION_INTERVAL_SECONDS=int(os.environ.get('RETENTION_INTERVAL_SECONDS', 3600)),
+        RETENTION_BATCH_SIZE=int(os.environ.get('RETENTION_BATCH_SIZE', 1000)),
+        # SQLite files get one writer connection plus this many read-only connections, in WAL mode
+        SQLITE_READ_POOL_SIZE=int(os.environ.get('SQLITE_READ_POOL_SIZE', 8)),
+        # Page cache per connection, and how long a connection waits for a lock before failing
+        SQLITE_CACHE_KB=int(os.environ.get('SQLITE_CACHE_KB', 16384)),
+        SQLITE_BUSY_TIMEOUT_MS=int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        # Sliding windows in seconds and the EWMA time constant for streaming analytics
+        ANALYTICS_WINDOWS=os.environ.get('ANALYTICS_WINDOWS', '60,300,3600'),
+        ANALYTICS_EWMA_SECONDS=float(os.environ.get('ANALYTICS_EWMA_SECONDS', 60)),
+        # JSON list of threshold rules, e.g. [{"name": "humid", "metric": "humidity", "above": 70, "clear": 65, "for_seconds": 300}]
+        ANALYTICS_RULES=os.environ.get('ANALYTICS_RULES', '[]'),
+        ANALYTICS_MAX_SERIES=int(os.environ.get('ANALYTICS_MAX_SERIES', 64)),
+        # Aggregates are published to <prefix>/<device_id>/<metric> at most this often, events right away
+        ANALYTICS_PUBLISH_INTERVAL_SECONDS=float(os.environ.get('ANALYTICS_PUBLISH_INTERVAL_SECONDS', 5)),
+        ANALYTICS_TOPIC_PREFIX=os.environ.get('ANALYTICS_TOPIC_PREFIX', 'analytics'),
+        # Directory shared by the worker processes of one server (e.g. under /dev/shm); empty for a single process
+        CLUSTER_DIR=os.environ.get('CLUSTER_DIR', ''),
+        # Device/kind records the shared latest state can hold, and how often followers check it for changes
+        CLUSTER_STATE_SLOTS=int(os.environ.get('CLUSTER_STATE_SLOTS', 1024)),
+        CLUSTER_POLL_MS=int(os.environ.get('CLUSTER_POLL_MS', 20)),
+        # Break every request down into DB, serialization and handler time in a Server-Timing header, and log slow ones
+        PROFILING_ENABLED=os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true',
+        # Requests and MQTT callbacks at least this slow are logged while profiling is enabled (0 logs none)
+        PROFILING_SLOW_REQUEST_MS=float(os.environ.get('PROFILING_SLOW_REQUEST_MS', 500)),
+        PROFILING_SLOW_CALLBACK_MS=float(os.environ.get('PROFILING_SLOW_CALLBACK_MS', 50)),
+        # Bearer token for the sampling profiler at /debug/profile; empty disables the endpoint
+        PROFILING_TOKEN=os.environ.get('PROFILING_TOKEN', ''),
+        # Longest sampling profile a single request may run
+        PROFILING_MAX_SECONDS=float(os.environ.get('PROFILING_MAX_SECONDS', 30)),
         # Add connect options for containerized SQLite
         SQLALCHEMY_ENGINE_OPTIONS={
             'connect_args': {
@@ -32,8 +116,11 @@ def create_app(test_config=None):
     # Setup CORS
     CORS(app, origins=os.environ.get('CORS_ORIGINS', "*"))
     
-    # Initialize the database
+    # Initialize the database, with separate writer and reader connections for SQLite files
+    storage_options(app)
     db.init_app(app)
+    tune_engines(app, db)
+    install_profiling(app, db)
     
     # Create all database tables
     with app.app_context():
@@ -54,6 +141,25 @@ def create_app(test_config=None):
             "version": "1.0.0"
         }), 200 
         
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+        
+    @app.route('/debug/profile', methods=['GET'])
+    def profile():
+        """Sample every thread of this process, MQTT and writer threads included, and return collapsed stacks"""
+        if not app.config['PROFILING_TOKEN']:
+            return jsonify({"error": "Endpoint not found."}), 404
+        if not authorized(app.config['PROFILING_TOKEN']):
+            return jsonify({"error": "Missing or invalid profiling token"}), 403
+        
+        seconds = min(max(request.args.get('seconds', default=10, type=float), 0.1), app.config['PROFILING_MAX_SECONDS'])
+        interval = max(request.args.get('interval_ms', default=5, type=float), 1) / 1000.0
+        stacks = sample_stacks(seconds, interval, request.args.get('thread'))
+        if stacks is None:
+            return jsonify({"error": "A profile is already running"}), 409
+        return Response(stacks, mimetype='text/plain', headers={"X-Profile-Pid": str(os.getpid())})
+        
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({"error": "Endpoint not found."}), 404
@@ -62,10 +168,21 @@ def create_app(test_config=None):
     def internal_error(error):
         return jsonify({"error": "Internal server error."}), 500
         
-    # Initialize the MQTT client with app configuration
-    with app.app_context():
-        initialize_mqtt_client(app)
-        
+    # Start the database writer and analytics before any messages can arrive
+    initialize_ingest_queue(app)
+    initialize_analytics(app)
+    
+    # With several workers only the elected leader restores the checkpoint and runs the MQTT client
+    if app.config['CLUSTER_DIR']:
+        initialize_cluster(app)
+    else:
+        restore_state(app)
+        if app.config['MQTT_ENABLED']:
+            # Initialize the MQTT client with app configuration
+            with app.app_context():
+                initialize_mqtt_client(app)
+    
+    finish_startup()
     return app
 
 app = create_app()
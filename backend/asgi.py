@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+# Asyncio serving mode: run with `uvicorn asgi:app --host 0.0.0.0 --port 5000`.
+# The MQTT client runs on the event loop instead of paho's thread, and the long-lived
+# /stream and /snapshot?since= requests wait as coroutines instead of holding a thread each.
+# Every other route is the unchanged Flask app, run in a thread pool.
+os.environ.setdefault('MQTT_LOOP', 'asyncio')
+
+from app import app as flask_app
+from blueprints.mqtt import routes
+from blueprints.mqtt.aioloop import AsyncioMqttLoop
+from blueprints.mqtt.events import AsyncSubscriber
+from models import DEFAULT_DEVICE_ID
+
+
+class _ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs every WSGI call on one shared thread by default; Flask requests are safe to run side by side
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that runs requests in the event loop's default executor"""
+
+    async def __call__(self, scope, receive, send):
+        await _ThreadedWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+wsgi = ThreadedWsgiToAsgi(flask_app)
+cors_origins = os.environ.get('CORS_ORIGINS', "*")
+
+
+def query_arg(query, name, default=None, type=str):
+    """First value of a query string argument, or default when missing or invalid, like request.args.get"""
+    try:
+        return type(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+def response_headers(scope, content_type):
+    headers = [(b"content-type", content_type.encode()), (b"cache-control", b"no-cache")]
+    origin = dict(scope["headers"]).get(b"origin")
+    if cors_origins == "*":
+        headers.append((b"access-control-allow-origin", b"*"))
+    elif origin is not None and origin.decode() == cors_origins:
+        headers.append((b"access-control-allow-origin", origin))
+        headers.append((b"vary", b"Origin"))
+    return headers
+
+
+async def send_json(scope, send, status, payload):
+    await send({"type": "http.response.start", "status": status, "headers": response_headers(scope, "application/json")})
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+
+async def watch_disconnect(receive, subscriber):
+    """Close the subscriber once the client goes away, which ends its wait"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    subscriber.close()
+
+
+async def stream_state(scope, receive, send, query):
+    """/api/mqtt/stream on the event loop; same events as the Flask endpoint"""
+    try:
+        topics, devices = routes.stream_filters(query_arg(query, 'topics'), query_arg(query, 'devices'))
+    except ValueError as e:
+        await send_json(scope, send, 400, {"error": str(e)})
+        return 400
+
+    keepalive = flask_app.config['STREAM_KEEPALIVE_SECONDS']
+    subscriber = routes.event_bus.attach(AsyncSubscriber(asyncio.get_running_loop(), topics, devices))
+    watcher = asyncio.create_task(watch_disconnect(receive, subscriber))
+    try:
+        headers = response_headers(scope, "text/event-stream") + [(b"x-accel-buffering", b"no")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        initial = "retry: 2000\n\n" + "".join(routes.initial_stream_events(subscriber, topics))
+        await send({"type": "http.response.body", "body": initial.encode(), "more_body": True})
+        while True:
+            # Updates that arrive while the client is still reading are coalesced per topic
+            updates = await subscriber.next(keepalive)
+            if updates is None:
+                break
+            chunk = "".join(routes.sse_event(topic, data) for (_, topic), data in updates) if updates else ": keepalive\n\n"
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        watcher.cancel()
+        routes.event_bus.unsubscribe(subscriber)
+    return 200
+
+
+async def get_snapshot(scope, receive, send, query):
+    """/api/mqtt/snapshot?since= long-poll on the event loop; plain snapshots go to Flask"""
+    since = query_arg(query, 'since', type=int)
+    if since is None:
+        return None
+
+    device_id = query_arg(query, 'device_id', DEFAULT_DEVICE_ID)
+    max_timeout = flask_app.config['SNAPSHOT_LONG_POLL_SECONDS']
+    timeout = max(0.0, min(query_arg(query, 'timeout', max_timeout, float), max_timeout))
+
+    if not routes.snapshot_changed(device_id, since):
+        # Subscribe before checking again, so an update in between cannot be missed
+        loop = asyncio.get_running_loop()
+        subscriber = routes.event_bus.attach(AsyncSubscriber(loop, devices=[device_id]))
+        watcher = asyncio.create_task(watch_disconnect(receive, subscriber))
+        try:
+            deadline = loop.time() + timeout
+            while not routes.snapshot_changed(device_id, since):
+                remaining = deadline - loop.time()
+                if remaining <= 0 or await subscriber.next(remaining) is None:
+                    break
+        finally:
+            watcher.cancel()
+            routes.event_bus.unsubscribe(subscriber)
+
+    await send_json(scope, send, 200, routes.snapshot_payload(device_id))
+    return 200
+
+
+# Path -> (endpoint name for the latency histogram, handler); a handler returning None passes the request on to Flask
+NATIVE_ROUTES = {
+    "/api/mqtt/stream": ("mqtt.stream_state", stream_state),
+    "/api/mqtt/snapshot": ("mqtt.get_snapshot", get_snapshot)
+}
+
+
+# MQTT client -> task driving it on the event loop
+mqtt_tasks = {}
+
+
+def start_mqtt_loop(client):
+    """Drive an MQTT client from the running event loop, once"""
+    if client is None or client in mqtt_tasks:
+        return
+    mqtt_loop = AsyncioMqttLoop(client, flask_app.config['BROKER_ADDRESS'], flask_app.config['BROKER_PORT'])
+    mqtt_tasks[client] = asyncio.create_task(mqtt_loop.run())
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            loop = asyncio.get_running_loop()
+            # Flask requests and broker connects run here
+            loop.set_default_executor(ThreadPoolExecutor(flask_app.config['ASGI_THREADS'], thread_name_prefix="wsgi"))
+            # With CLUSTER_DIR, a worker elected leader later creates its client on the election thread
+            routes.mqtt_loop_hook = lambda client: loop.call_soon_threadsafe(start_mqtt_loop, client)
+            start_mqtt_loop(routes.client)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            routes.mqtt_loop_hook = None
+            for mqtt_task in mqtt_tasks.values():
+                mqtt_task.cancel()
+                try:
+                    await mqtt_task
+                except asyncio.CancelledError:
+                    pass
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] in NATIVE_ROUTES:
+        endpoint, handler = NATIVE_ROUTES[scope["path"]]
+        started = time.perf_counter()
+        status = await handler(scope, receive, send, parse_qs(scope["query_string"].decode()))
+        if status is not None:
+            routes.request_latency.labels(endpoint, "GET", str(status)).observe(time.perf_counter() - started)
+            return
+
+    await wsgi(scope, receive, send)
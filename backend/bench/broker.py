@@ -0,0 +1,197 @@
+import socket
+import struct
+import threading
+
+# MQTT 3.1.1 control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 10, 11, 12, 13, 14
+
+
+def encode_length(length):
+    """Encode an MQTT remaining length as a variable-length integer"""
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def packet(packet_type, body=b"", flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def read_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def read_packet(sock):
+    """Read one packet and return (type, flags, body)"""
+    header = read_exact(sock, 1)[0]
+    length, shift = 0, 0
+    while True:
+        byte = read_exact(sock, 1)[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return header >> 4, header & 0x0F, read_exact(sock, length)
+
+
+def topic_matches(topic_filter, topic):
+    """Return whether a topic matches a subscription filter with + and # wildcards"""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.filters = set()
+        self._send_lock = threading.Lock()
+
+    def send(self, data):
+        with self._send_lock:
+            self.sock.sendall(data)
+
+
+class StandInBroker:
+    """Minimal in-process MQTT 3.1.1 broker over plain TCP
+
+    Supports what the backend and the simulated devices use: CONNECT, SUBSCRIBE with wildcards,
+    PUBLISH at QoS 0/1 (always delivered at QoS 0), PINGREQ and DISCONNECT. No retained messages,
+    sessions or authentication.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = socket.create_server((host, port))
+        self.host, self.port = self._server.getsockname()[:2]
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._running = False
+        self.received = 0
+        self.delivered = 0
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._accept, name="broker-accept", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.sock.close()
+
+    def subscriptions(self):
+        with self._lock:
+            return sum(len(connection.filters) for connection in self._connections)
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _Connection(sock)
+            with self._lock:
+                self._connections.add(connection)
+            threading.Thread(target=self._serve, args=(connection,), name="broker-connection", daemon=True).start()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                packet_type, flags, body = read_packet(connection.sock)
+                if packet_type == CONNECT:
+                    connection.send(packet(CONNACK, b"\x00\x00"))
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(connection, body)
+                elif packet_type == UNSUBSCRIBE:
+                    connection.send(packet(UNSUBACK, body[:2]))
+                elif packet_type == PUBLISH:
+                    self._publish(connection, flags, body)
+                elif packet_type == PINGREQ:
+                    connection.send(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(connection)
+            connection.sock.close()
+
+    def _subscribe(self, connection, body):
+        packet_id, offset = body[:2], 2
+        granted = bytearray()
+        with self._lock:
+            while offset < len(body):
+                length = struct.unpack_from("!H", body, offset)[0]
+                connection.filters.add(body[offset + 2:offset + 2 + length].decode("utf-8"))
+                offset += 2 + length + 1
+                granted.append(0)
+        connection.send(packet(SUBACK, packet_id + bytes(granted)))
+
+    def _publish(self, connection, flags, body):
+        length = struct.unpack_from("!H", body)[0]
+        topic = body[2:2 + length].decode("utf-8")
+        offset = 2 + length
+        qos = (flags >> 1) & 0x03
+        if qos:
+            connection.send(packet(PUBACK, body[offset:offset + 2]))
+            offset += 2
+        self.received += 1
+
+        forward = packet(PUBLISH, body[:2 + length] + body[offset:])
+        with self._lock:
+            targets = [target for target in self._connections
+                       if any(topic_matches(topic_filter, topic) for topic_filter in target.filters)]
+        for target in targets:
+            try:
+                target.send(forward)
+                self.delivered += 1
+            except OSError:
+                pass
+
+
+class Publisher:
+    """Bare-bones QoS 0 publishing client, one per simulated device"""
+
+    def __init__(self, host, port, client_id):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Protocol name, level 4 (3.1.1), clean session, 60 s keepalive
+        variable_header = encode_string("MQTT") + b"\x04\x02" + struct.pack("!H", 60)
+        self.sock.sendall(packet(CONNECT, variable_header + encode_string(client_id)))
+        packet_type, _, body = read_packet(self.sock)
+        if packet_type != CONNACK or body[1] != 0:
+            raise ConnectionError(f"Broker refused connection for {client_id}")
+
+    def publish(self, topic, payload):
+        self.sock.sendall(packet(PUBLISH, encode_string(topic) + payload.encode("utf-8")))
+
+    def close(self):
+        try:
+            self.sock.sendall(packet(DISCONNECT))
+        finally:
+            self.sock.close()
@@ -0,0 +1,375 @@
+"""Ingestion throughput and query latency benchmark for the backend
+
+Drives the real on_message callback with synthetic traffic from a fleet of simulated devices,
+either in-process with fake MQTT message objects or over TCP through a stand-in broker, then
+measures the history and stats endpoints against the resulting database.
+
+    python bench/ingest_benchmark.py --devices 10 --messages 50000 --db-rows 1000000
+    python bench/ingest_benchmark.py --mode broker --devices 50 --rate 2000 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+from types import SimpleNamespace
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench.broker import StandInBroker, Publisher  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("inprocess", "broker"), default="inprocess",
+                        help="Call on_message directly, or publish through a local stand-in broker")
+    parser.add_argument("--devices", type=int, default=10, help="Number of simulated devices")
+    parser.add_argument("--messages", type=int, default=20000, help="Total messages sent by the fleet")
+    parser.add_argument("--rate", type=float, default=0, help="Target fleet-wide messages per second (0 = as fast as possible)")
+    parser.add_argument("--actuator-ratio", type=float, default=0.1, help="Share of messages on the light/motion topics")
+    parser.add_argument("--db-rows", type=int, default=100000, help="Sensor rows pre-populated before the run")
+    parser.add_argument("--history-days", type=float, default=30, help="Time span the pre-populated rows cover")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint for the latency measurement")
+    parser.add_argument("--readers", type=int, default=0,
+                        help="Threads reading history from the database while messages are ingested")
+    parser.add_argument("--database", help="SQLite file to use (default: a temporary file)")
+    parser.add_argument("--json", help="Also write the results to this file, for comparing runs")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic traffic")
+    return parser.parse_args()
+
+
+def device_topics(index):
+    """Topics a simulated device publishes on; the first device uses the original single-device topics"""
+    if index == 0:
+        return "default", {"temperature": "sensors/temperature", "humidity": "sensors/humidity",
+                           "light": "light", "motion": "motion"}
+    device_id = f"bench-{index:04d}"
+    return device_id, {"temperature": f"sensors/{device_id}/temperature", "humidity": f"sensors/{device_id}/humidity",
+                       "light": f"devices/{device_id}/light", "motion": f"devices/{device_id}/motion"}
+
+
+def device_traffic(index, count, actuator_ratio, rng):
+    """Yield (topic, payload) messages for one simulated device"""
+    _, topics = device_topics(index)
+    temperature = rng.uniform(18, 26)
+    humidity = rng.uniform(30, 60)
+    for sequence in range(count):
+        if rng.random() < actuator_ratio:
+            if rng.random() < 0.5:
+                yield topics["light"], rng.choice(("on", "off"))
+            else:
+                yield topics["motion"], f"{rng.choice(('left', 'right'))} {rng.randint(0, 90)}"
+        elif sequence % 2:
+            temperature += rng.gauss(0, 0.05)
+            yield topics["temperature"], f"{temperature:.2f}"
+        else:
+            humidity += rng.gauss(0, 0.1)
+            yield topics["humidity"], f"{humidity:.1f}"
+
+
+def fleet_traffic(devices, messages, actuator_ratio, seed):
+    """Interleave the traffic of every device, as the broker would deliver it"""
+    rng = random.Random(seed)
+    per_device = [messages // devices + (1 if index < messages % devices else 0) for index in range(devices)]
+    streams = [device_traffic(index, count, actuator_ratio, rng) for index, count in enumerate(per_device)]
+    while streams:
+        for stream in list(streams):
+            message = next(stream, None)
+            if message is None:
+                streams.remove(stream)
+            else:
+                yield message
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(samples):
+    """Summarize latencies in seconds as milliseconds"""
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+        "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0.0
+    }
+
+
+def populate(rows, devices, days):
+    """Insert synthetic history ending just before now, then rebuild the derived tables"""
+    from models import db, SensorReading, SENSOR_METRICS
+    from blueprints.mqtt.rollups import rebuild_rollups
+    from blueprints.mqtt.stats import rebuild_stats
+
+    series = [(device_topics(index)[0], metric) for index in range(devices) for metric in SENSOR_METRICS]
+    per_series = max(1, rows // len(series))
+    end = time.time() - 60
+    step = days * 86400 / per_series
+    chunk = []
+    for device_id, metric in series:
+        base = 22.0 if metric == "temperature" else 45.0
+        for index in range(per_series):
+            chunk.append({
+                "device_id": device_id,
+                "metric": metric,
+                "value": base + (index % 100) / 50.0,
+                "timestamp": datetime.utcfromtimestamp(end - (per_series - index) * step)
+            })
+            if len(chunk) >= 10000:
+                db.session.execute(db.insert(SensorReading), chunk)
+                chunk = []
+    if chunk:
+        db.session.execute(db.insert(SensorReading), chunk)
+    db.session.commit()
+
+    rebuild_rollups()
+    rebuild_stats()
+    return per_series * len(series)
+
+
+def run_inprocess(routes, traffic, rate):
+    """Feed fake messages straight into on_message on this thread, like paho's network loop does"""
+    latencies = []
+    interval = 1.0 / rate if rate else 0
+    started = time.perf_counter()
+    for sent, (topic, payload) in enumerate(traffic):
+        if interval:
+            delay = started + sent * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        message = SimpleNamespace(topic=topic, payload=payload.encode("utf-8"))
+        before = time.perf_counter()
+        routes.on_message(None, None, message)
+        latencies.append(time.perf_counter() - before)
+    return latencies, time.perf_counter() - started
+
+
+def run_broker(routes, broker, args):
+    """Publish from one TCP connection per device and time on_message inside the backend's MQTT client"""
+    latencies = []
+    received = threading.Event()
+    handled = [0]
+    on_message = routes.on_message
+
+    def timed_on_message(client, userdata, msg):
+        before = time.perf_counter()
+        on_message(client, userdata, msg)
+        latencies.append(time.perf_counter() - before)
+        handled[0] += 1
+        if handled[0] >= args.messages:
+            received.set()
+
+    routes.client.on_message = timed_on_message
+
+    # Wait for the backend to subscribe before the fleet starts publishing
+    deadline = time.monotonic() + 10
+    while broker.subscriptions() == 0:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Backend did not subscribe to the stand-in broker")
+        time.sleep(0.05)
+
+    rng = random.Random(args.seed)
+    per_device = [args.messages // args.devices + (1 if index < args.messages % args.devices else 0)
+                  for index in range(args.devices)]
+    workloads = [list(device_traffic(index, count, args.actuator_ratio, rng)) for index, count in enumerate(per_device)]
+    publishers = [Publisher(broker.host, broker.port, device_topics(index)[0]) for index in range(args.devices)]
+    device_rate = args.rate / args.devices if args.rate else 0
+
+    def publish(publisher, workload):
+        interval = 1.0 / device_rate if device_rate else 0
+        started = time.perf_counter()
+        for sent, (topic, payload) in enumerate(workload):
+            if interval:
+                delay = started + sent * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            publisher.publish(topic, payload)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=publish, args=(publisher, workload))
+               for publisher, workload in zip(publishers, workloads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not received.wait(60):
+        print(f"Only {handled[0]} of {args.messages} messages reached on_message")
+    elapsed = time.perf_counter() - started
+
+    for publisher in publishers:
+        publisher.close()
+    return latencies, elapsed
+
+
+def wait_for_writer(ingest_queue):
+    """Block until every queued row has been written"""
+    while ingest_queue.stats()["depth"]:
+        time.sleep(0.01)
+    # Any batch taken before the queue emptied is committed before a task runs
+    ingest_queue.submit(lambda: None).result()
+
+
+def endpoint_latencies(app, routes, requests, split_time):
+    """Time the read endpoints with the Flask test client, with an empty result cache (cold) and a primed one (warm)
+
+    Cold requests still use the hot cache, so they measure the database, rollup and ring buffer
+    queries; warm requests measure answering from the result cache.
+    """
+    endpoints = {
+        "temperature latest": "/api/mqtt/temperature",
+        "history recent (hot cache)": "/api/mqtt/temperature/history?limit=100",
+        "history older (database)": f"/api/mqtt/temperature/history?limit=100&end_time={split_time}",
+        "history 1h rollups": "/api/mqtt/temperature/history?resolution=1h&limit=720",
+        "history 1d rollups": "/api/mqtt/temperature/history?resolution=1d&limit=365",
+        "stats": "/api/mqtt/stats",
+        "export 1000 rows": "/api/mqtt/export?metric=temperature&limit=1000"
+    }
+    results = {}
+    with app.test_client() as client:
+        for name, url in endpoints.items():
+            samples = {"cold": [], "warm": []}
+            for cache in ("cold", "warm"):
+                for _ in range(requests):
+                    if cache == "cold":
+                        routes.result_cache.clear()
+                    before = time.perf_counter()
+                    response = client.get(url)
+                    response.get_data()
+                    samples[cache].append(time.perf_counter() - before)
+            if response.status_code != 200:
+                print(f"{url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+            results[name] = {cache: latency_summary(latencies) for cache, latencies in samples.items()}
+    return results
+
+
+def start_readers(app, count, split_time):
+    """Keep count threads reading database history until the returned stop() is called"""
+    latencies = []
+    stopped = threading.Event()
+    url = f"/api/mqtt/temperature/history?limit=500&end_time={split_time}"
+
+    def read():
+        with app.test_client() as client:
+            while not stopped.is_set():
+                before = time.perf_counter()
+                client.get(url).get_data()
+                latencies.append(time.perf_counter() - before)
+
+    threads = [threading.Thread(target=read, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    def stop():
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        return latencies
+    return stop
+
+
+def print_report(results):
+    ingest = results["ingest"]
+    print()
+    print(f"Mode: {results['config']['mode']}, {results['config']['devices']} devices, "
+          f"{ingest['messages']} messages, {results['populated_rows']} pre-populated rows")
+    print(f"Sustained ingest rate:   {ingest['messages_per_second']:>12,.0f} msg/s")
+    print(f"on_message latency:      p50 {ingest['handler']['p50_ms']:.3f} ms, p99 {ingest['handler']['p99_ms']:.3f} ms, "
+          f"max {ingest['handler']['max_ms']:.3f} ms")
+    print(f"Database rows written:   {ingest['rows_written']:>12,} ({ingest['rows_per_second']:,.0f} rows/s, "
+          f"{ingest['rows_dropped']} dropped, {ingest['rows_failed']} failed)")
+    print(f"Batch flush:             avg {ingest['avg_flush_ms']:.2f} ms, max {ingest['max_flush_ms']:.2f} ms")
+    if "concurrent_reads" in results:
+        reads = results["concurrent_reads"]
+        print(f"Reads during ingestion:  {reads['count']} from {results['config']['readers']} threads, "
+              f"p50 {reads['p50_ms']:.2f} ms, p99 {reads['p99_ms']:.2f} ms, max {reads['max_ms']:.2f} ms")
+    print()
+    print(f"{'Endpoint':<30}{'cold p50':>10}{'cold p99':>10}{'warm p50':>10}{'warm p99':>10}  (ms)")
+    for name, summary in results["endpoints"].items():
+        cold, warm = summary["cold"], summary["warm"]
+        print(f"{name:<30}{cold['p50_ms']:>10.2f}{cold['p99_ms']:>10.2f}{warm['p50_ms']:>10.2f}{warm['p99_ms']:>10.2f}")
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="iot-bench-")
+    database = args.database or os.path.join(workdir, "bench.db")
+
+    broker = None
+    os.environ["DATABASE_URI"] = f"sqlite:///{os.path.abspath(database)}"
+    os.environ["FLASK_DEBUG"] = "false"
+    # Start from the generated data only, and leave any real checkpoint in the working directory alone
+    os.environ["STATE_CHECKPOINT_PATH"] = ""
+    if args.mode == "broker":
+        broker = StandInBroker().start()
+        os.environ.update(MQTT_ENABLED="true", BROKER_ADDRESS=broker.host, BROKER_PORT=str(broker.port),
+                          USE_WEBSOCKETS="false")
+    else:
+        os.environ["MQTT_ENABLED"] = "false"
+
+    # Handlers print every actuator command; keep that out of the terminal and the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from app import app
+        from blueprints.mqtt import routes
+
+        populated = routes.ingest_queue.submit(populate, args.db_rows, args.devices, args.history_days).result()
+        split_time = time.time() - 60
+
+        start_stats = routes.ingest_queue.stats()
+        stop_readers = start_readers(app, args.readers, split_time) if args.readers else None
+        load_started = time.perf_counter()
+        if args.mode == "broker":
+            latencies, elapsed = run_broker(routes, broker, args)
+        else:
+            latencies, elapsed = run_inprocess(
+                routes, fleet_traffic(args.devices, args.messages, args.actuator_ratio, args.seed), args.rate)
+        wait_for_writer(routes.ingest_queue)
+        write_elapsed = time.perf_counter() - load_started
+        end_stats = routes.ingest_queue.stats()
+        read_latencies = stop_readers() if stop_readers else None
+
+        endpoints = endpoint_latencies(app, routes, args.requests, split_time)
+
+    rows_written = end_stats["written"] - start_stats["written"]
+    results = {
+        "config": vars(args),
+        "populated_rows": populated,
+        "ingest": {
+            "messages": len(latencies),
+            "elapsed_seconds": elapsed,
+            "messages_per_second": len(latencies) / elapsed if elapsed else 0.0,
+            "handler": latency_summary(latencies),
+            "rows_written": rows_written,
+            "rows_per_second": rows_written / write_elapsed,
+            "rows_dropped": end_stats["dropped"] - start_stats["dropped"],
+            "rows_failed": end_stats["failed"] - start_stats["failed"],
+            "avg_flush_ms": end_stats["avg_flush_ms"],
+            "max_flush_ms": end_stats["max_flush_ms"]
+        },
+        "endpoints": endpoints
+    }
+    if read_latencies is not None:
+        results["concurrent_reads"] = latency_summary(read_latencies)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    routes.ingest_queue.stop()
+    if broker:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
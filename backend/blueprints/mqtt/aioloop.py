@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import paho.mqtt.client as mqtt
+
+
+class AsyncioMqttLoop:
+    """Drives a paho client from an asyncio event loop instead of paho's network thread
+
+    The broker socket is watched with the loop's add_reader/add_writer, so incoming messages are
+    handled on the event loop. Connecting can block on DNS and TCP, so it runs in the default
+    executor. Paho calls the socket callbacks from whichever thread touched the client (a publish
+    from a request thread, for example), so they are moved onto the loop.
+    """
+
+    def __init__(self, client, host, port, keepalive=60, min_delay=1, max_delay=60):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._loop = None
+        self._loop_thread = None
+
+    def _call(self, callback, *args):
+        """Run callback on the event loop: right away when already on it, otherwise as soon as possible"""
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        # Called before paho closes the socket, so the watch must be removed before returning when possible
+        self._call(self._unwatch, sock)
+
+    def _unwatch(self, sock):
+        try:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+        except (ValueError, OSError):
+            # Already closed by paho
+            pass
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._unwatch_write, sock)
+
+    def _unwatch_write(self, sock):
+        try:
+            self._loop.remove_writer(sock)
+        except (ValueError, OSError):
+            pass
+
+    async def run(self):
+        """Connect, keep the connection alive and reconnect with backoff until cancelled"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        delay = self.min_delay
+        try:
+            while True:
+                try:
+                    await self._loop.run_in_executor(None, self.client.connect, self.host, self.port, self.keepalive)
+                    print(f"MQTT client connecting to {self.host}:{self.port} from the event loop")
+                    delay = self.min_delay
+                    # Keepalive pings and retries; stops returning success once the connection is lost
+                    while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                        await asyncio.sleep(1)
+                except Exception as e:
+                    print(f"MQTT connection to {self.host}:{self.port} failed: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+        finally:
+            self.client.disconnect()
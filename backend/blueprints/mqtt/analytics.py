@@ -0,0 +1,296 @@
+import json
+import math
+import threading
+from collections import OrderedDict, deque
+from metrics import Counter
+
+analytics_events = Counter("analytics_events_total", "Threshold rule events per rule and state", ["rule", "state"])
+
+
+class SlidingWindow:
+    """Count, mean, min, max and rate of change over the last seconds of samples, O(1) amortized per sample
+
+    The running sum gives the mean; min and max come from monotonic deques whose front is always
+    the extreme of the current window.
+    """
+
+    __slots__ = ("seconds", "samples", "sum", "_min", "_max")
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()
+        self.sum = 0.0
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, timestamp, value):
+        self.samples.append((timestamp, value))
+        self.sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        self.expire(timestamp)
+
+    def expire(self, now):
+        """Drop samples that fell out of the window at time now"""
+        cutoff = now - self.seconds
+        while self.samples and self.samples[0][0] <= cutoff:
+            self.sum -= self.samples.popleft()[1]
+        while self._min and self._min[0][0] <= cutoff:
+            self._min.popleft()
+        while self._max and self._max[0][0] <= cutoff:
+            self._max.popleft()
+        if not self.samples:
+            # Start again from an exact zero rather than carry rounding error forward
+            self.sum = 0.0
+
+    def summary(self):
+        count = len(self.samples)
+        if not count:
+            return {"count": 0, "mean": None, "min": None, "max": None, "rate": None}
+        (first_timestamp, first), (last_timestamp, last) = self.samples[0], self.samples[-1]
+        elapsed = last_timestamp - first_timestamp
+        return {
+            "count": count,
+            "mean": self.sum / count,
+            "min": self._min[0][1],
+            "max": self._max[0][1],
+            # Change per second between the oldest and newest sample in the window
+            "rate": (last - first) / elapsed if elapsed > 0 else None
+        }
+
+
+class ThresholdRule:
+    """Raise an event when a metric stays beyond a threshold for a while, and clear it once it is back past the clear level
+
+    The gap between threshold and clear is the hysteresis that keeps a value hovering around the
+    threshold from raising and clearing over and over.
+    """
+
+    def __init__(self, name, metric, above=None, below=None, clear=None, for_seconds=0, devices=None):
+        if (above is None) == (below is None):
+            raise ValueError(f"Rule {name}: exactly one of above and below is required")
+        self.name = name
+        self.metric = metric
+        self.above = above is not None
+        try:
+            self.threshold = float(above if self.above else below)
+            self.clear = self.threshold if clear is None else float(clear)
+            self.for_seconds = float(for_seconds)
+        except (TypeError, ValueError):
+            raise ValueError(f"Rule {name}: above, below, clear and for_seconds must be numbers")
+        if (self.clear > self.threshold) if self.above else (self.clear < self.threshold):
+            raise ValueError(f"Rule {name}: clear must be on the safe side of the threshold")
+        self.devices = set(devices) if devices else None
+
+    def applies(self, device_id, metric):
+        return metric == self.metric and (self.devices is None or device_id in self.devices)
+
+    def beyond(self, value):
+        return value > self.threshold if self.above else value < self.threshold
+
+    def cleared(self, value):
+        return value < self.clear if self.above else value > self.clear
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "metric": self.metric,
+            "above" if self.above else "below": self.threshold,
+            "clear": self.clear,
+            "for_seconds": self.for_seconds,
+            "devices": sorted(self.devices) if self.devices else None
+        }
+
+
+# Keys a rule may have besides name and metric
+RULE_OPTIONS = {"above", "below", "clear", "for_seconds", "devices"}
+
+
+def parse_rules(text):
+    """Build threshold rules from a JSON list such as
+    [{"name": "humid", "metric": "humidity", "above": 70, "clear": 65, "for_seconds": 300}]"""
+    rules = []
+    for index, spec in enumerate(json.loads(text or "[]")):
+        if not isinstance(spec, dict):
+            raise ValueError(f"Rule rule{index + 1}: must be an object")
+        spec = dict(spec)
+        name = spec.pop("name", f"rule{index + 1}")
+        try:
+            metric = spec.pop("metric")
+        except KeyError:
+            raise ValueError(f"Rule {name}: metric is required")
+        unknown = sorted(set(spec) - RULE_OPTIONS)
+        if unknown:
+            raise ValueError(f"Rule {name}: unknown keys {', '.join(unknown)}")
+        rules.append(ThresholdRule(name, metric, **spec))
+    return rules
+
+
+class _Series:
+    """Analytics state of one device and metric"""
+
+    __slots__ = ("windows", "ewma", "last_timestamp", "last_value", "last_published", "rules")
+
+    def __init__(self, windows):
+        self.windows = [SlidingWindow(seconds) for seconds in windows]
+        self.ewma = None
+        self.last_timestamp = None
+        self.last_value = None
+        self.last_published = float("-inf")
+        # Rule name -> (state, since): pending while beyond the threshold, active once raised
+        self.rules = {}
+
+
+class StreamAnalytics:
+    """Incremental per-device/metric aggregates and threshold events, updated on every incoming sample
+
+    publish(topic, payload, qos) is called outside the lock with the series summary, at most
+    once per publish_interval seconds per series, and with every rule event as it happens.
+    """
+
+    def __init__(self, windows=(60, 300, 3600), ewma_seconds=60, rules=(), max_series=64,
+                 publish=None, publish_interval=5, topic_prefix="analytics", max_events=200):
+        self.window_seconds = sorted(windows)
+        self.ewma_seconds = ewma_seconds
+        self.rules = list(rules)
+        self.max_series = max_series
+        self.publish_interval = publish_interval
+        self.topic_prefix = topic_prefix
+        self._publish = publish
+        self._series = OrderedDict()
+        self._events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    def add(self, device_id, metric, value, timestamp):
+        """Fold one sample into the windows, EWMA and rules of its series"""
+        messages = []
+        with self._lock:
+            key = (device_id, metric)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.window_seconds)
+                if len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+            else:
+                self._series.move_to_end(key)
+                # The deques rely on time order; a clock step back is treated as no time passing
+                timestamp = max(timestamp, series.last_timestamp)
+
+            if series.ewma is None:
+                series.ewma = value
+            else:
+                # Time-weighted smoothing, so irregular sample intervals do not skew it
+                alpha = 1.0 - math.exp(-(timestamp - series.last_timestamp) / self.ewma_seconds) if self.ewma_seconds else 1.0
+                series.ewma += alpha * (value - series.ewma)
+            series.last_timestamp = timestamp
+            series.last_value = value
+            for window in series.windows:
+                window.add(timestamp, value)
+            self.samples += 1
+
+            for rule in self.rules:
+                if rule.applies(device_id, metric):
+                    event = self._evaluate(rule, series, device_id, value, timestamp)
+                    if event is not None:
+                        messages.append((f"{self.topic_prefix}/{device_id}/alerts/{rule.name}", event, 1))
+
+            if self._publish and timestamp - series.last_published >= self.publish_interval:
+                series.last_published = timestamp
+                messages.append((f"{self.topic_prefix}/{device_id}/{metric}", self._summary(key, series), 0))
+
+        if self._publish:
+            for topic, payload, qos in messages:
+                try:
+                    self._publish(topic, payload, qos)
+                except Exception as e:
+                    print(f"Error publishing analytics to {topic}: {str(e)}")
+
+    def _evaluate(self, rule, series, device_id, value, timestamp):
+        """Advance a rule's state machine for one sample and return the event it raises or clears, if any"""
+        state, since = series.rules.get(rule.name, ("ok", None))
+        if state == "active":
+            if not rule.cleared(value):
+                return None
+            series.rules.pop(rule.name, None)
+            return self._event(rule, device_id, "cleared", value, timestamp, since)
+
+        if not rule.beyond(value):
+            series.rules.pop(rule.name, None)
+            return None
+        if state == "ok":
+            since = timestamp
+        if timestamp - since >= rule.for_seconds:
+            series.rules[rule.name] = ("active", since)
+            return self._event(rule, device_id, "raised", value, timestamp, since)
+        series.rules[rule.name] = ("pending", since)
+        return None
+
+    def _event(self, rule, device_id, state, value, timestamp, since):
+        event = {
+            "rule": rule.name,
+            "device_id": device_id,
+            "metric": rule.metric,
+            "state": state,
+            "value": value,
+            "threshold": rule.threshold if state == "raised" else rule.clear,
+            "since": since,
+            "timestamp": timestamp
+        }
+        self._events.append(event)
+        analytics_events.labels(rule.name, state).inc()
+        return event
+
+    def _summary(self, key, series, now=None):
+        if now is not None:
+            for window in series.windows:
+                window.expire(now)
+        return {
+            "device_id": key[0],
+            "metric": key[1],
+            "value": series.last_value,
+            "timestamp": series.last_timestamp,
+            "ewma": series.ewma,
+            "windows": {f"{window.seconds:g}": window.summary() for window in series.windows},
+            "alerts": [name for name, (state, _) in series.rules.items() if state == "active"]
+        }
+
+    def series(self, device_id=None, metric=None, now=None):
+        """Current aggregates of every matching series, with samples older than the windows at now dropped"""
+        with self._lock:
+            return [
+                self._summary(key, series, now)
+                for key, series in self._series.items()
+                if (device_id is None or key[0] == device_id) and (metric is None or key[1] == metric)
+            ]
+
+    def alerts(self, device_id=None):
+        """Rules currently raised, per device"""
+        with self._lock:
+            return [
+                {"rule": name, "device_id": key[0], "metric": key[1], "since": since}
+                for key, series in self._series.items()
+                if device_id is None or key[0] == device_id
+                for name, (state, since) in series.rules.items()
+                if state == "active"
+            ]
+
+    def events(self, device_id=None, limit=50):
+        """Most recent rule events, newest first"""
+        with self._lock:
+            events = [event for event in reversed(self._events) if device_id is None or event["device_id"] == device_id]
+        return events[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "series": len(self._series),
+                "samples": self.samples,
+                "windows": self.window_seconds,
+                "ewma_seconds": self.ewma_seconds,
+                "rules": [rule.to_dict() for rule in self.rules]
+            }
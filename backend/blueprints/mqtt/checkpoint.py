@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import threading
+
+CHECKPOINT_FORMAT = 1
+
+
+class StateCheckpoint:
+    """Saves the latest state of every device to a small JSON file and restores it at startup
+
+    A save writes a temporary file, fsyncs it and renames it over the previous checkpoint, so a
+    crash mid-write leaves the old checkpoint intact. The background thread only saves when the
+    state version moved since the last save, which keeps writes to an SD card rare.
+    """
+
+    def __init__(self, path, store, interval=30):
+        self.path = path
+        self.store = store
+        self.interval = interval
+        self.saved_version = None
+        self.saves = 0
+        self.last_save_seconds = None
+        self.last_saved_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Return the saved checkpoint as {"version", "saved_at", "devices"}, or None when there is none"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint.get("format") != CHECKPOINT_FORMAT:
+            raise ValueError(f"unsupported checkpoint format {checkpoint.get('format')}")
+        return checkpoint
+
+    def restore(self):
+        """Load the checkpoint into an empty store and return how many records were restored
+
+        A store that already holds state (a worker taking over from another leader) is newer
+        than any checkpoint and is left alone.
+        """
+        if self.store.version:
+            return 0
+        checkpoint = self.load()
+        if checkpoint is None:
+            return 0
+        # Versions keep counting from the checkpoint, so a long-poll "since" from before the restart still sees the restored state as newer
+        self.store.skip_to(checkpoint["version"])
+        restored = 0
+        for device_id, kinds in checkpoint["devices"].items():
+            for kind, record in kinds.items():
+                record.pop("version", None)
+                self.store.update(device_id, kind, **record)
+                restored += 1
+        self.saved_version = self.store.version
+        return restored
+
+    def save(self, force=False):
+        """Write the current state unless it has not changed since the last save; returns whether it wrote"""
+        with self._lock:
+            version = self.store.version
+            if version == self.saved_version and not force:
+                return False
+            started = time.perf_counter()
+            checkpoint = {
+                "format": CHECKPOINT_FORMAT,
+                "version": version,
+                "saved_at": time.time(),
+                "devices": self.store.devices()
+            }
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(checkpoint, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self.saved_version = version
+            self.saves += 1
+            self.last_saved_at = checkpoint["saved_at"]
+            self.last_save_seconds = time.perf_counter() - started
+            return True
+
+    def start(self):
+        """Save every interval seconds in a background thread"""
+        if self._thread is not None or not self.interval:
+            return
+        self._thread = threading.Thread(target=self._run, name="state-checkpoint", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Error saving the state checkpoint: {str(e)}")
+
+    def stop(self):
+        """Stop the background thread and save one last time"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.save()
+        except Exception as e:
+            print(f"Error saving the state checkpoint: {str(e)}")
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "interval_seconds": self.interval,
+            "saves": self.saves,
+            "saved_version": self.saved_version,
+            "last_saved_at": self.last_saved_at,
+            "last_save_seconds": self.last_save_seconds
+        }
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import threading
+import socketserver
+from contextlib import contextmanager
+
+
+@contextmanager
+def startup_lock(directory):
+    """Hold <directory>/startup.lock, so the workers of a server run their startup schema changes one at a time
+
+    Yields True in the first worker of this server to take it, the one that should do one-off
+    work such as a requested rebuild; workers are told apart from the next server by their
+    parent process.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(os.path.join(directory, "startup.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        server = str(os.getppid()).encode("utf-8")
+        yield os.pread(fd, 32, 0) != server
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, server, 0)
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                # Operations are view code run outside a request, so they get the app context a view would have
+                with self.server.app.app_context():
+                    payload, status = self.server.ops[request["op"]](**request.get("args", {}))
+            except Exception as e:
+                payload, status = {"error": str(e)}, 500
+            self.wfile.write(json.dumps({"payload": payload, "status": status}).encode("utf-8") + b"\n")
+
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Cluster:
+    """Coordinates the worker processes of one server sharing a directory
+
+    Every worker tries to take an exclusive flock on <directory>/leader.lock; the one holding it
+    is the leader until it exits, when the kernel releases the lock and another worker takes
+    over within poll_interval. The leader serves operations on <directory>/control.sock, so a
+    follower can call(op, args) to have it run them inside the leader's app context.
+    """
+
+    def __init__(self, directory, ops, on_elected, app, poll_interval=1.0, timeout=5.0):
+        self.directory = directory
+        self.app = app
+        self.lock_path = os.path.join(directory, "leader.lock")
+        self.socket_path = os.path.join(directory, "control.sock")
+        self.ops = ops
+        self.on_elected = on_elected
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.is_leader = False
+        self.elected_at = None
+        self._lock_fd = None
+        self._server = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """Take the leadership now if it is free, otherwise keep trying in the background"""
+        self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        if not self._try_elect():
+            threading.Thread(target=self._campaign, name="leader-election", daemon=True).start()
+
+    def _try_elect(self):
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        # Holding the lock, so any socket file left behind belongs to a dead leader
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = _ControlServer(self.socket_path, _ControlHandler)
+        self._server.ops = self.ops
+        self._server.app = self.app
+        threading.Thread(target=self._server.serve_forever, name="control-server", daemon=True).start()
+
+        self.is_leader = True
+        self.elected_at = time.time()
+        print(f"Worker {os.getpid()} is the leader")
+        self.on_elected()
+        return True
+
+    def _campaign(self):
+        while not self._try_elect():
+            time.sleep(self.poll_interval)
+
+    def call(self, op, args=None):
+        """Run an operation on the leader and return its (payload, status)"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps({"op": op, "args": args or {}}).encode("utf-8") + b"\n")
+            response = b""
+            while not response.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError("Leader closed the control connection")
+                response += chunk
+        response = json.loads(response)
+        return response["payload"], response["status"]
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "elected_at": self.elected_at
+        }
@@ -0,0 +1,38 @@
+import sys
+import struct
+from array import array
+
+COLUMNAR_MIMETYPE = "application/vnd.iot.columnar"
+
+# magic, version, flags, reserved, sample count
+HEADER = struct.Struct("<4sBBHI")
+MAGIC = b"IOTC"
+VERSION = 1
+
+
+def encode_columnar(timestamps, values):
+    """Pack parallel timestamp/value columns as a header, float64 timestamps and float32 values
+
+    All numbers are little-endian.
+    """
+    timestamps = array("d", timestamps)
+    values = array("f", values)
+    if sys.byteorder != "little":
+        timestamps.byteswap()
+        values.byteswap()
+    return HEADER.pack(MAGIC, VERSION, 0, 0, len(timestamps)) + timestamps.tobytes() + values.tobytes()
+
+
+def decode_columnar(payload):
+    """Unpack a columnar payload into (timestamps, values) arrays"""
+    magic, version, _, _, count = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a columnar history payload")
+
+    offset = HEADER.size
+    timestamps = array("d", payload[offset:offset + 8 * count])
+    values = array("f", payload[offset + 8 * count:offset + 12 * count])
+    if sys.byteorder != "little":
+        timestamps.byteswap()
+        values.byteswap()
+    return timestamps, values
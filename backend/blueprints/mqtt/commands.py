@@ -0,0 +1,301 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from metrics import Counter, Histogram
+
+commands_submitted = Counter("commands_submitted_total", "Control commands accepted from the API", ["kind"])
+commands_published = Counter("commands_published_total", "Control commands published to MQTT", ["kind"])
+commands_coalesced = Counter("commands_coalesced_total", "Control commands replaced by a newer one before publishing", ["kind"])
+commands_dropped = Counter("commands_dropped_total", "Control commands that could not be published", ["kind"])
+commands_acknowledged = Counter("commands_acknowledged_total", "Control commands a device acknowledged actuating", ["kind"])
+command_latency = Histogram("command_latency_seconds", "Control command latency per stage, from the API call to the device actuating", ["kind", "stage"])
+
+# A command on the wire is "<command> #<command id>", e.g. "left 45 #1042"
+COMMAND_ID_SEPARATOR = " #"
+
+
+def split_command_id(payload):
+    """Return (command, command id or None) for a control payload with or without an id"""
+    command, separator, tag = payload.rpartition(COMMAND_ID_SEPARATOR)
+    if separator and tag.isdigit():
+        return command, int(tag)
+    return payload, None
+
+
+class _Slot:
+    """Scheduling state of one device's actuator"""
+
+    __slots__ = ("pending", "scheduled", "last_published", "last_command_id")
+
+    def __init__(self):
+        self.pending = None
+        self.scheduled = False
+        self.last_published = float("-inf")
+        self.last_command_id = None
+
+
+class CommandScheduler:
+    """Coalesces and rate-limits control commands per device and actuator
+
+    The first command after a quiet period is published right away. Commands arriving within
+    window_ms of the last publish for the same actuator are held until the window ends, and only
+    the newest one is published. On top of that, a device gets at most max_rate publishes per
+    second across all of its actuators.
+
+    publish(device_id, kind, payload, command_id) sends a command and returns whether it went out;
+    on_submitted(command_id, device_id, kind, payload) runs for every command before it can be sent.
+    """
+
+    def __init__(self, publish, window_ms=50, max_rate=20, on_submitted=None):
+        self._publish = publish
+        self._on_submitted = on_submitted
+        self.window = window_ms / 1000.0
+        self.max_rate = max_rate
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self._ids = itertools.count(1)
+        self._slots = {}
+        self._device_last = {}
+        self._due = []
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.submitted = 0
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="command-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def submit(self, device_id, kind, payload, on_published=None):
+        """Queue a command and return its id; on_published() runs once it has been published"""
+        command_id = next(self._ids)
+        key = (device_id, kind)
+        with self._cond:
+            self.submitted += 1
+            commands_submitted.labels(kind).inc()
+            if self._on_submitted:
+                self._on_submitted(command_id, device_id, kind, payload)
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+
+            if slot.pending is not None:
+                self.coalesced += 1
+                commands_coalesced.labels(kind).inc()
+            slot.pending = (command_id, payload, on_published)
+
+            if not slot.scheduled:
+                due = max(
+                    time.monotonic(),
+                    slot.last_published + self.window,
+                    self._device_last.get(device_id, float("-inf")) + self.min_interval
+                )
+                heapq.heappush(self._due, (due, key))
+                slot.scheduled = True
+                self._cond.notify()
+        return command_id
+
+    def _next(self):
+        """Wait for the next due command and take it off its slot"""
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if self._due and self._due[0][0] <= now:
+                    _, key = heapq.heappop(self._due)
+                    device_id = key[0]
+                    # Another actuator of the device may have published since this one was scheduled
+                    device_due = self._device_last.get(device_id, float("-inf")) + self.min_interval
+                    if device_due > now:
+                        heapq.heappush(self._due, (device_due, key))
+                        continue
+                    slot = self._slots[key]
+                    command, slot.pending, slot.scheduled = slot.pending, None, False
+                    slot.last_published = self._device_last[device_id] = now
+                    slot.last_command_id = command[0]
+                    return key, command
+                self._cond.wait(self._due[0][0] - now if self._due else None)
+            return None
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            (device_id, kind), (command_id, payload, on_published) = item
+            try:
+                if self._publish(device_id, kind, payload, command_id):
+                    self.published += 1
+                    commands_published.labels(kind).inc()
+                    if on_published:
+                        on_published()
+                    continue
+                print(f"Could not publish {kind} command {command_id} for {device_id}")
+            except Exception as e:
+                print(f"Error publishing {kind} command {command_id} for {device_id}: {str(e)}")
+            self.dropped += 1
+            commands_dropped.labels(kind).inc()
+
+    def stats(self):
+        with self._cond:
+            pending = sum(1 for slot in self._slots.values() if slot.pending is not None)
+        return {
+            "window_ms": self.window * 1000,
+            "max_rate": self.max_rate,
+            "submitted": self.submitted,
+            "published": self.published,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "pending": pending
+        }
+
+
+class CommandTracker:
+    """Follows control commands from the API call to the device's acknowledgement
+
+    Each command moves from queued to published, and then to acknowledged once the device reports
+    it actuated. It can also end as coalesced (a newer command for the same actuator was published
+    instead), superseded (the device acted on a newer one before getting to it) or dropped. Device
+    timestamps are only ever subtracted from each other, so the device clock need not be in sync:
+    the broker-to-device time is half the round trip minus the time the device held the command.
+    """
+
+    FINAL = ("acknowledged", "coalesced", "superseded", "dropped")
+
+    def __init__(self, max_commands=10000):
+        self.max_commands = max_commands
+        self._commands = OrderedDict()
+        # (device_id, kind) -> ids of its commands that may still change status
+        self._open = {}
+        self._cond = threading.Condition()
+        # Devices that announced they acknowledge commands
+        self.acking_devices = set()
+
+    def _forget(self, record):
+        """Stop tracking a command as open; it may already have been, e.g. published without an id"""
+        open_ids = self._open[(record["device_id"], record["kind"])]
+        if record["command_id"] in open_ids:
+            open_ids.remove(record["command_id"])
+
+    def _close(self, record, status):
+        record["status"] = status
+        self._forget(record)
+
+    def _close_older(self, record, statuses, status):
+        """Close the older open commands of the same device and actuator that are in one of statuses"""
+        for command_id in list(self._open[(record["device_id"], record["kind"])]):
+            other = self._commands[command_id]
+            if command_id < record["command_id"] and other["status"] in statuses:
+                self._close(other, status)
+                other["replaced_by"] = record["command_id"]
+
+    def queued(self, command_id, device_id, kind, payload):
+        with self._cond:
+            self._commands[command_id] = {
+                "command_id": command_id,
+                "device_id": device_id,
+                "kind": kind,
+                "payload": payload,
+                "status": "queued",
+                "traced": False,
+                "submitted_at": time.time(),
+                "published_at": None,
+                "acknowledged_at": None,
+                "latency_ms": None
+            }
+            self._open.setdefault((device_id, kind), []).append(command_id)
+            while len(self._commands) > self.max_commands:
+                _, oldest = self._commands.popitem(last=False)
+                self._forget(oldest)
+
+    def published(self, command_id, traced):
+        """Record that a command went out, carrying its id when traced"""
+        with self._cond:
+            record = self._commands.get(command_id)
+            if record is None:
+                return
+            record["status"] = "published"
+            record["traced"] = traced
+            record["published_at"] = time.time()
+            command_latency.labels(record["kind"], "api_to_broker").observe(record["published_at"] - record["submitted_at"])
+            self._close_older(record, ("queued",), "coalesced")
+            if not traced:
+                # No acknowledgement will ever name it
+                self._forget(record)
+            self._cond.notify_all()
+
+    def dropped(self, command_id):
+        with self._cond:
+            record = self._commands.get(command_id)
+            if record is not None and record["status"] not in self.FINAL:
+                self._close(record, "dropped")
+                self._cond.notify_all()
+
+    def acknowledged(self, device_id, ack, received_at):
+        """Apply an acknowledgement {"command_id", "received_at", "actuated_at", "sent_at"} and return the record, or None if unknown"""
+        with self._cond:
+            record = self._commands.get(ack["command_id"])
+            if record is None or record["device_id"] != device_id or record["status"] != "published":
+                return None
+            api_to_broker = record["published_at"] - record["submitted_at"]
+            device_to_actuated = max(0.0, ack["actuated_at"] - ack["received_at"])
+            held = max(0.0, ack["sent_at"] - ack["received_at"])
+            broker_to_device = max(0.0, (received_at - record["published_at"] - held) / 2)
+            self._close(record, "acknowledged")
+            record["acknowledged_at"] = received_at
+            record["latency_ms"] = {
+                "api_to_broker": api_to_broker * 1000,
+                "broker_to_device": broker_to_device * 1000,
+                "device_to_actuated": device_to_actuated * 1000,
+                "api_to_actuated": (api_to_broker + broker_to_device + device_to_actuated) * 1000,
+                "round_trip": (received_at - record["submitted_at"]) * 1000
+            }
+            for stage in ("broker_to_device", "device_to_actuated", "api_to_actuated"):
+                command_latency.labels(record["kind"], stage).observe(record["latency_ms"][stage] / 1000)
+            commands_acknowledged.labels(record["kind"]).inc()
+            # The device only acts on the newest command, so older ones still in flight were skipped
+            self._close_older(record, ("queued", "published"), "superseded")
+            self._cond.notify_all()
+            return dict(record)
+
+    def get(self, command_id):
+        with self._cond:
+            record = self._commands.get(command_id)
+            return dict(record) if record is not None else None
+
+    def wait(self, command_id, timeout):
+        """Wait until a command is final, or published without an id to acknowledge, and return its record"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                record = self._commands.get(command_id)
+                if record is None:
+                    return None
+                if record["status"] in self.FINAL or (record["status"] == "published" and not record["traced"]):
+                    return dict(record)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return dict(record)
+                self._cond.wait(remaining)
+
+    def stats(self):
+        with self._cond:
+            statuses = {}
+            for record in self._commands.values():
+                statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+            return {
+                "tracked": len(self._commands),
+                "statuses": statuses,
+                "acking_devices": sorted(self.acking_devices)
+            }
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from models import DEFAULT_DEVICE_ID
+
+
+class Subscriber:
+    """One stream client: a per-device/topic mailbox where newer updates replace ones not yet delivered"""
+
+    def __init__(self, topics=None, devices=None):
+        self.topics = set(topics) if topics else None
+        self.devices = set(devices) if devices else None
+        self.coalesced = 0
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def wants(self, device_id, topic):
+        return (self.topics is None or topic in self.topics) and (self.devices is None or device_id in self.devices)
+
+    def offer(self, device_id, topic, data):
+        """Queue an update, replacing any undelivered update for the same device and topic"""
+        key = (device_id, topic)
+        with self._cond:
+            if key in self._pending:
+                self.coalesced += 1
+                del self._pending[key]
+            self._pending[key] = data
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """Block until updates are pending or the timeout expires, then take all of them
+
+        Returns a list of ((device_id, topic), data) tuples, empty on timeout, or None once closed.
+        """
+        with self._cond:
+            if not self._pending and not self._closed:
+                self._cond.wait(timeout)
+            if self._closed:
+                return None
+            updates = list(self._pending.items())
+            self._pending.clear()
+            return updates
+
+
+class AsyncSubscriber(Subscriber):
+    """Subscriber for asyncio handlers: an offer from any thread wakes a coroutine on the loop instead of a thread"""
+
+    def __init__(self, loop, topics=None, devices=None):
+        super().__init__(topics, devices)
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def _wake(self):
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The loop has been closed
+            pass
+
+    def offer(self, device_id, topic, data):
+        super().offer(device_id, topic, data)
+        self._wake()
+
+    def close(self):
+        super().close()
+        self._wake()
+
+    async def next(self, timeout):
+        """Like wait(), but suspends the coroutine instead of blocking the event loop"""
+        deadline = self._loop.time() + timeout
+        while True:
+            updates = self.wait(0)
+            if updates is None or updates:
+                return updates
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return []
+            # Set callbacks run on this loop, so none can slip in between the check and the clear
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return []
+
+
+class EventBus:
+    """Fan-out of state changes to stream subscribers"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self._coalesced_closed = 0
+
+    def subscribe(self, topics=None, devices=None):
+        return self.attach(Subscriber(topics, devices))
+
+    def attach(self, subscriber):
+        """Start delivering to an already created subscriber, e.g. an AsyncSubscriber"""
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.discard(subscriber)
+                self._coalesced_closed += subscriber.coalesced
+        subscriber.close()
+
+    def publish(self, topic, data, device_id=DEFAULT_DEVICE_ID):
+        """Deliver an update to every subscriber interested in the device and topic"""
+        self.published += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if subscriber.wants(device_id, topic):
+                subscriber.offer(device_id, topic, data)
+
+    def stats(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            coalesced = self._coalesced_closed
+        return {
+            "subscribers": len(subscribers),
+            "published": self.published,
+            "coalesced": coalesced + sum(subscriber.coalesced for subscriber in subscribers)
+        }
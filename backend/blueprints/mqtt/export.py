@@ -0,0 +1,134 @@
+import io
+import csv
+import json
+import base64
+from datetime import datetime, timezone
+from models import db, SensorReading
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+CSV_COLUMNS = ("id", "device_id", "metric", "value", "timestamp")
+
+
+def encode_cursor(timestamp, reading_id):
+    """Build an opaque continuation token for the (timestamp, id) keyset position"""
+    raw = json.dumps([timestamp.isoformat(), reading_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """Return the (timestamp, id) position encoded in a continuation token"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        timestamp, reading_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(reading_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def _keyset_query(device_id, metric, start_time, end_time, after):
+    query = db.select(
+        SensorReading.id,
+        SensorReading.device_id,
+        SensorReading.metric,
+        SensorReading.value,
+        SensorReading.timestamp
+    ).where(
+        SensorReading.device_id == device_id,
+        SensorReading.metric == metric
+    )
+
+    if start_time:
+        query = query.where(SensorReading.timestamp >= datetime.utcfromtimestamp(start_time))
+
+    if end_time:
+        query = query.where(SensorReading.timestamp <= datetime.utcfromtimestamp(end_time))
+
+    if after:
+        after_timestamp, after_id = after
+        # (timestamp, id) > (after_timestamp, after_id), written so the index range still applies
+        query = query.where(
+            SensorReading.timestamp >= after_timestamp,
+            db.or_(SensorReading.timestamp > after_timestamp, SensorReading.id > after_id)
+        )
+
+    return query.order_by(SensorReading.timestamp, SensorReading.id)
+
+
+def iter_readings(device_id, metric, start_time=None, end_time=None, after=None, limit=None, page_size=1000):
+    """Yield reading rows in (timestamp, id) order, one short keyset query per page
+
+    Each page is streamed from the database cursor, so memory use does not depend on the export size.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        result = db.session.execute(
+            _keyset_query(device_id, metric, start_time, end_time, after).limit(size),
+            execution_options={"yield_per": size}
+        )
+
+        count = 0
+        for row in result:
+            count += 1
+            after = (row.timestamp, row.id)
+            yield row
+
+        if remaining is not None:
+            remaining -= count
+        if count < size:
+            return
+
+
+def cursor_line(token, export_format):
+    """Last line of a page that has more rows after it, carrying the cursor of the next page"""
+    if export_format == "csv":
+        return f"# next_cursor: {token}\n"
+    return json.dumps({"next_cursor": token}) + "\n"
+
+
+def format_rows(rows, export_format, limit=None, chunk_size=1000):
+    """Serialize reading rows as NDJSON or CSV text chunks
+
+    With a limit, rows should be fetched with one row more: that row is not written, but shows
+    that more remain, so a last line with the cursor after the last row written is added.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if export_format == "csv":
+        writer.writerow(CSV_COLUMNS)
+
+    pending = 0
+    written = 0
+    last = None
+    for row in rows:
+        if written == limit:
+            buffer.write(cursor_line(encode_cursor(last.timestamp, last.id), export_format))
+            break
+        timestamp = row.timestamp.replace(tzinfo=timezone.utc).timestamp()
+        if export_format == "csv":
+            writer.writerow((row.id, row.device_id, row.metric, row.value, timestamp))
+        else:
+            buffer.write(json.dumps({
+                "id": row.id,
+                "device_id": row.device_id,
+                "metric": row.metric,
+                "value": row.value,
+                "timestamp": timestamp
+            }))
+            buffer.write("\n")
+
+        written += 1
+        last = row
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,146 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+class RingBuffer:
+    """Fixed-size, time-ordered ring of (id, timestamp, value) samples backed by typed arrays
+
+    Every stored sample with a timestamp after complete_after is guaranteed to be in the ring,
+    which is what lets a window be answered without going to the database.
+    """
+
+    def __init__(self, capacity, complete_after):
+        self.capacity = capacity
+        self.complete_after = complete_after
+        self.ids = array('q', [0]) * capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        # Logical (oldest-first) timestamp lookup, which is all bisect needs
+        return self.timestamps[(self.head + index) % self.capacity]
+
+    def append(self, sample_id, timestamp, value):
+        """Add a sample, evicting the oldest one when full"""
+        if timestamp <= self.complete_after:
+            # Older than anything we vouch for, the database already has it
+            return
+
+        if self.size == self.capacity:
+            self.complete_after = max(self.complete_after, self.timestamps[self.head])
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+            if timestamp <= self.complete_after:
+                return
+
+        # Samples nearly always arrive in order; late ones are shifted into place
+        position = self.size
+        while position > 0 and self[position - 1] > timestamp:
+            position -= 1
+        for index in range(self.size, position, -1):
+            source = (self.head + index - 1) % self.capacity
+            target = (self.head + index) % self.capacity
+            self.ids[target] = self.ids[source]
+            self.timestamps[target] = self.timestamps[source]
+            self.values[target] = self.values[source]
+
+        target = (self.head + position) % self.capacity
+        self.ids[target] = sample_id
+        self.timestamps[target] = timestamp
+        self.values[target] = value
+        self.size += 1
+
+    def trim(self, cutoff):
+        """Drop the samples older than cutoff, e.g. once the database has deleted them"""
+        while self.size and self.timestamps[self.head] < cutoff:
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+
+    def window(self, start_time, end_time, limit):
+        """Return up to limit samples in [start_time, end_time] newest first, or None if the ring cannot answer"""
+        low = bisect_left(self, start_time) if start_time else 0
+        high = bisect_right(self, end_time) if end_time else self.size
+
+        complete = (start_time and start_time > self.complete_after) or high - low >= limit
+        if not complete:
+            return None
+
+        rows = []
+        for index in range(high - 1, max(low, high - limit) - 1, -1):
+            physical = (self.head + index) % self.capacity
+            rows.append((self.ids[physical], self.timestamps[physical], self.values[physical]))
+        return rows
+
+
+class HotCache:
+    """Recent samples per device and metric, held in bounded ring buffers"""
+
+    # Bytes per sample: int64 id, float64 timestamp and float64 value
+    SAMPLE_BYTES = 24
+
+    def __init__(self, capacity=10000, max_series=64):
+        self.capacity = capacity
+        self.max_series = max_series
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, device_id, metric, samples):
+        """Append committed (id, value, timestamp) samples for a device and metric"""
+        if not self.capacity:
+            return
+        key = (device_id, metric)
+        with self._lock:
+            ring = self._series.get(key)
+            if ring is None:
+                # Anything stored before the first sample we see may be missing from the ring
+                ring = RingBuffer(self.capacity, min(timestamp for _, _, timestamp in samples) - 1e-6)
+                self._series[key] = ring
+                if len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+            else:
+                self._series.move_to_end(key)
+
+            for sample_id, value, timestamp in samples:
+                # The database keeps microsecond precision, match it
+                ring.append(sample_id, round(timestamp, 6), value)
+
+    def query(self, device_id, metric, start_time=None, end_time=None, limit=100):
+        """Return (id, timestamp, value) rows newest first, or None when the window is not fully cached"""
+        with self._lock:
+            ring = self._series.get((device_id, metric))
+            rows = ring.window(start_time, end_time, limit) if ring is not None and limit > 0 else None
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rows
+
+    def trim(self, cutoff):
+        """Drop samples older than cutoff from every series"""
+        with self._lock:
+            for ring in self._series.values():
+                ring.trim(cutoff)
+
+    def stats(self):
+        """Return hit/miss counters and memory use"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "capacity": self.capacity,
+                "max_series": self.max_series,
+                "series": len(self._series),
+                "samples": sum(len(ring) for ring in self._series.values()),
+                "memory_bytes": len(self._series) * self.capacity * self.SAMPLE_BYTES,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
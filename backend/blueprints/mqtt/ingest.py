@@ -0,0 +1,252 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from models import db, SensorReading, use_writer_session
+from metrics import Counter, Histogram
+
+flush_latency = Histogram("ingest_flush_duration_seconds", "Time to insert and commit one batch of sensor rows")
+rows_written = Counter("ingest_rows_written_total", "Sensor rows committed to the database")
+rows_failed = Counter("ingest_rows_failed_total", "Sensor rows lost to failed flushes")
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+
+class IngestQueue:
+    """Bounded write-behind queue that group-commits sensor rows from a dedicated writer thread"""
+
+    def __init__(self, max_size=10000, batch_size=500, flush_interval_ms=500, overflow_policy="block"):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy '{overflow_policy}'. Must be one of {', '.join(OVERFLOW_POLICIES)}")
+
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.overflow_policy = overflow_policy
+
+        self._rows = deque()
+        self._tasks = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._running = False
+        self._thread = None
+        self._app = None
+        self._flush_hooks = []
+        self._commit_hooks = []
+
+        # Counters exposed through the /ingest endpoint
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add_flush_hook(self, hook):
+        """Register hook(device_id, metric, samples) to run inside each flush transaction
+
+        samples is a list of (value, timestamp) tuples for that device and metric.
+        """
+        self._flush_hooks.append(hook)
+
+    def add_commit_hook(self, hook):
+        """Register hook(device_id, metric, rows) to run after each successful flush
+
+        rows is a list of (id, value, timestamp) tuples for the committed samples.
+        """
+        self._commit_hooks.append(hook)
+
+    def _append(self, row):
+        # Caller holds the lock
+        if len(self._rows) >= self.max_size:
+            if self.overflow_policy == "drop_newest":
+                self.dropped += 1
+                return False
+            if self.overflow_policy == "drop_oldest":
+                self._rows.popleft()
+                self.dropped += 1
+            else:
+                while self._running and len(self._rows) >= self.max_size:
+                    self._not_empty.notify()
+                    self._not_full.wait()
+
+        self._rows.append(row)
+        self.enqueued += 1
+        return True
+
+    def put(self, device_id, metric, value, timestamp):
+        """Queue a sample for the given device and metric, applying the overflow policy when the queue is full"""
+        with self._lock:
+            accepted = self._append((device_id, metric, value, timestamp))
+            if len(self._rows) >= self.batch_size:
+                self._not_empty.notify()
+        return accepted
+
+    def put_many(self, rows):
+        """Queue many (device_id, metric, value, timestamp) samples at once and return how many were accepted"""
+        accepted = 0
+        with self._lock:
+            for row in rows:
+                accepted += self._append(row)
+            if len(self._rows) >= self.batch_size:
+                self._not_empty.notify()
+        return accepted
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the writer thread between batches and return a Future for its result
+
+        Used for maintenance writes that must not race with ingestion.
+        """
+        future = Future()
+        with self._lock:
+            self._tasks.append((future, fn, args))
+            self._not_empty.notify()
+        return future
+
+    def start(self, app):
+        """Start the writer thread, which runs inside its own app context and owns the writer connection"""
+        if self._running:
+            return
+        self._app = app
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the writer thread after flushing everything still queued"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self._thread.join()
+
+    def _take_batch(self):
+        with self._lock:
+            deadline = time.monotonic() + self.flush_interval
+            while self._running and len(self._rows) < self.batch_size and not self._tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_empty.wait(remaining)
+
+            count = min(len(self._rows), self.batch_size)
+            batch = [self._rows.popleft() for _ in range(count)]
+            if batch:
+                self._not_full.notify_all()
+            return batch
+
+    def _run_tasks(self):
+        while self._tasks:
+            with self._lock:
+                future, fn, args = self._tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                db.session.rollback()
+                future.set_exception(e)
+
+    def _run(self):
+        with self._app.app_context():
+            use_writer_session()
+            while True:
+                batch = self._take_batch()
+                if batch:
+                    self._write(batch)
+                self._run_tasks()
+                if not batch and not self._running:
+                    break
+
+    def _write(self, batch):
+        """Insert one batch and run the commit hooks for the rows that were committed"""
+        started = time.perf_counter()
+        committed = self._commit(batch)
+
+        elapsed = time.perf_counter() - started
+        flush_latency.observe(elapsed)
+        self.flushes += 1
+        self.last_flush_ms = elapsed * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.total_flush_ms += self.last_flush_ms
+
+        if not self._commit_hooks:
+            return
+        grouped = {}
+        for rows, ids in committed:
+            for sample_id, (device_id, metric, value, timestamp) in zip(ids, rows):
+                grouped.setdefault((device_id, metric), []).append((sample_id, value, timestamp))
+        for (device_id, metric), samples in grouped.items():
+            for hook in self._commit_hooks:
+                try:
+                    hook(device_id, metric, samples)
+                except Exception as e:
+                    print(f"Error in ingest commit hook: {str(e)}")
+
+    def _commit(self, batch):
+        """Insert rows in a single transaction, running the flush hooks per device and metric
+
+        Returns the committed (rows, ids) parts. A batch rejected by a constraint is retried in
+        halves, so one bad row costs only itself instead of every device's readings in the batch.
+        """
+        grouped = {}
+        for device_id, metric, value, timestamp in batch:
+            grouped.setdefault((device_id, metric), []).append((value, timestamp))
+
+        try:
+            rows = [
+                {"device_id": device_id, "metric": metric, "value": value, "timestamp": datetime.utcfromtimestamp(timestamp)}
+                for device_id, metric, value, timestamp in batch
+            ]
+            ids = db.session.execute(
+                db.insert(SensorReading).returning(SensorReading.id, sort_by_parameter_order=True),
+                rows
+            ).scalars().all()
+            for (device_id, metric), samples in grouped.items():
+                for hook in self._flush_hooks:
+                    hook(device_id, metric, samples)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return self._commit(batch[:middle]) + self._commit(batch[middle:])
+            print(f"Dropping sensor row {batch[0]}: {str(e.orig)}")
+            self.failed += 1
+            rows_failed.inc()
+            return []
+        except Exception as e:
+            print(f"Error storing batch of {len(batch)} sensor rows: {str(e)}")
+            db.session.rollback()
+            self.failed += len(batch)
+            rows_failed.inc(len(batch))
+            return []
+
+        self.written += len(batch)
+        rows_written.inc(len(batch))
+        return [(batch, ids)]
+
+    def stats(self):
+        """Return queue depth and flush counters"""
+        return {
+            "depth": len(self._rows),
+            "max_size": self.max_size,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "overflow_policy": self.overflow_policy,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0
+        }
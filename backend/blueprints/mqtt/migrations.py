@@ -0,0 +1,51 @@
+from models import db, DEFAULT_DEVICE_ID
+from .rollups import rebuild_rollups
+
+# Per-metric tables used before readings were stored in sensor_readings
+LEGACY_TABLES = {
+    "temperature_data": "temperature",
+    "humidity_data": "humidity"
+}
+
+# Derived tables that are rebuilt from sensor_readings when their schema is out of date
+DERIVED_TABLES = ("sensor_rollups", "sensor_stats")
+
+
+def migrate_schema():
+    """Bring an existing database up to the current schema
+
+    Moves rows from the legacy temperature_data/humidity_data tables into sensor_readings and
+    recreates derived tables that predate the device_id column. Safe to run on every startup.
+    """
+    inspector = db.inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    rebuild = False
+
+    for table in DERIVED_TABLES:
+        if table in tables and "device_id" not in {column["name"] for column in inspector.get_columns(table)}:
+            db.session.execute(db.text(f"DROP TABLE {table}"))
+            print(f"Dropped outdated {table} table, it will be rebuilt from raw readings")
+            rebuild = True
+    db.session.commit()
+
+    db.create_all()
+
+    for table, metric in LEGACY_TABLES.items():
+        if table not in tables:
+            continue
+        result = db.session.execute(
+            db.text(
+                f"INSERT INTO sensor_readings (device_id, metric, value, timestamp) "
+                f"SELECT :device_id, :metric, value, timestamp FROM {table} ORDER BY id"
+            ),
+            {"device_id": DEFAULT_DEVICE_ID, "metric": metric}
+        )
+        db.session.execute(db.text(f"DROP TABLE {table}"))
+        db.session.commit()
+        print(f"Migrated {result.rowcount} rows from {table} into sensor_readings")
+        rebuild = True
+
+    if rebuild:
+        rebuild_rollups()
+        print("Rebuilt sensor rollups from raw readings")
+    return rebuild
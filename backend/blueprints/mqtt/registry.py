@@ -0,0 +1,55 @@
+from models import DEFAULT_DEVICE_ID
+
+
+class TopicRegistry:
+    """Maps MQTT topic patterns to handler functions
+
+    A pattern is either an exact topic, which belongs to the default device, or a topic with a single
+    '+' level holding the device id, e.g. 'sensors/+/temperature'. Dispatch is a dict lookup per
+    distinct wildcard position, independent of how many patterns are registered.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._wildcard = {}
+        # (number of levels, index of the '+' level) for every registered wildcard pattern
+        self._shapes = []
+
+    def register(self, pattern, handler):
+        """Register handler(device_id, payload, received_at) for a topic pattern
+
+        The handler returns False when the payload could not be parsed.
+        """
+        levels = pattern.split("/")
+        wildcards = [index for index, level in enumerate(levels) if level == "+"]
+        if "#" in levels or len(wildcards) > 1:
+            raise ValueError(f"Unsupported topic pattern '{pattern}': only a single '+' device level is allowed")
+
+        if not wildcards:
+            self._exact[pattern] = handler
+            return
+
+        shape = (len(levels), wildcards[0])
+        if shape not in self._shapes:
+            self._shapes.append(shape)
+        self._wildcard[pattern] = handler
+
+    def patterns(self):
+        """Every registered pattern, for subscribing"""
+        return list(self._exact) + list(self._wildcard)
+
+    def resolve(self, topic):
+        """Return (handler, device_id, pattern) for a topic, or (None, None, None) when nothing matches"""
+        handler = self._exact.get(topic)
+        if handler is not None:
+            return handler, DEFAULT_DEVICE_ID, topic
+
+        levels = topic.split("/")
+        for length, index in self._shapes:
+            if len(levels) != length or not levels[index]:
+                continue
+            key = "/".join(levels[:index] + ["+"] + levels[index + 1:])
+            handler = self._wildcard.get(key)
+            if handler is not None:
+                return handler, levels[index], key
+        return None, None, None
@@ -0,0 +1,120 @@
+import math
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping cost on top of the cached bytes
+ENTRY_OVERHEAD = 256
+
+
+class ResultCache:
+    """LRU of rendered responses, bounded by their total size
+
+    Every entry records the series it was computed from and the time range of samples that could
+    change it. Newly committed samples only invalidate entries of their series whose range they
+    fall in, so a closed window in the past stays cached until it is evicted.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._by_series = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def generation(self, series):
+        """Current invalidation counter of a series; read it before computing a result to cache"""
+        return self._generations.get(series, 0)
+
+    def put(self, key, value, size, series, low=-math.inf, high=math.inf, generation=0):
+        """Cache value for key unless the series was invalidated since generation was read
+
+        Samples with a timestamp in [low, high] invalidate the entry.
+        """
+        size += ENTRY_OVERHEAD
+        if not self.max_bytes or size > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations.get(series, 0) != generation:
+                # Rows were committed while the result was computed, it may already be stale
+                return
+            self._remove(key)
+            self._entries[key] = (value, size, series, low, high)
+            self._by_series.setdefault(series, set()).add(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        self.bytes -= item[1]
+        keys = self._by_series.get(item[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_series[item[2]]
+
+    def invalidate(self, series, timestamps=None):
+        """Drop entries of a series whose range contains any of the timestamps, or all of them when None"""
+        ordered = sorted(timestamps) if timestamps is not None else None
+
+        def stale(low, high):
+            if ordered is None:
+                return True
+            index = bisect_left(ordered, low)
+            return index < len(ordered) and ordered[index] <= high
+        self._drop(series, stale)
+
+    def invalidate_range(self, series, first, last):
+        """Drop entries of a series whose range overlaps [first, last], when only the span of the new timestamps is known"""
+        self._drop(series, lambda low, high: low <= last and first <= high)
+
+    def _drop(self, series, stale):
+        with self._lock:
+            self._generations[series] = self._generations.get(series, 0) + 1
+            for key in list(self._by_series.get(series, ())):
+                _, _, _, low, high = self._entries[key]
+                if stale(low, high):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for series in list(self._by_series):
+                self._generations[series] = self._generations.get(series, 0) + 1
+            self._entries.clear()
+            self._by_series.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,201 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from models import db, SensorReading, SensorRollup, SensorStats
+from metrics import Counter, Histogram
+
+# Pages handed back to the filesystem per incremental vacuum step
+VACUUM_STEP_PAGES = 512
+
+rows_pruned = Counter("retention_rows_pruned_total", "Expired rows deleted by the retention worker", ["table"])
+run_duration = Histogram("retention_run_duration_seconds", "Time taken by one retention run",
+                         buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+
+
+def _series():
+    """Every (device_id, metric) with stored data, read from the small stats table instead of the raw rows"""
+    return db.session.execute(db.select(SensorStats.device_id, SensorStats.metric)).all()
+
+
+def delete_expired_readings(device_id, metric, cutoff, batch_size):
+    """Delete up to batch_size raw readings older than cutoff for one series and commit
+
+    The device/metric/timestamp index bounds the scan, so each call is a short transaction.
+    """
+    expired = db.select(SensorReading.id).where(
+        SensorReading.device_id == device_id,
+        SensorReading.metric == metric,
+        SensorReading.timestamp < cutoff
+    ).limit(batch_size)
+    result = db.session.execute(db.delete(SensorReading).where(SensorReading.id.in_(expired)))
+    db.session.commit()
+    return result.rowcount
+
+
+def delete_expired_rollups(device_id, metric, resolution, cutoff, batch_size):
+    """Delete up to batch_size rollup buckets older than cutoff for one series and resolution and commit"""
+    expired = db.select(SensorRollup.id).where(
+        SensorRollup.device_id == device_id,
+        SensorRollup.metric == metric,
+        SensorRollup.resolution == resolution,
+        SensorRollup.bucket_start < cutoff
+    ).limit(batch_size)
+    result = db.session.execute(db.delete(SensorRollup).where(SensorRollup.id.in_(expired)))
+    db.session.commit()
+    return result.rowcount
+
+
+def auto_vacuum_mode():
+    """Return the SQLite auto_vacuum mode: 0 none, 1 full, 2 incremental"""
+    return db.session.execute(db.text("PRAGMA auto_vacuum")).scalar()
+
+
+def enable_incremental_vacuum():
+    """Switch an existing database to incremental auto-vacuum, which needs one full VACUUM"""
+    db.session.commit()
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+
+
+def incremental_vacuum(pages):
+    """Return up to pages free pages to the filesystem and report how many free pages remain"""
+    db.session.execute(db.text(f"PRAGMA incremental_vacuum({int(pages)})"))
+    db.session.commit()
+    return db.session.execute(db.text("PRAGMA freelist_count")).scalar()
+
+
+class RetentionWorker:
+    """Background thread that deletes expired raw readings and fine-grained rollups
+
+    Every delete is a small batch submitted to the ingest writer thread, so ingestion keeps
+    flushing between batches instead of waiting behind one long delete. Daily rollups are never
+    pruned: they keep the long-term history and are what the statistics are rebuilt from.
+    on_pruned(cutoff) is called after a run that deleted anything, with the Unix time raw readings
+    were deleted before, or None when only rollups were.
+    """
+
+    def __init__(self, ingest_queue, raw_days=0, rollup_days=None, interval=3600, batch_size=1000, on_pruned=None):
+        self.ingest_queue = ingest_queue
+        self.on_pruned = on_pruned
+        self.raw_days = raw_days
+        self.rollup_days = {resolution: days for resolution, days in (rollup_days or {}).items() if days}
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._sqlite = False
+        self._switch_vacuum_mode = False
+        self.runs = 0
+        self.total_pruned = 0
+        self.last_run = None
+
+    @property
+    def enabled(self):
+        return bool(self.raw_days or self.rollup_days)
+
+    def start(self, app):
+        if not self.enabled or self._thread:
+            return
+        with app.app_context():
+            self._sqlite = db.engine.dialect.name == "sqlite"
+            # Switched from the worker thread, so the full VACUUM it needs does not hold up startup
+            self._switch_vacuum_mode = self._sqlite and auto_vacuum_mode() != 2
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def trigger(self):
+        """Start a run now instead of waiting for the interval"""
+        self._wake.set()
+
+    def _run(self):
+        if self._switch_vacuum_mode:
+            print("Switching the database to incremental auto-vacuum, which runs one full VACUUM; ingestion waits until it finishes")
+            started = time.perf_counter()
+            try:
+                self.ingest_queue.submit(enable_incremental_vacuum).result()
+                print(f"Enabled incremental auto-vacuum in {time.perf_counter() - started:.1f} s")
+            except Exception as e:
+                print(f"Could not enable incremental auto-vacuum: {str(e)}")
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Retention run failed: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _prune(self, label, delete, *args):
+        pruned = 0
+        while not self._stopped.is_set():
+            count = self.ingest_queue.submit(delete, *args, self.batch_size).result()
+            pruned += count
+            if count < self.batch_size:
+                break
+        rows_pruned.labels(label).inc(pruned)
+        return pruned
+
+    def run_once(self):
+        """Prune everything past its retention period, then reclaim the freed pages"""
+        with self._run_lock:
+            started = time.perf_counter()
+            now = datetime.utcnow()
+            series = self.ingest_queue.submit(_series).result()
+
+            raw_pruned = 0
+            raw_cutoff = None
+            if self.raw_days:
+                cutoff = now - timedelta(days=self.raw_days)
+                for device_id, metric in series:
+                    raw_pruned += self._prune("sensor_readings", delete_expired_readings, device_id, metric, cutoff)
+                if raw_pruned:
+                    raw_cutoff = cutoff.replace(tzinfo=timezone.utc).timestamp()
+
+            rollups_pruned = 0
+            for resolution, days in self.rollup_days.items():
+                cutoff = now - timedelta(days=days)
+                for device_id, metric in series:
+                    rollups_pruned += self._prune("sensor_rollups", delete_expired_rollups,
+                                                  device_id, metric, resolution, cutoff)
+
+            if (raw_pruned or rollups_pruned) and self.on_pruned:
+                self.on_pruned(raw_cutoff)
+
+            pages_free = None
+            if (raw_pruned or rollups_pruned) and self._sqlite:
+                # One short step at a time, so flushes can run in between
+                pages_free = self.ingest_queue.submit(incremental_vacuum, VACUUM_STEP_PAGES).result()
+                while pages_free and not self._stopped.is_set():
+                    pages_free = self.ingest_queue.submit(incremental_vacuum, VACUUM_STEP_PAGES).result()
+
+            elapsed = time.perf_counter() - started
+            run_duration.observe(elapsed)
+            self.runs += 1
+            self.total_pruned += raw_pruned + rollups_pruned
+            self.last_run = {
+                "started": time.time() - elapsed,
+                "raw_rows_pruned": raw_pruned,
+                "rollups_pruned": rollups_pruned,
+                "free_pages": pages_free,
+                "duration_ms": elapsed * 1000
+            }
+            print(f"Retention run pruned {raw_pruned} raw rows and {rollups_pruned} rollups in {elapsed * 1000:.0f} ms")
+            return self.last_run
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "raw_days": self.raw_days,
+            "rollup_days": self.rollup_days,
+            "interval_seconds": self.interval,
+            "batch_size": self.batch_size,
+            "runs": self.runs,
+            "total_rows_pruned": self.total_pruned,
+            "last_run": self.last_run
+        }
@@ -0,0 +1,128 @@
+from datetime import datetime, timezone
+from models import db, SensorReading, SensorRollup
+
+# Supported rollup resolutions and their bucket width in seconds
+RESOLUTIONS = {
+    "1m": 60,
+    "1h": 3600,
+    "1d": 86400
+}
+
+
+def bucket_start(timestamp, resolution):
+    """Return the start of the bucket containing the given unix timestamp"""
+    width = RESOLUTIONS[resolution]
+    return timestamp - (timestamp % width)
+
+
+def _aggregate(samples, resolution):
+    """Aggregate (value, timestamp) samples into per-bucket partial rollups"""
+    buckets = {}
+    for value, timestamp in samples:
+        key = bucket_start(timestamp, resolution)
+        agg = buckets.get(key)
+        if agg is None:
+            buckets[key] = {
+                "count": 1, "sum": value, "min": value, "max": value,
+                "first": value, "first_timestamp": timestamp,
+                "last": value, "last_timestamp": timestamp
+            }
+            continue
+        agg["count"] += 1
+        agg["sum"] += value
+        agg["min"] = min(agg["min"], value)
+        agg["max"] = max(agg["max"], value)
+        if timestamp < agg["first_timestamp"]:
+            agg["first"], agg["first_timestamp"] = value, timestamp
+        if timestamp >= agg["last_timestamp"]:
+            agg["last"], agg["last_timestamp"] = value, timestamp
+    return buckets
+
+
+def update_rollups(device_id, metric, samples):
+    """Merge a batch of (value, timestamp) samples into the rollup table
+
+    Runs inside the ingest writer's transaction, so rollups and raw rows are committed together.
+    """
+    for resolution in RESOLUTIONS:
+        buckets = _aggregate(samples, resolution)
+        starts = {datetime.utcfromtimestamp(key): agg for key, agg in buckets.items()}
+
+        existing = SensorRollup.query.filter(
+            SensorRollup.device_id == device_id,
+            SensorRollup.metric == metric,
+            SensorRollup.resolution == resolution,
+            SensorRollup.bucket_start.in_(list(starts))
+        ).all()
+        existing = {rollup.bucket_start: rollup for rollup in existing}
+
+        for start, agg in starts.items():
+            first_timestamp = datetime.utcfromtimestamp(agg["first_timestamp"])
+            last_timestamp = datetime.utcfromtimestamp(agg["last_timestamp"])
+            rollup = existing.get(start)
+            if rollup is None:
+                db.session.add(SensorRollup(
+                    device_id=device_id,
+                    metric=metric,
+                    resolution=resolution,
+                    bucket_start=start,
+                    count=agg["count"],
+                    sum=agg["sum"],
+                    min=agg["min"],
+                    max=agg["max"],
+                    first=agg["first"],
+                    first_timestamp=first_timestamp,
+                    last=agg["last"],
+                    last_timestamp=last_timestamp
+                ))
+                continue
+
+            rollup.count += agg["count"]
+            rollup.sum += agg["sum"]
+            rollup.min = min(rollup.min, agg["min"])
+            rollup.max = max(rollup.max, agg["max"])
+            if first_timestamp < rollup.first_timestamp:
+                rollup.first, rollup.first_timestamp = agg["first"], first_timestamp
+            if last_timestamp >= rollup.last_timestamp:
+                rollup.last, rollup.last_timestamp = agg["last"], last_timestamp
+
+
+def rebuild_rollups(chunk_size=10000):
+    """Recompute every rollup bucket from the raw readings and commit them"""
+    SensorRollup.query.delete()
+
+    chunk = []
+    chunk_key = None
+    rows = db.session.execute(
+        db.select(SensorReading.device_id, SensorReading.metric, SensorReading.value, SensorReading.timestamp)
+        .order_by(SensorReading.device_id, SensorReading.metric, SensorReading.timestamp)
+        .execution_options(yield_per=chunk_size)
+    )
+    for device_id, metric, value, timestamp in rows:
+        if chunk and (len(chunk) >= chunk_size or chunk_key != (device_id, metric)):
+            update_rollups(*chunk_key, chunk)
+            db.session.flush()
+            chunk = []
+        chunk_key = (device_id, metric)
+        chunk.append((value, timestamp.replace(tzinfo=timezone.utc).timestamp()))
+
+    if chunk:
+        update_rollups(*chunk_key, chunk)
+    db.session.commit()
+
+
+def query_rollups(device_id, metric, resolution, start_time=None, end_time=None, limit=100):
+    """Return rollup buckets for a device and metric, newest first"""
+    query = SensorRollup.query.filter(
+        SensorRollup.device_id == device_id,
+        SensorRollup.metric == metric,
+        SensorRollup.resolution == resolution
+    )
+
+    if start_time:
+        query = query.filter(SensorRollup.bucket_start >= datetime.utcfromtimestamp(bucket_start(start_time, resolution)))
+
+    if end_time:
+        query = query.filter(SensorRollup.bucket_start <= datetime.utcfromtimestamp(end_time))
+
+    return query.order_by(SensorRollup.bucket_start.desc()).limit(limit).all()
@@ -1,36 +1,375 @@
+import os
 import time
-from datetime import datetime
-from flask import jsonify, current_app, request
+import json
+import math
+from functools import partial
+from contextlib import nullcontext
+import gzip
+import atexit
+import threading
+import hashlib
+from datetime import datetime, timezone
+from flask import jsonify, current_app, request, Response, stream_with_context, g
 import paho.mqtt.client as mqtt
 from . import mqtt_bp
-from models import db, TemperatureData, HumidityData
+from .ingest import IngestQueue
+from .rollups import RESOLUTIONS, bucket_start, update_rollups, query_rollups
+from .stats import update_stats, rebuild_stats, initialize_stats, get_stats
+from .migrations import migrate_schema
+from .retention import RetentionWorker
+from .commands import CommandScheduler, CommandTracker, split_command_id
+from .hotcache import HotCache
+from .resultcache import ResultCache
+from .analytics import StreamAnalytics, parse_rules
+from .telemetry import decode_telemetry, SequenceTracker
+from .checkpoint import StateCheckpoint
+from .sharedstate import SharedSegment, SharedStateStore, CommitLog, LEADER_OFFSET
+from .cluster import Cluster, startup_lock
+from .events import EventBus
+from .columnar import COLUMNAR_MIMETYPE, encode_columnar
+from .export import EXPORT_FORMATS, decode_cursor, iter_readings, format_rows
+from .registry import TopicRegistry
+from .state import LatestStateStore
+from models import db, SensorReading, SensorStats, DEFAULT_DEVICE_ID, SENSOR_METRICS, use_writer_session
+from metrics import Counter, Gauge, Histogram
+from profiling import observe_callback
 
-# Global variables to store the latest sensor data
-temperature_data = {"value": 0, "timestamp": 0}
-humidity_data = {"value": 0, "timestamp": 0}
-light_status = {"state": "off", "timestamp": 0}
-motion_status = {"direction": "center", "angle": 0, "timestamp": 0}
+# Process-wide MQTT connection state
 connection_status = {"connected": False, "last_message": 0}
 subscriptions = {"temperature": False, "humidity": False, "light": False, "motion": False}
 
+# Latest sensor and actuator state per device
+latest_state = LatestStateStore()
+
+# Topic pattern -> handler for incoming MQTT messages
+topic_registry = TopicRegistry()
+
 # MQTT client instance
 client = None
 
+# Set by the ASGI entry point to start the event loop driving a client created after startup, e.g. on a later election
+mqtt_loop_hook = None
+
+# Coalescing, rate-limited publisher for control commands
+command_scheduler = None
+
+# Control commands from the API call to the device's acknowledgement
+command_tracker = CommandTracker()
+
+# Which devices get the command id appended to their commands: on, off, or auto (those that announced acks)
+command_ids = "auto"
+
+# Write-behind queue for sensor rows
+ingest_queue = None
+
+# Background pruning of expired readings and rollups
+retention_worker = None
+
+# Live state changes pushed to /stream clients
+event_bus = EventBus()
+STREAM_TOPICS = ("temperature", "humidity", "light", "motion")
+
+# Latest values older than this are reported as stale
+STALE_AFTER_SECONDS = 300
+
+# Ring buffers holding the most recent committed samples per device and metric
+hot_cache = HotCache(capacity=0)
+
+# Rendered history and stats responses, invalidated by the samples committed into their window
+result_cache = ResultCache(max_bytes=0)
+STATS_SERIES = "stats"
+
+# Sliding-window aggregates, EWMA and threshold events over incoming sensor samples
+analytics = StreamAnalytics()
+
+# Sequence numbers of compact telemetry messages per device, to spot lost and redelivered samples
+sequence_tracker = SequenceTracker()
+
+# Device clocks further than this from the receive time are not trusted (0 always trusts them)
+telemetry_max_skew = 300
+
+# Latest state saved to disk, so a restarted process answers with it straight away; None when disabled
+state_checkpoint = None
+
+# Seconds spent in each startup phase of this process, and from the start until the first latest-state request answered with 200
+startup_timing = {"started_at": None, "ready_seconds": None, "phases": {}, "first_state_response_seconds": None}
+STATE_ENDPOINTS = ("mqtt.get_temperature", "mqtt.get_humidity", "mqtt.get_light_status", "mqtt.get_motion_status",
+                   "mqtt.get_snapshot", "mqtt.get_devices")
+
+# Worker coordination when several processes serve the API (CLUSTER_DIR); None in a single process
+cluster = None
+shared_segment = None
+commit_log = None
+
+# Operations only the leader worker can run, by name; each returns (payload, status)
+leader_ops = {}
+
+# Prometheus metrics for the ingest and request hot paths
+messages_received = Counter("mqtt_messages_received_total", "MQTT messages received per topic pattern", ["topic"])
+parse_failures = Counter("mqtt_parse_failures_total", "MQTT messages whose payload could not be parsed", ["topic"])
+handler_latency = Histogram("mqtt_on_message_duration_seconds", "Time spent in on_message")
+request_latency = Histogram("http_request_duration_seconds", "Request latency per endpoint", ["endpoint", "method", "status"])
+backfilled_readings = Counter("mqtt_backfilled_readings_total", "Spooled historical readings received from devices")
+mqtt_connects = Counter("mqtt_connects_total", "Successful connections to the MQTT broker, including reconnects")
+mqtt_disconnects = Counter("mqtt_disconnects_total", "Disconnections from the MQTT broker")
+Gauge("mqtt_connected", "Whether the MQTT client is connected", function=lambda: connection_status["connected"])
+Gauge("mqtt_last_message_age_seconds", "Seconds since the last valid MQTT message",
+      function=lambda: time.time() - connection_status["last_message"] if connection_status["last_message"] else float("nan"))
+Gauge("ingest_queue_depth", "Sensor rows waiting to be written", function=lambda: ingest_queue.stats()["depth"])
+Counter("ingest_rows_dropped_total", "Sensor rows dropped by the overflow policy", function=lambda: ingest_queue.dropped)
+Counter("hot_cache_hits_total", "History requests answered from the hot cache", function=lambda: hot_cache.hits)
+Counter("hot_cache_misses_total", "History requests that went to the database", function=lambda: hot_cache.misses)
+Gauge("stream_subscribers", "Open /stream connections", function=lambda: event_bus.stats()["subscribers"])
+Counter("result_cache_hits_total", "History and stats requests answered from the result cache", function=lambda: result_cache.hits)
+Counter("result_cache_misses_total", "History and stats requests that had to be computed", function=lambda: result_cache.misses)
+Counter("result_cache_invalidations_total", "Result cache entries dropped by newly committed samples", function=lambda: result_cache.invalidations)
+Gauge("result_cache_bytes", "Memory held by the result cache", function=lambda: result_cache.bytes)
+Gauge("startup_duration_seconds", "Seconds from the start of create_app until the app was ready", function=lambda: startup_timing["ready_seconds"] or float("nan"))
+Gauge("startup_first_state_response_seconds", "Seconds from the start of create_app until the first latest-state request answered with 200",
+      function=lambda: startup_timing["first_state_response_seconds"] or float("nan"))
+telemetry_samples = Counter("telemetry_samples_total", "Samples stored from compact telemetry messages")
+telemetry_clock_corrections = Counter("telemetry_clock_corrections_total", "Telemetry messages whose device timestamps were shifted to the receive time")
+Counter("telemetry_sequence_gaps_total", "Telemetry samples missing from the device sequence numbers", function=lambda: sequence_tracker.gaps)
+Counter("telemetry_duplicate_samples_total", "Redelivered telemetry samples that were skipped", function=lambda: sequence_tracker.duplicates)
+
+def state_payload(topic, record):
+    """Format a latest-state record like the matching GET endpoint"""
+    if topic in ("temperature", "humidity"):
+        return {topic: record["value"], "timestamp": record["timestamp"]}
+    if topic == "light":
+        return {"state": record["state"], "timestamp": record["timestamp"]}
+    return {"direction": record["direction"], "angle": record["angle"], "timestamp": record["timestamp"]}
+
+def publish_state_change(device_id, topic, record):
+    """Push every latest-state update to the stream subscribers"""
+    event_bus.publish(topic, dict(state_payload(topic, record), device_id=device_id), device_id)
+
+latest_state.add_listener(publish_state_change)
+
+def control_topic(kind, device_id):
+    """Topic a control command for a device is published on"""
+    return kind if device_id == DEFAULT_DEVICE_ID else f"devices/{device_id}/{kind}"
+
+def publish_command(device_id, kind, payload, command_id):
+    """Publish a control command once the scheduler releases it, tagged with its id for devices that acknowledge"""
+    traced = command_ids == "on" or (command_ids == "auto" and device_id in command_tracker.acking_devices)
+    if traced:
+        payload = f"{payload} #{command_id}"
+    # Marked before publishing, so even an immediate acknowledgement finds it published
+    command_tracker.published(command_id, traced)
+    try:
+        published = client.publish(control_topic(kind, device_id), payload).rc == mqtt.MQTT_ERR_SUCCESS
+    except Exception:
+        command_tracker.dropped(command_id)
+        raise
+    if not published:
+        command_tracker.dropped(command_id)
+    return published
+
+def leader_op(function):
+    """Register a function as an operation follower workers forward to the leader"""
+    leader_ops[function.__name__] = function
+    return function
+
+def run_on_leader(op, **args):
+    """Run a leader operation here when this process is the leader or the only worker, otherwise on the leader"""
+    if cluster is None or cluster.is_leader:
+        return leader_ops[op](**args)
+    try:
+        return cluster.call(op, args)
+    except OSError as e:
+        return {"error": f"Leader worker is not reachable: {str(e)}"}, 503
+
+def publish_analytics(topic, payload, qos):
+    """Publish a retained analytics summary or threshold event while connected to the broker"""
+    if client is not None and connection_status["connected"]:
+        client.publish(topic, json.dumps(payload), qos=qos, retain=True)
+
+def handle_sensor(metric, device_id, payload, received_at):
+    """Store a plain numeric sensor reading"""
+    try:
+        value = float(payload)
+        if not math.isfinite(value):
+            raise ValueError(f"{value} is not a finite number")
+    except ValueError:
+        print(f"Received invalid {metric} data from {device_id}: {payload}")
+        return False
+    
+    latest_state.update(device_id, metric, value=value, timestamp=received_at)
+    subscriptions[metric] = True
+    connection_status["last_message"] = received_at
+    analytics.add(device_id, metric, value, received_at)
+    
+    # Queue for the database writer
+    ingest_queue.put(device_id, metric, value, received_at)
+
+def handle_backfill(device_id, payload, received_at):
+    """Bulk-store readings a device spooled while it was offline
+    
+    The readings keep their device-side timestamps and are only written to history;
+    the latest state is left alone, since it already holds newer values.
+    """
+    try:
+        readings = json.loads(payload)["readings"]
+        rows = []
+        for reading in readings:
+            metric = reading["metric"]
+            value = float(reading["value"])
+            timestamp = float(reading["timestamp"])
+            if metric not in SENSOR_METRICS or not math.isfinite(value) or not math.isfinite(timestamp):
+                raise ValueError(f"invalid reading {reading}")
+            rows.append((device_id, metric, value, timestamp))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Received invalid backfill batch from {device_id}: {str(e)}")
+        return False
+    
+    connection_status["last_message"] = received_at
+    accepted = ingest_queue.put_many(rows)
+    backfilled_readings.inc(accepted)
+    print(f"Queued {accepted} backfilled readings from {device_id}")
+
+def handle_telemetry(device_id, payload, received_at, named_by_payload=False):
+    """Store a compact batch of samples with the device's own sequence numbers and timestamps
+    
+    On the shared sensors/telemetry topic the message names its device; on a per-device topic
+    the name must match. Samples of metrics the backend does not know are ignored.
+    """
+    try:
+        named, boot, sequence, timestamps, metrics = decode_telemetry(payload)
+        if named is not None and named != device_id:
+            if not named_by_payload:
+                raise ValueError(f"message from {named} on the topic of another device")
+            device_id = named
+    except ValueError as e:
+        print(f"Received invalid telemetry from {device_id}: {str(e)}")
+        return False
+    
+    connection_status["last_message"] = received_at
+    skip = sequence_tracker.accept(device_id, boot, sequence, len(timestamps))
+    if skip == len(timestamps):
+        return
+    
+    offset = 0.0
+    if telemetry_max_skew and abs(timestamps[-1] - received_at) > telemetry_max_skew:
+        # No usable clock yet (no RTC, NTP not synced): keep the spacing, anchor the newest sample at the receive time
+        offset = received_at - timestamps[-1]
+        telemetry_clock_corrections.inc()
+    
+    rows = []
+    for metric, values in metrics.items():
+        if metric not in SENSOR_METRICS:
+            continue
+        newest = None
+        for timestamp, value in zip(timestamps[skip:], values[skip:]):
+            if value is None:
+                continue
+            timestamp += offset
+            rows.append((device_id, metric, value, timestamp))
+            analytics.add(device_id, metric, value, timestamp)
+            newest = (value, timestamp)
+        if newest is not None:
+            latest_state.update(device_id, metric, value=newest[0], timestamp=newest[1])
+            subscriptions[metric] = True
+    
+    # One bulk append for the whole batch
+    telemetry_samples.inc(ingest_queue.put_many(rows))
+
+def handle_light(device_id, payload, received_at):
+    """Track light control messages"""
+    payload_lower = split_command_id(payload.strip())[0].strip().lower()
+    if payload_lower in ["on", "off"]:
+        latest_state.update(device_id, "light", state=payload_lower, timestamp=received_at)
+        subscriptions["light"] = True
+        connection_status["last_message"] = received_at
+        print(f"Received light control command for {device_id}: {payload}")
+    else:
+        print(f"Received invalid light command: {payload}")
+        return False
+
+def handle_motion(device_id, payload, received_at):
+    """Track motion control messages"""
+    payload_lower = split_command_id(payload.strip())[0].strip().lower()
+    try:
+        parts = payload_lower.split()
+        if len(parts) >= 2 and parts[0] in ["left", "right"]:
+            direction = parts[0]
+            angle = int(parts[1])
+            if 0 <= angle <= 90:
+                latest_state.update(device_id, "motion", direction=direction, angle=angle, timestamp=received_at)
+                subscriptions["motion"] = True
+                connection_status["last_message"] = received_at
+                print(f"Received motion control command for {device_id}: {direction} {angle}")
+            else:
+                print(f"Received invalid motion angle (must be 0-90): {angle}")
+                return False
+        else:
+            print(f"Received invalid motion format: {payload}")
+            return False
+    except (ValueError, IndexError) as e:
+        print(f"Error parsing motion command '{payload}': {str(e)}")
+        return False
+
+def handle_ack(device_id, payload, received_at):
+    """Match a device's actuation acknowledgement to its command, or note that the device acknowledges commands"""
+    try:
+        ack = json.loads(payload)
+        if ack.get("ready"):
+            # Retained announcement, so a restarted backend learns it on subscribing
+            command_tracker.acking_devices.add(device_id)
+            return
+        ack = {
+            "command_id": int(ack["command_id"]),
+            "received_at": float(ack["received_at"]),
+            "actuated_at": float(ack["actuated_at"]),
+            "sent_at": float(ack["sent_at"])
+        }
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Received invalid acknowledgement from {device_id}: {str(e)}")
+        return False
+    
+    # Acknowledgements show the device handles ids even if its announcement was missed
+    command_tracker.acking_devices.add(device_id)
+    connection_status["last_message"] = received_at
+    record = command_tracker.acknowledged(device_id, ack, received_at)
+    if record is not None:
+        print(f"Command {record['command_id']} ({record['kind']} {record['payload']}) actuated on {device_id} "
+              f"{record['latency_ms']['api_to_actuated']:.1f} ms after the API call")
+
+# The original single-device topics belong to the default device, the wildcard ones carry the device id
+for metric in SENSOR_METRICS:
+    topic_registry.register(f"sensors/{metric}", partial(handle_sensor, metric))
+    topic_registry.register(f"sensors/+/{metric}", partial(handle_sensor, metric))
+topic_registry.register("sensors/backfill", handle_backfill)
+topic_registry.register("sensors/+/backfill", handle_backfill)
+topic_registry.register("sensors/telemetry", partial(handle_telemetry, named_by_payload=True))
+topic_registry.register("sensors/+/telemetry", handle_telemetry)
+topic_registry.register("light", handle_light)
+topic_registry.register("devices/+/light", handle_light)
+topic_registry.register("motion", handle_motion)
+topic_registry.register("devices/+/motion", handle_motion)
+topic_registry.register("ack", handle_ack)
+topic_registry.register("devices/+/ack", handle_ack)
+
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the MQTT broker"""
     if rc == 0:
         print("Connected to MQTT broker")
         connection_status["connected"] = True
-        # Subscribe to temperature, humidity, light, and motion topics
-        client.subscribe("sensors/temperature")
-        client.subscribe("sensors/humidity")
-        client.subscribe("light")
-        client.subscribe("motion")
-        print("Subscribed to sensors/temperature, sensors/humidity, light, and motion topics")
+        mqtt_connects.inc()
+        # Subscribe to every registered topic pattern
+        patterns = topic_registry.patterns()
+        client.subscribe([(pattern, 0) for pattern in patterns])
+        print(f"Subscribed to {', '.join(patterns)}")
     else:
         print(f"Failed to connect to MQTT broker with code {rc}")
         connection_status["connected"] = False
 
+def on_disconnect(client, userdata, rc):
+    """Callback for when the client disconnects from the MQTT broker"""
+    connection_status["connected"] = False
+    mqtt_disconnects.inc()
+    print(f"Disconnected from MQTT broker with code {rc}")
+
 def on_subscribe(client, userdata, mid, granted_qos):
     """Callback for when the client successfully subscribes to a topic"""
     print(f"Successfully subscribed with message ID: {mid}")
@@ -38,95 +377,296 @@ def on_subscribe(client, userdata, mid, granted_qos):
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received from the MQTT broker"""
+    started = time.perf_counter()
     topic = msg.topic
     payload = msg.payload.decode("utf-8")
-    current_time = time.time()
     
-    if topic == "light":
-        # Handle light control messages
-        payload_lower = payload.strip().lower()
-        if payload_lower in ["on", "off"]:
-            light_status["state"] = payload_lower
-            light_status["timestamp"] = current_time
-            subscriptions["light"] = True
-            connection_status["last_message"] = current_time
-            print(f"Received light control command: {payload}")
-        else:
-            print(f"Received invalid light command: {payload}")
-        return
+    handler, device_id, pattern = topic_registry.resolve(topic)
+    if handler is None:
+        messages_received.labels("unhandled").inc()
+        print(f"Received message on unhandled topic {topic}: {payload}")
+    else:
+        messages_received.labels(pattern).inc()
+        if handler(device_id, payload, time.time()) is False:
+            parse_failures.labels(pattern).inc()
     
-    if topic == "motion":
-        # Handle motion control messages
-        payload_lower = payload.strip().lower()
-        try:
-            parts = payload_lower.split()
-            if len(parts) >= 2 and parts[0] in ["left", "right"]:
-                direction = parts[0]
-                angle = int(parts[1])
-                if 0 <= angle <= 90:
-                    motion_status["direction"] = direction
-                    motion_status["angle"] = angle
-                    motion_status["timestamp"] = current_time
-                    subscriptions["motion"] = True
-                    connection_status["last_message"] = current_time
-                    print(f"Received motion control command: {direction} {angle}")
-                else:
-                    print(f"Received invalid motion angle (must be 0-90): {angle}")
-            else:
-                print(f"Received invalid motion format: {payload}")
-        except (ValueError, IndexError) as e:
-            print(f"Error parsing motion command '{payload}': {str(e)}")
-        return
+    elapsed = time.perf_counter() - started
+    handler_latency.observe(elapsed)
+    observe_callback(topic, elapsed)
+
+def invalidate_results(device_id, metric, samples):
+    """Drop cached results whose window the committed (id, value, timestamp) samples fall in"""
+    timestamps = [timestamp for _, _, timestamp in samples]
+    result_cache.invalidate((device_id, metric), timestamps)
+    result_cache.invalidate(STATS_SERIES)
+    if commit_log is not None:
+        # Follower workers replay this to invalidate their own caches
+        commit_log.append(device_id, metric, min(timestamps), max(timestamps))
+
+def clear_results():
+    """Drop every cached result, in every worker"""
+    result_cache.clear()
+    if commit_log is not None:
+        commit_log.append()
+
+def clear_pruned(cutoff):
+    """Drop what a retention run deleted: raw samples before cutoff from the hot cache, and every cached result"""
+    if cutoff is not None:
+        hot_cache.trim(cutoff)
+    clear_results()
+
+def initialize_analytics(app):
+    """Configure the streaming analytics windows and threshold rules"""
+    global analytics
+    
+    analytics = StreamAnalytics(
+        windows=[float(seconds) for seconds in app.config['ANALYTICS_WINDOWS'].split(',') if seconds.strip()],
+        ewma_seconds=app.config['ANALYTICS_EWMA_SECONDS'],
+        rules=parse_rules(app.config['ANALYTICS_RULES']),
+        max_series=app.config['ANALYTICS_MAX_SERIES'],
+        publish=publish_analytics,
+        publish_interval=app.config['ANALYTICS_PUBLISH_INTERVAL_SECONDS'],
+        topic_prefix=app.config['ANALYTICS_TOPIC_PREFIX']
+    )
+    print(f"Streaming analytics over {', '.join(f'{seconds:g}s' for seconds in analytics.window_seconds)} windows with {len(analytics.rules)} threshold rules")
+
+def initialize_ingest_queue(app):
+    """Initialize the write-behind queue and start its database writer"""
+    global ingest_queue, hot_cache, result_cache, retention_worker, telemetry_max_skew
+    
+    telemetry_max_skew = app.config['TELEMETRY_MAX_CLOCK_SKEW_SECONDS']
+    # Only the process that commits ingested rows can keep a hot cache current, see build_hot_cache
+    hot_cache = HotCache(capacity=0)
+    result_cache = ResultCache(max_bytes=app.config['RESULT_CACHE_MAX_BYTES'])
+    
+    ingest_queue = IngestQueue(
+        max_size=app.config['INGEST_QUEUE_SIZE'],
+        batch_size=app.config['INGEST_BATCH_SIZE'],
+        flush_interval_ms=app.config['INGEST_FLUSH_INTERVAL_MS'],
+        overflow_policy=app.config['INGEST_OVERFLOW_POLICY']
+    )
+    # Keep the 1m/1h/1d rollups and running statistics in step with every flushed batch
+    ingest_queue.add_flush_hook(update_rollups)
+    ingest_queue.add_flush_hook(update_stats)
+    # Committed rows (with their ids) feed the hot cache and invalidate the cached results they change
+    ingest_queue.add_commit_hook(cache_samples)
+    ingest_queue.add_commit_hook(invalidate_results)
+    
+    # Workers sharing a CLUSTER_DIR take turns, so a legacy database is migrated by the first one only
+    directory = app.config['CLUSTER_DIR']
+    with app.app_context(), (startup_lock(directory) if directory else nullcontext(True)) as first:
+        # The writer thread is not running yet, so the schema changes can use the writer connection here
+        use_writer_session()
+        migrated = migrate_schema()
+        initialize_stats(rebuild=migrated or (first and app.config['STATS_REBUILD_ON_STARTUP']))
+    
+    ingest_queue.start(app)
+    # Flush whatever is still queued when the process exits
+    atexit.register(ingest_queue.stop)
+    print(f"Ingest queue started (batch size {ingest_queue.batch_size}, flush interval {app.config['INGEST_FLUSH_INTERVAL_MS']} ms)")
+    if not app.config['CLUSTER_DIR']:
+        build_hot_cache(app)
     
+    retention_worker = RetentionWorker(
+        ingest_queue,
+        raw_days=app.config['RETENTION_RAW_DAYS'],
+        rollup_days={"1m": app.config['RETENTION_MINUTE_ROLLUP_DAYS'], "1h": app.config['RETENTION_HOURLY_ROLLUP_DAYS']},
+        interval=app.config['RETENTION_INTERVAL_SECONDS'],
+        batch_size=app.config['RETENTION_BATCH_SIZE'],
+        # Pruned rows can be part of any cached window
+        on_pruned=clear_pruned
+    )
+    if not app.config['CLUSTER_DIR']:
+        start_retention_worker(app)
+
+def cache_samples(device_id, metric, samples):
+    """Append committed samples to the current hot cache, which a newly elected leader replaces"""
+    hot_cache.add(device_id, metric, samples)
+
+def build_hot_cache(app):
+    """Start this process's hot cache and preload it; runs in the single process, or when a worker becomes the leader
+    
+    Followers never commit rows, so a cache of theirs would go stale; they keep an empty one and read from the database.
+    """
+    global hot_cache
+    
+    hot_cache = HotCache(
+        capacity=app.config['HOT_CACHE_SIZE'],
+        max_series=app.config['HOT_CACHE_MAX_SERIES']
+    )
+    # On the writer thread, between batches, so the preloaded rings cannot miss a sample committed meanwhile
+    started = time.perf_counter()
+    preloaded = ingest_queue.submit(preload_hot_cache, min(app.config['HOT_CACHE_PRELOAD'], hot_cache.capacity)).result()
+    startup_timing["phases"]["preload_hot_cache"] = time.perf_counter() - started
+    if preloaded:
+        print(f"Preloaded {preloaded} recent samples into the hot cache in {startup_timing['phases']['preload_hot_cache'] * 1000:.0f} ms")
+
+def preload_hot_cache(limit):
+    """Fill the hot cache with the newest stored samples of the most recently active series and return how many"""
+    if limit <= 0:
+        return 0
+    series = SensorStats.query.order_by(SensorStats.last_timestamp.desc()).limit(hot_cache.max_series).all()
+    preloaded = 0
+    # Oldest first, so the most recently active series end up least likely to be evicted
+    for stats in reversed(series):
+        rows = db.session.execute(
+            db.select(SensorReading.id, SensorReading.value, SensorReading.timestamp)
+            .where(SensorReading.device_id == stats.device_id, SensorReading.metric == stats.metric)
+            .order_by(SensorReading.timestamp.desc())
+            .limit(limit)
+        ).all()
+        if len(rows) == limit:
+            # Rows sharing the oldest timestamp may have been cut off by the limit, so the ring must not vouch for it
+            rows = [row for row in rows if row[2] != rows[-1][2]]
+        if rows:
+            hot_cache.add(stats.device_id, stats.metric, [
+                (sample_id, value, timestamp.replace(tzinfo=timezone.utc).timestamp())
+                for sample_id, value, timestamp in reversed(rows)
+            ])
+            preloaded += len(rows)
+    return preloaded
+
+def restore_state(app):
+    """Restore the latest state checkpoint and keep it up to date; only the process that ingests from MQTT does this"""
+    global state_checkpoint
+    
+    path = app.config['STATE_CHECKPOINT_PATH']
+    if not path:
+        return
+    state_checkpoint = StateCheckpoint(path, latest_state, interval=app.config['STATE_CHECKPOINT_INTERVAL_SECONDS'])
+    started = time.perf_counter()
     try:
-        value = float(payload)
-        if topic == "sensors/temperature":
-            temperature_data["value"] = value
-            temperature_data["timestamp"] = current_time
-            subscriptions["temperature"] = True
-            
-            # Store in database
-            try:
-                new_temp = TemperatureData(value=value, timestamp=datetime.utcfromtimestamp(current_time))
-                db.session.add(new_temp)
-                db.session.commit()
-                print(f"Temperature data stored in database: {value}°C")
-            except Exception as e:
-                print(f"Error storing temperature data: {str(e)}")
-                db.session.rollback()
-                
-        elif topic == "sensors/humidity":
-            humidity_data["value"] = value
-            humidity_data["timestamp"] = current_time
-            subscriptions["humidity"] = True
-            
-            # Store in database
-            try:
-                new_humidity = HumidityData(value=value, timestamp=datetime.utcfromtimestamp(current_time))
-                db.session.add(new_humidity)
-                db.session.commit()
-                print(f"Humidity data stored in database: {value}%")
-            except Exception as e:
-                print(f"Error storing humidity data: {str(e)}")
-                db.session.rollback()
+        restored = state_checkpoint.restore()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Could not restore the state checkpoint {path}: {str(e)}")
+        restored = 0
+    startup_timing["phases"]["restore_state"] = time.perf_counter() - started
+    if restored:
+        print(f"Restored {restored} latest-state records from {path} in {startup_timing['phases']['restore_state'] * 1000:.1f} ms")
+    
+    state_checkpoint.start()
+    # Save the final state when the process exits
+    atexit.register(state_checkpoint.stop)
+
+def begin_startup():
+    """Start timing this process's startup"""
+    startup_timing["started_at"] = time.time()
+
+def finish_startup():
+    """Record how long startup took, once every initialize_* step has run"""
+    startup_timing["ready_seconds"] = time.time() - startup_timing["started_at"]
+    phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in startup_timing["phases"].items())
+    print(f"Started in {startup_timing['ready_seconds'] * 1000:.0f} ms ({phases})")
+
+def start_retention_worker(app):
+    """Start pruning expired data; with several workers only the leader does this"""
+    retention_worker.start(app)
+    atexit.register(retention_worker.stop)
+    if retention_worker.enabled:
+        print(f"Retention worker started (raw readings kept {app.config['RETENTION_RAW_DAYS']:g} days)")
+
+def become_leader(app):
+    """Start what exactly one worker runs: shared state writes, the hot cache, the MQTT client and the retention worker"""
+    repaired = latest_state.recover()
+    if repaired:
+        print(f"Repaired {repaired} shared state slots left mid-write by the previous leader")
+    latest_state.writable = True
+    shared_segment.write_u64(LEADER_OFFSET, os.getpid())
+    restore_state(app)
+    build_hot_cache(app)
+    start_retention_worker(app)
+    if app.config['MQTT_ENABLED']:
+        with app.app_context():
+            initialize_mqtt_client(app)
+
+def follow_leader(poll_interval):
+    """On a follower, replay the leader's state updates to the local listeners and its commits to the result cache"""
+    seen_version = latest_state.version
+    log_head = commit_log.head
+    while not cluster.is_leader:
+        time.sleep(poll_interval)
+        try:
+            head, entries = commit_log.read(log_head)
+            if entries is None:
+                # Fell too far behind to know what changed
+                result_cache.clear()
+            for device_id, metric, first, last in entries or ():
+                if device_id is None:
+                    result_cache.clear()
+                    continue
+                result_cache.invalidate_range((device_id, metric), first, last)
+                result_cache.invalidate(STATS_SERIES)
+            log_head = head
             
-        connection_status["last_message"] = current_time
-        print(f"Received message on topic {topic}: {payload}")
-    except ValueError:
-        print(f"Received invalid data on topic {topic}: {payload}")
+            version = latest_state.version
+            if version == seen_version:
+                continue
+            for index in latest_state.used_slots():
+                if latest_state.slot_version(index) <= seen_version:
+                    continue
+                slot = latest_state.read_slot(index)
+                if slot is not None and slot[2] is not None and slot[1] > seen_version:
+                    device_id, kind = slot[0].decode("utf-8").split("\0", 1)
+                    version = max(version, slot[1])
+                    latest_state.notify(device_id, kind, slot[2])
+            seen_version = version
+        except Exception as e:
+            print(f"Error following the leader worker: {str(e)}")
+
+def initialize_cluster(app):
+    """Share the latest state with the other workers and elect the one that ingests from MQTT"""
+    global cluster, shared_segment, commit_log, latest_state
+    
+    directory = app.config['CLUSTER_DIR']
+    os.makedirs(directory, exist_ok=True)
+    shared_segment = SharedSegment(os.path.join(directory, "state.shm"), slots=app.config['CLUSTER_STATE_SLOTS'])
+    commit_log = CommitLog(shared_segment)
+    latest_state = SharedStateStore(shared_segment)
+    latest_state.add_listener(publish_state_change)
+    
+    # A forwarded POST may wait for a device acknowledgement on the leader
+    cluster = Cluster(directory, leader_ops, on_elected=partial(become_leader, app), app=app,
+                      timeout=app.config['COMMAND_ACK_MAX_WAIT_SECONDS'] + 5)
+    cluster.start()
+    if not cluster.is_leader:
+        print(f"Worker {os.getpid()} is a follower, the leader ingests from MQTT")
+        threading.Thread(
+            target=follow_leader,
+            args=(app.config['CLUSTER_POLL_MS'] / 1000.0,),
+            name="leader-follower",
+            daemon=True
+        ).start()
 
 def initialize_mqtt_client(app):
     """Initialize the MQTT client with the broker settings"""
-    global client
+    global client, command_scheduler, command_ids
     
-    broker_address = "localhost"
-    broker_port = 8080  # WebSocket port as per your configuration
+    command_ids = app.config['COMMAND_IDS']
+    broker_address = app.config['BROKER_ADDRESS']
+    broker_port = app.config['BROKER_PORT']
     
-    client = mqtt.Client(transport="websockets")
+    client = mqtt.Client(transport="websockets" if app.config['USE_WEBSOCKETS'] else "tcp")
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_disconnect = on_disconnect
     client.on_subscribe = on_subscribe
     
+    command_scheduler = CommandScheduler(
+        publish_command,
+        window_ms=app.config['COMMAND_WINDOW_MS'],
+        max_rate=app.config['COMMAND_MAX_RATE'],
+        on_submitted=command_tracker.queued
+    )
+    command_scheduler.start()
+    atexit.register(command_scheduler.stop)
+    
+    if app.config['MQTT_LOOP'] != 'thread':
+        # The ASGI entry point drives the client from its event loop
+        if mqtt_loop_hook is not None:
+            mqtt_loop_hook(client)
+        print(f"MQTT client initialized, waiting for the event loop to connect to {broker_address}:{broker_port}")
+        return
+    
     # Connect to the MQTT broker
     try:
         client.connect(broker_address, broker_port, 60)
@@ -136,147 +676,416 @@ def initialize_mqtt_client(app):
     except Exception as e:
         print(f"Failed to initialize MQTT client: {str(e)}")
         
-@mqtt_bp.route('/temperature', methods=['GET'])
-def get_temperature():
-    """Endpoint to get the latest temperature data"""
-    if time.time() - temperature_data["timestamp"] > 300:  # Data older than 5 minutes
-        return jsonify({"error": "Temperature data is stale or not available"}), 404
+@mqtt_bp.before_request
+def start_request_timer():
+    """Record when the request started, for the latency histogram"""
+    g.request_started = time.perf_counter()
+
+@mqtt_bp.after_request
+def observe_request_latency(response):
+    """Record the request latency per endpoint"""
+    request_latency.labels(request.endpoint, request.method, str(response.status_code)).observe(
+        time.perf_counter() - g.request_started)
+    if startup_timing["first_state_response_seconds"] is None and response.status_code == 200 and request.endpoint in STATE_ENDPOINTS:
+        startup_timing["first_state_response_seconds"] = time.time() - startup_timing["started_at"]
+    return response
+
+def render_history(response):
+    """Freeze a history response into a cacheable entry: body, mimetype, ETag and the gzipped body when large enough"""
+    body = response.get_data()
+    compressed = None
+    if len(body) >= current_app.config['HISTORY_GZIP_MIN_BYTES']:
+        compressed = gzip.compress(body, compresslevel=5)
+    return {
+        "body": body,
+        "mimetype": response.mimetype,
+        "etag": hashlib.md5(body).hexdigest(),
+        "gzip": compressed
+    }
+
+def history_response(entry):
+    """Build a history response from a rendered entry with an ETag and optional gzip encoding, answering 304 when the window is unchanged"""
+    compress = entry["gzip"] is not None and request.accept_encodings['gzip'] > 0
+    
+    response = Response(entry["body"], mimetype=entry["mimetype"])
+    response.set_etag(entry["etag"] + ("-gzip" if compress else ""))
+    response.vary.update(("Accept", "Accept-Encoding"))
+    response = response.make_conditional(request)
+    
+    if compress and response.status_code == 200:
+        response.set_data(entry["gzip"])
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+def wants_columnar():
+    """Whether the client asked for the columnar binary history format"""
+    if request.args.get('format') == 'columnar':
+        return True
+    return request.accept_mimetypes.best_match(["application/json", COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE
+
+def query_history(device_id, metric, resolution, start_time, end_time, limit, columnar):
+    """Build a history response from the rollup table, the hot cache or sensor_readings
+
+    Returns the response with the number of rows and the timestamp of the oldest one.
+    """
+    # Serve pre-aggregated buckets when a resolution is requested
+    if resolution is not None:
+        rollups = query_rollups(device_id, metric, resolution, start_time, end_time, limit)
+        data = [rollup.to_dict() for rollup in rollups]
+        oldest = rollups[-1].bucket_start.replace(tzinfo=timezone.utc).timestamp() if rollups else None
+        
+        return jsonify({
+            "count": len(data),
+            "resolution": resolution,
+            "data": data
+        }), len(data), oldest
+    
+    # Serve recent windows straight from the ring buffer when it holds all of them
+    cached = hot_cache.query(device_id, metric, start_time, end_time, limit)
+    if cached is not None:
+        oldest = cached[-1][1] if cached else None
+        if columnar:
+            payload = encode_columnar((row[1] for row in cached), (row[2] for row in cached))
+            return Response(payload, mimetype=COLUMNAR_MIMETYPE), len(cached), oldest
+        
+        data = [
+            {"id": sample_id, "value": value, "timestamp": timestamp}
+            for sample_id, timestamp, value in cached
+        ]
+        return jsonify({
+            "count": len(data),
+            "data": data
+        }), len(data), oldest
+    
+    # Build the query; the composite index covers device, metric and timestamp
+    query = SensorReading.query.filter(
+        SensorReading.device_id == device_id,
+        SensorReading.metric == metric
+    )
+    
+    # Apply time filters if provided
+    if start_time:
+        start_datetime = datetime.utcfromtimestamp(start_time)
+        query = query.filter(SensorReading.timestamp >= start_datetime)
+        
+    if end_time:
+        end_datetime = datetime.utcfromtimestamp(end_time)
+        query = query.filter(SensorReading.timestamp <= end_datetime)
+    
+    # Order by timestamp descending and limit results
+    query = query.order_by(SensorReading.timestamp.desc()).limit(limit)
+    
+    if columnar:
+        # Plain tuples straight into the packed columns, no ORM objects or dicts
+        rows = db.session.execute(
+            db.select(SensorReading.timestamp, SensorReading.value)
+            .where(query.whereclause)
+            .order_by(SensorReading.timestamp.desc())
+            .limit(limit)
+        ).all()
+        payload = encode_columnar((row[0].replace(tzinfo=timezone.utc).timestamp() for row in rows), (row[1] for row in rows))
+        oldest = rows[-1][0].replace(tzinfo=timezone.utc).timestamp() if rows else None
+        return Response(payload, mimetype=COLUMNAR_MIMETYPE), len(rows), oldest
+    
+    # Convert to list of dictionaries
+    records = query.all()
+    data = [record.to_dict() for record in records]
+    oldest = records[-1].timestamp.replace(tzinfo=timezone.utc).timestamp() if records else None
     
     return jsonify({
-        "temperature": temperature_data["value"],
-        "timestamp": temperature_data["timestamp"]
-    }), 200
+        "count": len(data),
+        "data": data
+    }), len(data), oldest
 
-@mqtt_bp.route('/temperature/history', methods=['GET'])
-def get_temperature_history():
-    """Endpoint to get historical temperature data"""
+def history_window(resolution, start_time, end_time, limit, count, oldest):
+    """Return the [low, high] range of sample timestamps that could change a history result
+
+    A full page only depends on samples from its oldest row on. A rollup bucket changes with any
+    sample inside it, so high extends to the end of the last bucket the query can include.
+    """
+    if count >= limit and oldest is not None:
+        low = oldest
+    elif start_time:
+        low = bucket_start(start_time, resolution) if resolution else start_time
+    else:
+        low = -math.inf
+    
+    high = end_time or math.inf
+    if resolution and end_time:
+        high = bucket_start(end_time, resolution) + RESOLUTIONS[resolution] - 1e-6
+    return low, high
+
+def sensor_history(metric):
+    """Build a history response for one device and metric, answered from the result cache when possible"""
     try:
         # Get optional query parameters
+        device_id = request.args.get('device_id', default=DEFAULT_DEVICE_ID)
         limit = request.args.get('limit', default=100, type=int)
         start_time = request.args.get('start_time', default=None, type=float)
         end_time = request.args.get('end_time', default=None, type=float)
+        resolution = request.args.get('resolution')
         
-        # Build the query
-        query = TemperatureData.query
+        if resolution is not None and resolution not in RESOLUTIONS:
+            return jsonify({"error": f"Invalid resolution. Must be one of {', '.join(RESOLUTIONS)}"}), 400
         
-        # Apply time filters if provided
-        if start_time:
-            start_datetime = datetime.utcfromtimestamp(start_time)
-            query = query.filter(TemperatureData.timestamp >= start_datetime)
-            
-        if end_time:
-            end_datetime = datetime.utcfromtimestamp(end_time)
-            query = query.filter(TemperatureData.timestamp <= end_datetime)
+        columnar = resolution is None and wants_columnar()
         
-        # Order by timestamp descending and limit results
-        temperature_records = query.order_by(TemperatureData.timestamp.desc()).limit(limit).all()
+        # Normalized parameters, so equivalent URLs share one entry
+        key = ("history", device_id, metric, resolution, start_time or None, end_time or None, limit, columnar)
+        entry = result_cache.get(key)
+        if entry is not None:
+            return history_response(entry)
         
-        # Convert to list of dictionaries
-        data = [record.to_dict() for record in temperature_records]
+        series = (device_id, metric)
+        generation = result_cache.generation(series)
+        response, count, oldest = query_history(device_id, metric, resolution, start_time, end_time, limit, columnar)
+        entry = render_history(response)
         
-        return jsonify({
-            "count": len(data),
-            "data": data
-        }), 200
+        low, high = history_window(resolution, start_time, end_time, limit, count, oldest)
+        result_cache.put(key, entry, len(entry["body"]) + len(entry["gzip"] or b""), series, low, high, generation)
+        return history_response(entry)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def fresh_state(kind):
+    """Return the latest record of a kind for the requested device (?device_id=), or None if stale"""
+    device_id = request.args.get('device_id', default=DEFAULT_DEVICE_ID)
+    record = latest_state.get(device_id, kind)
+    if record is None or time.time() - record["timestamp"] > STALE_AFTER_SECONDS:
+        return None
+    return record
+
+@mqtt_bp.route('/temperature', methods=['GET'])
+def get_temperature():
+    """Endpoint to get the latest temperature data"""
+    record = fresh_state("temperature")
+    if record is None:
+        return jsonify({"error": "Temperature data is stale or not available"}), 404
+    
+    return jsonify({
+        "temperature": record["value"],
+        "timestamp": record["timestamp"]
+    }), 200
+
+@mqtt_bp.route('/temperature/history', methods=['GET'])
+def get_temperature_history():
+    """Endpoint to get historical temperature data"""
+    return sensor_history("temperature")
+
 @mqtt_bp.route('/humidity', methods=['GET'])
 def get_humidity():
     """Endpoint to get the latest humidity data"""
-    if time.time() - humidity_data["timestamp"] > 300:  # Data older than 5 minutes
+    record = fresh_state("humidity")
+    if record is None:
         return jsonify({"error": "Humidity data is stale or not available"}), 404
     
     return jsonify({
-        "humidity": humidity_data["value"],
-        "timestamp": humidity_data["timestamp"]
+        "humidity": record["value"],
+        "timestamp": record["timestamp"]
     }), 200
 
 @mqtt_bp.route('/humidity/history', methods=['GET'])
 def get_humidity_history():
     """Endpoint to get historical humidity data"""
-    try:
-        # Get optional query parameters
-        limit = request.args.get('limit', default=100, type=int)
-        start_time = request.args.get('start_time', default=None, type=float)
-        end_time = request.args.get('end_time', default=None, type=float)
-        
-        # Build the query
-        query = HumidityData.query
-        
-        # Apply time filters if provided
-        if start_time:
-            start_datetime = datetime.utcfromtimestamp(start_time)
-            query = query.filter(HumidityData.timestamp >= start_datetime)
-            
-        if end_time:
-            end_datetime = datetime.utcfromtimestamp(end_time)
-            query = query.filter(HumidityData.timestamp <= end_datetime)
-        
-        # Order by timestamp descending and limit results
-        humidity_records = query.order_by(HumidityData.timestamp.desc()).limit(limit).all()
-        
-        # Convert to list of dictionaries
-        data = [record.to_dict() for record in humidity_records]
-        
-        return jsonify({
-            "count": len(data),
-            "data": data
-        }), 200
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return sensor_history("humidity")
+
+@mqtt_bp.route('/sensors/<metric>/history', methods=['GET'])
+def get_sensor_history(metric):
+    """Endpoint to get historical data for any stored metric"""
+    return sensor_history(metric)
+
+@mqtt_bp.route('/export', methods=['GET'])
+def export_history():
+    """Endpoint to stream raw readings as NDJSON or CSV, paged by an opaque continuation cursor"""
+    metric = request.args.get('metric')
+    if not metric:
+        return jsonify({"error": "metric is required"}), 400
+    
+    export_format = request.args.get('format', default='ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Invalid format. Must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    device_id = request.args.get('device_id', default=DEFAULT_DEVICE_ID)
+    limit = request.args.get('limit', default=None, type=int)
+    start_time = request.args.get('start_time', default=None, type=float)
+    end_time = request.args.get('end_time', default=None, type=float)
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be a positive number"}), 400
+    
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    # One row past the limit tells whether a next page exists; its cursor is taken from the last row streamed
+    rows = iter_readings(device_id, metric, start_time, end_time, after, limit if limit is None else limit + 1,
+                         page_size=current_app.config['EXPORT_PAGE_SIZE'])
+    return Response(stream_with_context(format_rows(rows, export_format, limit)),
+                    mimetype=EXPORT_FORMATS[export_format])
 
 @mqtt_bp.route('/light', methods=['GET'])
 def get_light_status():
     """Endpoint to get the latest light status"""
-    if time.time() - light_status["timestamp"] > 300:  # Data older than 5 minutes
+    record = fresh_state("light")
+    if record is None:
         return jsonify({"error": "Light status is stale or not available"}), 404
     
     return jsonify({
-        "state": light_status["state"],
-        "timestamp": light_status["timestamp"]
+        "state": record["state"],
+        "timestamp": record["timestamp"]
     }), 200
 
 @mqtt_bp.route('/light', methods=['POST'])
 def control_light():
     """Endpoint to control the light via MQTT"""
-    global client
-    
-    if not client or not connection_status["connected"]:
-        return jsonify({"error": "MQTT client is not connected"}), 503
-    
     data = request.json
     state = data.get('state', '').strip().lower()
+    device_id = data.get('device_id') or request.args.get('device_id', default=DEFAULT_DEVICE_ID)
     
     if state not in ["on", "off"]:
         return jsonify({"error": "Invalid state. Must be 'on' or 'off'"}), 400
     
     try:
-        # Publish the light control command
-        result = client.publish("light", state)
-        if result.rc == 0:
-            # Update local state immediately for faster response
-            light_status["state"] = state
-            light_status["timestamp"] = time.time()
-            
-            return jsonify({
-                "success": True, 
-                "message": f"Light turned {state}",
-                "state": state
-            }), 200
-        else:
-            return jsonify({"success": False, "error": f"Failed to publish with code {result.rc}"}), 500
+        # Queue the light control command on the worker that owns the MQTT client
+        result, status = run_on_leader("queue_command", device_id=device_id, kind="light", payload=state, state={"state": state})
+        if status != 200:
+            return jsonify(result), status
+        
+        return acknowledged_response({
+            "success": True, 
+            "message": f"Light turned {state}",
+            "state": state,
+            "command_id": result["command_id"]
+        }, data, result["command_id"])
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
-@mqtt_bp.route('/status', methods=['GET'])
-def get_status():
-    """Endpoint to check the MQTT connection status"""
-    is_active = connection_status["connected"] and (time.time() - connection_status["last_message"] < 300)
+@leader_op
+def queue_command(device_id, kind, payload, state):
+    """Queue a control command; the latest state is updated with the state fields once it is published"""
+    if not client or not connection_status["connected"]:
+        return {"error": "MQTT client is not connected"}, 503
     
+    # A newer command for the same device and actuator replaces it until it is sent
+    command_id = command_scheduler.submit(
+        device_id, kind, payload,
+        on_published=lambda: latest_state.update(device_id, kind, **state, timestamp=time.time())
+    )
+    return {"command_id": command_id}, 200
+
+@leader_op
+def command_stats():
+    if not command_scheduler:
+        return {"error": "MQTT client is not initialized"}, 503
+    return dict(command_scheduler.stats(), tracking=command_tracker.stats()), 200
+
+@mqtt_bp.route('/commands', methods=['GET'])
+def get_command_stats():
+    """Endpoint to get the control command scheduler counters"""
+    payload, status = run_on_leader("command_stats")
+    return jsonify(payload), status
+
+@leader_op
+def command_trace(command_id, wait=0.0):
+    """Status and stage latencies of a command, after waiting up to wait seconds for it to be acknowledged"""
+    record = command_tracker.wait(command_id, wait) if wait > 0 else command_tracker.get(command_id)
+    if record is None:
+        return {"error": f"Unknown command {command_id}"}, 404
+    return record, 200
+
+@mqtt_bp.route('/commands/<int:command_id>', methods=['GET'])
+def get_command_trace(command_id):
+    """Endpoint to follow one control command from the API call to the device's acknowledgement"""
+    payload, status = run_on_leader("command_trace", command_id=command_id)
+    return jsonify(payload), status
+
+def acknowledged_response(body, data, command_id):
+    """Add the command's trace to a control response when the request asked to wait for the device (wait_for_ack)"""
+    if not data.get('wait_for_ack'):
+        return jsonify(body), 200
+    try:
+        timeout = float(data.get('ack_timeout', current_app.config['COMMAND_ACK_TIMEOUT_SECONDS']))
+    except (ValueError, TypeError):
+        return jsonify({"error": "ack_timeout must be a number of seconds"}), 400
+    timeout = max(0.0, min(timeout, current_app.config['COMMAND_ACK_MAX_WAIT_SECONDS']))
+    
+    trace, status = run_on_leader("command_trace", command_id=command_id, wait=timeout)
+    if status != 200:
+        return jsonify(trace), status
+    body["ack"] = trace
+    if trace["status"] == "dropped":
+        body["success"] = False
+        body["error"] = "The command could not be published"
+        return jsonify(body), 502
+    if trace["status"] == "queued" or (trace["status"] == "published" and trace["traced"]):
+        body["success"] = False
+        body["error"] = f"No acknowledgement from {trace['device_id']} within {timeout:g} seconds"
+        return jsonify(body), 504
+    return jsonify(body), 200
+
+@mqtt_bp.route('/devices', methods=['GET'])
+def get_devices():
+    """Endpoint to get the latest state of every device in one response"""
+    devices = latest_state.devices()
     return jsonify({
+        "count": len(devices),
+        "devices": {
+            device_id: {kind: state_payload(kind, record) for kind, record in records.items()}
+            for device_id, records in devices.items()
+        }
+    }), 200
+
+def snapshot_payload(device_id):
+    """Every latest value of a device in one response, tagged with the device's state version"""
+    records, version = latest_state.device(device_id, STREAM_TOPICS)
+    now = time.time()
+    payload = {"device_id": device_id, "version": version}
+    for topic, record in records.items():
+        if record is None:
+            payload[topic] = None
+            continue
+        payload[topic] = dict(state_payload(topic, record), stale=now - record["timestamp"] > STALE_AFTER_SECONDS)
+    return payload
+
+def snapshot_changed(device_id, since):
+    """Whether any of a device's values changed after the given state version"""
+    return latest_state.device(device_id, STREAM_TOPICS)[1] > since
+
+@mqtt_bp.route('/snapshot', methods=['GET'])
+def get_snapshot():
+    """Endpoint to get the latest temperature, humidity, light and motion state at once
+    
+    With ?since=<version>, waits until the state is newer than that version or ?timeout= seconds pass.
+    """
+    device_id = request.args.get('device_id', default=DEFAULT_DEVICE_ID)
+    since = request.args.get('since', type=int)
+    max_timeout = current_app.config['SNAPSHOT_LONG_POLL_SECONDS']
+    timeout = max(0.0, min(request.args.get('timeout', default=max_timeout, type=float), max_timeout))
+    
+    if since is None or snapshot_changed(device_id, since):
+        return jsonify(snapshot_payload(device_id)), 200
+    
+    # Subscribe before checking again, so an update in between cannot be missed
+    subscriber = event_bus.subscribe(devices=[device_id])
+    try:
+        deadline = time.monotonic() + timeout
+        while not snapshot_changed(device_id, since):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or subscriber.wait(remaining) is None:
+                break
+    finally:
+        event_bus.unsubscribe(subscriber)
+    
+    return jsonify(snapshot_payload(device_id)), 200
+
+@leader_op
+def mqtt_status():
+    is_active = connection_status["connected"] and (time.time() - connection_status["last_message"] < 300)
+    
+    return {
         "connected": connection_status["connected"],
         "active": is_active,
         "last_message_time": connection_status["last_message"],
@@ -285,17 +1094,167 @@ def get_status():
             "humidity_received": subscriptions["humidity"],
             "light_received": subscriptions["light"],
             "motion_received": subscriptions["motion"]
-        }
-    }), 200
+        },
+        "telemetry": sequence_tracker.stats()
+    }, 200
 
-@mqtt_bp.route('/publish', methods=['POST'])
-def publish_test_data():
-    """Endpoint to manually publish test data to MQTT topics for debugging"""
-    global client
+@mqtt_bp.route('/status', methods=['GET'])
+def get_status():
+    """Endpoint to check the MQTT connection status"""
+    payload, status = run_on_leader("mqtt_status")
+    if cluster is not None:
+        payload["worker"] = cluster.stats()
+    return jsonify(payload), status
+
+@mqtt_bp.route('/ingest', methods=['GET'])
+def get_ingest_stats():
+    """Endpoint to get the write-behind queue depth and flush latency counters"""
+    if not ingest_queue:
+        return jsonify({"error": "Ingest queue is not initialized"}), 503
+    
+    return jsonify(ingest_queue.stats()), 200
+
+@leader_op
+def retention_stats():
+    if not retention_worker:
+        return {"error": "Retention worker is not initialized"}, 503
+    return retention_worker.stats(), 200
+
+@leader_op
+def retention_run():
+    if not retention_worker or not retention_worker.enabled:
+        return {"error": "Retention is not enabled"}, 503
+    return retention_worker.run_once(), 200
+
+@mqtt_bp.route('/retention', methods=['GET'])
+def get_retention_stats():
+    """Endpoint to get the retention settings and what the last run pruned"""
+    payload, status = run_on_leader("retention_stats")
+    return jsonify(payload), status
+
+@mqtt_bp.route('/retention/run', methods=['POST'])
+def run_retention():
+    """Endpoint to prune expired data now and report what was removed"""
+    try:
+        payload, status = run_on_leader("retention_run")
+        return jsonify(payload), status
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@mqtt_bp.route('/hotcache', methods=['GET'])
+def get_hot_cache_stats():
+    """Endpoint to get hot cache hit/miss counters and memory use"""
+    return jsonify(hot_cache.stats()), 200
+
+@mqtt_bp.route('/startup', methods=['GET'])
+def get_startup_stats():
+    """Endpoint to get this process's startup timing and the state checkpoint status"""
+    return jsonify(dict(startup_timing, checkpoint=state_checkpoint.stats() if state_checkpoint else None)), 200
+
+@mqtt_bp.route('/resultcache', methods=['GET'])
+def get_result_cache_stats():
+    """Endpoint to get result cache hit ratio, invalidations and memory use"""
+    return jsonify(result_cache.stats()), 200
+
+@leader_op
+def analytics_series(device_id, metric):
+    return {
+        "series": analytics.series(device_id, metric, now=time.time()),
+        "alerts": analytics.alerts(device_id)
+    }, 200
+
+@leader_op
+def analytics_events(device_id, limit):
+    return {
+        "events": analytics.events(device_id, limit),
+        "analytics": analytics.stats()
+    }, 200
+
+@mqtt_bp.route('/analytics', methods=['GET'])
+def get_analytics():
+    """Endpoint to get the sliding-window aggregates, EWMA and raised alerts (?device_id=, ?metric=)"""
+    payload, status = run_on_leader("analytics_series", device_id=request.args.get('device_id'), metric=request.args.get('metric'))
+    return jsonify(payload), status
+
+@mqtt_bp.route('/analytics/events', methods=['GET'])
+def get_analytics_events():
+    """Endpoint to get the most recent threshold events, newest first (?device_id=, ?limit=)"""
+    payload, status = run_on_leader("analytics_events", device_id=request.args.get('device_id'),
+                                    limit=request.args.get('limit', default=50, type=int))
+    return jsonify(payload), status
+
+def stream_filters(topics, devices):
+    """Parse the comma-separated topics and devices of a stream request, raising ValueError for unknown topics"""
+    topics = [topic.strip() for topic in topics.split(',') if topic.strip()] if topics else list(STREAM_TOPICS)
+    invalid = [topic for topic in topics if topic not in STREAM_TOPICS]
+    if invalid:
+        raise ValueError(f"Invalid topics: {', '.join(invalid)}. Must be among {', '.join(STREAM_TOPICS)}")
+    
+    devices = [device.strip() for device in devices.split(',') if device.strip()] if devices else None
+    return topics, devices
+
+def sse_event(topic, data):
+    """Format one state update as a Server-Sent Event"""
+    return f"event: {topic}\ndata: {json.dumps(data)}\n\n"
+
+def initial_stream_events(subscriber, topics):
+    """Yield the current state a new stream client starts from"""
+    for device_id, records in latest_state.devices().items():
+        for topic in topics:
+            if topic in records and subscriber.wants(device_id, topic):
+                yield sse_event(topic, dict(state_payload(topic, records[topic]), device_id=device_id))
+
+@mqtt_bp.route('/stream', methods=['GET'])
+def stream_state():
+    """Endpoint that pushes state changes to the client as Server-Sent Events"""
+    try:
+        topics, devices = stream_filters(request.args.get('topics'), request.args.get('devices'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    keepalive = current_app.config['STREAM_KEEPALIVE_SECONDS']
+    subscriber = event_bus.subscribe(topics, devices)
     
+    def generate():
+        try:
+            yield "retry: 2000\n\n"
+            yield from initial_stream_events(subscriber, topics)
+            while True:
+                # Updates that arrive while the client is still reading are coalesced per topic
+                updates = subscriber.wait(keepalive)
+                if updates is None:
+                    break
+                if not updates:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "".join(sse_event(topic, data) for (_, topic), data in updates)
+        finally:
+            event_bus.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@mqtt_bp.route('/stream/stats', methods=['GET'])
+def get_stream_stats():
+    """Endpoint to get the number of stream subscribers and coalesced updates"""
+    return jsonify(event_bus.stats()), 200
+
+@leader_op
+def publish_message(topic, value):
     if not client or not connection_status["connected"]:
-        return jsonify({"error": "MQTT client is not connected"}), 503
+        return {"error": "MQTT client is not connected"}, 503
     
+    result = client.publish(topic, value)
+    if result.rc == 0:
+        return {"success": True, "message": f"Published {value} to {topic}"}, 200
+    return {"success": False, "error": f"Failed to publish with code {result.rc}"}, 500
+
+@mqtt_bp.route('/publish', methods=['POST'])
+def publish_test_data():
+    """Endpoint to manually publish test data to MQTT topics for debugging"""
     data = request.json
     topic = data.get('topic')
     value = data.get('value')
@@ -304,38 +1263,31 @@ def publish_test_data():
         return jsonify({"error": "Topic and value are required"}), 400
     
     try:
-        # Publish the test data
-        result = client.publish(topic, str(value))
-        if result.rc == 0:
-            return jsonify({"success": True, "message": f"Published {value} to {topic}"}), 200
-        else:
-            return jsonify({"success": False, "error": f"Failed to publish with code {result.rc}"}), 500
+        payload, status = run_on_leader("publish_message", topic=topic, value=str(value))
+        return jsonify(payload), status
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 @mqtt_bp.route('/motion', methods=['GET'])
 def get_motion_status():
     """Endpoint to get the latest motion status"""
-    if time.time() - motion_status["timestamp"] > 300:  # Data older than 5 minutes
+    record = fresh_state("motion")
+    if record is None:
         return jsonify({"error": "Motion status is stale or not available"}), 404
     
     return jsonify({
-        "direction": motion_status["direction"],
-        "angle": motion_status["angle"],
-        "timestamp": motion_status["timestamp"]
+        "direction": record["direction"],
+        "angle": record["angle"],
+        "timestamp": record["timestamp"]
     }), 200
 
 @mqtt_bp.route('/motion', methods=['POST'])
 def control_motion():
     """Endpoint to control motion via MQTT"""
-    global client
-    
-    if not client or not connection_status["connected"]:
-        return jsonify({"error": "MQTT client is not connected"}), 503
-    
     data = request.json
     direction = data.get('direction', '').strip().lower()
     angle = data.get('angle')
+    device_id = data.get('device_id') or request.args.get('device_id', default=DEFAULT_DEVICE_ID)
     
     # Validate direction
     if direction not in ["left", "right"]:
@@ -353,22 +1305,19 @@ def control_motion():
         # Construct the motion command in the format expected by the Raspberry Pi
         motion_command = f"{direction} {angle}"
         
-        # Publish the motion control command
-        result = client.publish("motion", motion_command)
-        if result.rc == 0:
-            # Update local state immediately for faster response
-            motion_status["direction"] = direction
-            motion_status["angle"] = angle
-            motion_status["timestamp"] = time.time()
-            
-            return jsonify({
-                "success": True, 
-                "message": f"Motion set to {direction} {angle}°",
-                "direction": direction,
-                "angle": angle
-            }), 200
-        else:
-            return jsonify({"success": False, "error": f"Failed to publish with code {result.rc}"}), 500
+        # Queue the motion control command on the worker that owns the MQTT client
+        result, status = run_on_leader("queue_command", device_id=device_id, kind="motion", payload=motion_command,
+                                       state={"direction": direction, "angle": angle})
+        if status != 200:
+            return jsonify(result), status
+        
+        return acknowledged_response({
+            "success": True, 
+            "message": f"Motion set to {direction} {angle}°",
+            "direction": direction,
+            "angle": angle,
+            "command_id": result["command_id"]
+        }, data, result["command_id"])
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -376,58 +1325,34 @@ def control_motion():
 def get_database_stats():
     """Endpoint to get statistics about the stored sensor data"""
     try:
-        # Count records
-        temperature_count = TemperatureData.query.count()
-        humidity_count = HumidityData.query.count()
-        
-        # Get min, max, avg for temperature if records exist
-        temp_stats = {}
-        if temperature_count > 0:
-            temp_min = db.session.query(db.func.min(TemperatureData.value)).scalar()
-            temp_max = db.session.query(db.func.max(TemperatureData.value)).scalar()
-            temp_avg = db.session.query(db.func.avg(TemperatureData.value)).scalar()
-            
-            # Get the newest and oldest record timestamps
-            newest_temp = db.session.query(db.func.max(TemperatureData.timestamp)).scalar()
-            oldest_temp = db.session.query(db.func.min(TemperatureData.timestamp)).scalar()
-            
-            temp_stats = {
-                "min": temp_min,
-                "max": temp_max,
-                "avg": temp_avg,
-                "first_record": oldest_temp.timestamp() if oldest_temp else None,
-                "last_record": newest_temp.timestamp() if newest_temp else None
-            }
-        
-        # Get min, max, avg for humidity if records exist
-        humidity_stats = {}
-        if humidity_count > 0:
-            humidity_min = db.session.query(db.func.min(HumidityData.value)).scalar()
-            humidity_max = db.session.query(db.func.max(HumidityData.value)).scalar()
-            humidity_avg = db.session.query(db.func.avg(HumidityData.value)).scalar()
-            
-            # Get the newest and oldest record timestamps
-            newest_humidity = db.session.query(db.func.max(HumidityData.timestamp)).scalar()
-            oldest_humidity = db.session.query(db.func.min(HumidityData.timestamp)).scalar()
-            
-            humidity_stats = {
-                "min": humidity_min,
-                "max": humidity_max,
-                "avg": humidity_avg,
-                "first_record": oldest_humidity.timestamp() if oldest_humidity else None,
-                "last_record": newest_humidity.timestamp() if newest_humidity else None
-            }
+        entry = result_cache.get(STATS_SERIES)
+        if entry is None:
+            generation = result_cache.generation(STATS_SERIES)
+            entry = json.dumps(get_stats()).encode()
+            result_cache.put(STATS_SERIES, entry, len(entry), STATS_SERIES, generation=generation)
+        return Response(entry, mimetype="application/json"), 200
         
-        return jsonify({
-            "temperature": {
-                "count": temperature_count,
-                "stats": temp_stats
-            },
-            "humidity": {
-                "count": humidity_count,
-                "stats": humidity_stats
-            }
-        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@leader_op
+def stats_rebuild():
+    if not ingest_queue:
+        return {"error": "Ingest queue is not initialized"}, 503
+    
+    # Rebuild on the writer thread so it cannot interleave with a flush
+    ingest_queue.submit(rebuild_stats).result()
+    result_cache.invalidate(STATS_SERIES)
+    if commit_log is not None:
+        commit_log.append()
+    return get_stats(), 200
+
+@mqtt_bp.route('/stats/rebuild', methods=['POST'])
+def rebuild_database_stats():
+    """Endpoint to recompute the running statistics from the daily rollups"""
+    try:
+        payload, status = run_on_leader("stats_rebuild")
+        return jsonify(payload), status
         
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,326 @@
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import threading
+import zlib
+
+MAGIC = b"IOTSTATE"
+LAYOUT = 1
+
+# Header: magic, layout, slot count, log size, global version, slots in use, log head, leader pid
+HEADER = struct.Struct("=8sIII4xQI4xQQ")
+VERSION_OFFSET = 24
+USED_OFFSET = 32
+LOG_SEQ_OFFSET = 40
+LEADER_OFFSET = 48
+ORDER_OFFSET = 64
+
+# Slot: seqlock counter, record version, key and data lengths, then the key and JSON data bytes
+SLOT_SIZE = 512
+SLOT_HEADER = struct.Struct("=QQHH4x")
+KEY_SIZE = 128
+DATA_SIZE = SLOT_SIZE - SLOT_HEADER.size - KEY_SIZE
+
+# Commit log entry: log sequence number, time range, key length, then the "device\0metric" key
+LOG_ENTRY_SIZE = 160
+LOG_HEADER = struct.Struct("=QddH6x")
+
+# Spins a reader waits for a slot with a write in progress before treating it as empty
+READ_ATTEMPTS = 10000
+
+U32 = struct.Struct("=I")
+U64 = struct.Struct("=Q")
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class SharedSegment:
+    """Fixed-layout memory-mapped file shared by every worker process
+
+    Holds the latest-state slots and a ring of recent database commits. Only the leader writes to
+    it; the layout is created by the first process to open the file and kept by later ones.
+    """
+
+    def __init__(self, path, slots=1024, log_size=1024):
+        self.path = path
+        self.slots = slots
+        self.log_size = log_size
+        self.slots_offset = _align(ORDER_OFFSET + 4 * slots)
+        self.log_offset = self.slots_offset + slots * SLOT_SIZE
+        self.size = self.log_offset + log_size * LOG_ENTRY_SIZE
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Serialize the layout check between workers starting at the same time
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = os.pread(fd, HEADER.size, 0)
+            expected = (MAGIC, LAYOUT, slots, log_size)
+            if os.fstat(fd).st_size != self.size or len(header) < HEADER.size or HEADER.unpack(header)[:4] != expected:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, LAYOUT, slots, log_size, 0, 0, 0, 0), 0)
+            self.mm = mmap.mmap(fd, self.size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def read_u64(self, offset):
+        return U64.unpack_from(self.mm, offset)[0]
+
+    def write_u64(self, offset, value):
+        U64.pack_into(self.mm, offset, value)
+
+    def read_u32(self, offset):
+        return U32.unpack_from(self.mm, offset)[0]
+
+    def write_u32(self, offset, value):
+        U32.pack_into(self.mm, offset, value)
+
+
+def _slot_key(device_id, kind):
+    key = f"{device_id}\0{kind}".encode("utf-8")
+    if len(key) > KEY_SIZE:
+        raise ValueError(f"Device id too long for the shared state: {device_id}")
+    return key
+
+
+class SharedStateStore:
+    """LatestStateStore whose records live in a SharedSegment, readable by every worker without locks
+
+    Each slot is protected by a seqlock: the writer makes the counter odd, writes the slot and
+    makes it even again, and a reader retries until it copied the slot between two reads of the
+    same even counter. A leader that dies mid-write leaves the counter odd, so readers give up
+    after READ_ATTEMPTS and the next leader repairs the slot before writing. Slots are found by
+    open addressing on a hash of the key and are never freed, so a worker can remember where a
+    key lives. Only the leader worker may update.
+    """
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.writable = False
+        self._listeners = []
+        self._write_lock = threading.Lock()
+        self._index = {}
+
+    def add_listener(self, listener):
+        """Register listener(device_id, kind, record), called after every update in this process"""
+        self._listeners.append(listener)
+
+    def notify(self, device_id, kind, record):
+        """Run the listeners for an update made by another process"""
+        for listener in self._listeners:
+            listener(device_id, kind, record)
+
+    def _slot_offset(self, index):
+        return self.segment.slots_offset + index * SLOT_SIZE
+
+    def read_slot(self, index):
+        """Return (key, version, record) of a slot, or None when it is empty or stays mid-write
+
+        record is None for a key whose record was lost to a torn write.
+        """
+        mm = self.segment.mm
+        offset = self._slot_offset(index)
+        for _ in range(READ_ATTEMPTS):
+            sequence = U64.unpack_from(mm, offset)[0]
+            if sequence & 1:
+                # A write is in progress
+                time.sleep(0)
+                continue
+            raw = mm[offset:offset + SLOT_SIZE]
+            if U64.unpack_from(mm, offset)[0] != sequence:
+                continue
+            _, version, key_length, data_length = SLOT_HEADER.unpack_from(raw)
+            if not key_length:
+                return None
+            key = raw[SLOT_HEADER.size:SLOT_HEADER.size + key_length]
+            if not data_length:
+                return key, version, None
+            data = raw[SLOT_HEADER.size + KEY_SIZE:SLOT_HEADER.size + KEY_SIZE + data_length]
+            return key, version, dict(json.loads(data), version=version)
+        return None
+
+    def recover(self):
+        """Finish the writes a dead leader left mid-way; call before becoming writable
+
+        A slot that was being taken is emptied again. A slot already in use keeps its key, so the
+        keys probed past it stay reachable, and loses its record unless the record is intact.
+        Returns the number of slots repaired.
+        """
+        segment = self.segment
+        used = set(self.used_slots())
+        repaired = 0
+        with self._write_lock:
+            for index in range(segment.slots):
+                offset = self._slot_offset(index)
+                sequence = segment.read_u64(offset)
+                if not sequence & 1:
+                    continue
+                _, version, key_length, data_length = SLOT_HEADER.unpack_from(segment.mm, offset)
+                if index not in used or not 0 < key_length <= KEY_SIZE:
+                    SLOT_HEADER.pack_into(segment.mm, offset, sequence, 0, 0, 0)
+                else:
+                    start = offset + SLOT_HEADER.size + KEY_SIZE
+                    try:
+                        record = json.loads(segment.mm[start:start + min(data_length, DATA_SIZE)])
+                    except ValueError:
+                        record = None
+                    if not isinstance(record, dict) or data_length > DATA_SIZE:
+                        data_length = 0
+                    SLOT_HEADER.pack_into(segment.mm, offset, sequence, version, key_length, data_length)
+                segment.write_u64(offset, sequence + 1)
+                repaired += 1
+        return repaired
+
+    def slot_version(self, index):
+        """Version of a slot without copying it; may be torn, so confirm with read_slot"""
+        return U64.unpack_from(self.segment.mm, self._slot_offset(index) + 8)[0]
+
+    def _find(self, key):
+        """Return (index, slot) for a key, or (first empty index, None) when it is not stored"""
+        index = self._index.get(key)
+        if index is not None:
+            return index, self.read_slot(index)
+        start = zlib.crc32(key) % self.segment.slots
+        for probe in range(self.segment.slots):
+            index = (start + probe) % self.segment.slots
+            slot = self.read_slot(index)
+            if slot is None:
+                return index, None
+            if slot[0] == key:
+                self._index[key] = index
+                return index, slot
+        raise RuntimeError("Shared state is full, raise CLUSTER_STATE_SLOTS")
+
+    def used_slots(self):
+        """Indexes of the slots in use, in the order they were taken"""
+        used = self.segment.read_u32(USED_OFFSET)
+        return [self.segment.read_u32(ORDER_OFFSET + 4 * position) for position in range(used)]
+
+    def update(self, device_id, kind, **fields):
+        """Merge fields into the record for a device and kind and return the new record"""
+        if not self.writable:
+            raise RuntimeError("Only the leader worker can update the shared state")
+        key = _slot_key(device_id, kind)
+        segment = self.segment
+        with self._write_lock:
+            index, slot = self._find(key)
+            record = dict(slot and slot[2] or {}, **fields)
+            record.pop("version", None)
+            data = json.dumps(record).encode("utf-8")
+            if len(data) > DATA_SIZE:
+                raise ValueError(f"{kind} record of {device_id} is too large for the shared state")
+            version = segment.read_u64(VERSION_OFFSET) + 1
+
+            offset = self._slot_offset(index)
+            sequence = segment.read_u64(offset)
+            segment.write_u64(offset, sequence + 1)
+            SLOT_HEADER.pack_into(segment.mm, offset, sequence + 1, version, len(key), len(data))
+            segment.mm[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(key)] = key
+            start = offset + SLOT_HEADER.size + KEY_SIZE
+            segment.mm[start:start + len(data)] = data
+            segment.write_u64(offset, sequence + 2)
+
+            if slot is None:
+                used = segment.read_u32(USED_OFFSET)
+                segment.write_u32(ORDER_OFFSET + 4 * used, index)
+                segment.write_u32(USED_OFFSET, used + 1)
+                self._index[key] = index
+            segment.write_u64(VERSION_OFFSET, version)
+
+        record["version"] = version
+        for listener in self._listeners:
+            listener(device_id, kind, record)
+        return record
+
+    def skip_to(self, version):
+        """Continue numbering versions after the given one, e.g. one restored from a checkpoint"""
+        with self._write_lock:
+            if self.segment.read_u64(VERSION_OFFSET) < version:
+                self.segment.write_u64(VERSION_OFFSET, version)
+
+    def get(self, device_id, kind):
+        """Return the latest record for a device and kind, or None"""
+        slot = self._find(_slot_key(device_id, kind))[1]
+        return slot and slot[2]
+
+    def device(self, device_id, kinds):
+        """Return ({kind: record}, version) for one device, where version is the newest record's"""
+        records = {kind: self.get(device_id, kind) for kind in kinds}
+        version = max((record["version"] for record in records.values() if record), default=0)
+        return records, version
+
+    def devices(self):
+        """Return {device_id: {kind: record}} for every known device"""
+        latest = {}
+        for index in self.used_slots():
+            slot = self.read_slot(index)
+            if slot is not None and slot[2] is not None:
+                device_id, kind = slot[0].decode("utf-8").split("\0", 1)
+                latest.setdefault(device_id, {})[kind] = slot[2]
+        return latest
+
+    @property
+    def version(self):
+        return self.segment.read_u64(VERSION_OFFSET)
+
+
+class CommitLog:
+    """Ring of recently committed (device, metric, first timestamp, last timestamp) ranges in a SharedSegment
+
+    The leader appends one entry per series per flush; other workers replay new entries to
+    invalidate their result caches. An entry is stamped with its sequence number last, so a
+    reader that finds a different number knows it was overwritten and has fallen behind.
+    """
+
+    def __init__(self, segment):
+        self.segment = segment
+        self._lock = threading.Lock()
+
+    def _entry_offset(self, sequence):
+        return self.segment.log_offset + (sequence % self.segment.log_size) * LOG_ENTRY_SIZE
+
+    @property
+    def head(self):
+        return self.segment.read_u64(LOG_SEQ_OFFSET)
+
+    def append(self, device_id=None, metric=None, low=0.0, high=0.0):
+        """Record a commit; without a device and metric it means every cached result is stale"""
+        key = _slot_key(device_id, metric) if device_id is not None else b""
+        segment = self.segment
+        with self._lock:
+            sequence = segment.read_u64(LOG_SEQ_OFFSET) + 1
+            offset = self._entry_offset(sequence)
+            segment.write_u64(offset, 0)
+            LOG_HEADER.pack_into(segment.mm, offset, 0, low, high, len(key))
+            segment.mm[offset + LOG_HEADER.size:offset + LOG_HEADER.size + len(key)] = key
+            segment.write_u64(offset, sequence)
+            segment.write_u64(LOG_SEQ_OFFSET, sequence)
+
+    def read(self, after):
+        """Return (head, entries) for commits after the given sequence number
+
+        Entries are (device_id, metric, low, high), with None ids meaning everything. entries is
+        None when some were already overwritten.
+        """
+        head = self.head
+        if head - after > self.segment.log_size:
+            return head, None
+        entries = []
+        for sequence in range(after + 1, head + 1):
+            offset = self._entry_offset(sequence)
+            raw = self.segment.mm[offset:offset + LOG_ENTRY_SIZE]
+            stamped, low, high, key_length = LOG_HEADER.unpack_from(raw)
+            if stamped != sequence or self.segment.read_u64(offset) != sequence:
+                return head, None
+            if key_length:
+                device_id, metric = raw[LOG_HEADER.size:LOG_HEADER.size + key_length].decode("utf-8").split("\0", 1)
+                entries.append((device_id, metric, low, high))
+            else:
+                entries.append((None, None, low, high))
+        return head, entries
@@ -0,0 +1,62 @@
+import itertools
+import threading
+
+
+class LatestStateStore:
+    """Latest state per (device, kind), spread over independently locked shards
+
+    Records are replaced rather than mutated, so readers never take a lock and always see a complete record.
+    Every update stamps the record with a process-wide, monotonically increasing version.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._listeners = []
+        self._versions = itertools.count(1)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def add_listener(self, listener):
+        """Register listener(device_id, kind, record), called after every update"""
+        self._listeners.append(listener)
+
+    def update(self, device_id, kind, **fields):
+        """Merge fields into the record for a device and kind and return the new record"""
+        key = (device_id, kind)
+        records, lock = self._shard(key)
+        with lock:
+            version = next(self._versions)
+            record = dict(records.get(key) or {}, **fields, version=version)
+            records[key] = record
+        for listener in self._listeners:
+            listener(device_id, kind, record)
+        return record
+
+    def skip_to(self, version):
+        """Continue numbering versions after the given one, e.g. one restored from a checkpoint"""
+        self._versions = itertools.count(version + 1)
+
+    def get(self, device_id, kind):
+        """Return the latest record for a device and kind, or None"""
+        records, _ = self._shard((device_id, kind))
+        return records.get((device_id, kind))
+
+    def device(self, device_id, kinds):
+        """Return ({kind: record}, version) for one device, where version is the newest record's"""
+        records = {kind: self.get(device_id, kind) for kind in kinds}
+        version = max((record["version"] for record in records.values() if record), default=0)
+        return records, version
+
+    def devices(self):
+        """Return {device_id: {kind: record}} for every known device"""
+        latest = {}
+        for records, _ in self._shards:
+            for (device_id, kind), record in list(records.items()):
+                latest.setdefault(device_id, {})[kind] = record
+        return latest
+
+    @property
+    def version(self):
+        """Newest version of any record, 0 while the store is empty"""
+        return max((record["version"] for records, _ in self._shards for record in list(records.values())), default=0)
@@ -0,0 +1,108 @@
+from datetime import datetime, timezone
+from models import db, SensorRollup, SensorStats, SENSOR_METRICS
+
+
+def update_stats(device_id, metric, samples):
+    """Fold a batch of (value, timestamp) samples into the running statistics for a device and metric
+
+    Runs inside the ingest writer's transaction, so the totals always match the committed rows.
+    """
+    stats = db.session.get(SensorStats, (device_id, metric))
+    if stats is None:
+        stats = SensorStats(device_id=device_id, metric=metric, count=0, sum=0.0)
+        db.session.add(stats)
+
+    values = [value for value, _ in samples]
+    first_timestamp = datetime.utcfromtimestamp(min(timestamp for _, timestamp in samples))
+    last_timestamp = datetime.utcfromtimestamp(max(timestamp for _, timestamp in samples))
+
+    stats.count += len(values)
+    stats.sum += sum(values)
+    stats.min = min(values) if stats.min is None else min(stats.min, min(values))
+    stats.max = max(values) if stats.max is None else max(stats.max, max(values))
+    if stats.first_timestamp is None or first_timestamp < stats.first_timestamp:
+        stats.first_timestamp = first_timestamp
+    if stats.last_timestamp is None or last_timestamp > stats.last_timestamp:
+        stats.last_timestamp = last_timestamp
+
+
+def rebuild_stats():
+    """Recompute the running statistics for every device and metric and commit them
+
+    Built from the daily rollups rather than the raw rows: they are far fewer, and they are never
+    pruned, so the totals still cover readings the retention policy has already deleted.
+    """
+    totals = db.session.query(
+        SensorRollup.device_id,
+        SensorRollup.metric,
+        db.func.sum(SensorRollup.count),
+        db.func.sum(SensorRollup.sum),
+        db.func.min(SensorRollup.min),
+        db.func.max(SensorRollup.max),
+        db.func.min(SensorRollup.first_timestamp),
+        db.func.max(SensorRollup.last_timestamp)
+    ).filter(SensorRollup.resolution == "1d").group_by(SensorRollup.device_id, SensorRollup.metric).all()
+
+    SensorStats.query.delete()
+    for device_id, metric, count, total, minimum, maximum, first_timestamp, last_timestamp in totals:
+        db.session.add(SensorStats(
+            device_id=device_id,
+            metric=metric,
+            count=count,
+            sum=total or 0.0,
+            min=minimum,
+            max=maximum,
+            first_timestamp=first_timestamp,
+            last_timestamp=last_timestamp
+        ))
+    db.session.commit()
+    return sum(row[2] for row in totals)
+
+
+def initialize_stats(rebuild=False):
+    """Rebuild the statistics when asked to, or when there are none yet"""
+    if rebuild or SensorStats.query.first() is None:
+        count = rebuild_stats()
+        print(f"Rebuilt sensor statistics from {count} stored rows")
+
+
+def get_stats():
+    """Return the statistics for every metric, combined over all devices, without touching the raw table"""
+    combined = {metric: None for metric in SENSOR_METRICS}
+    for stats in SensorStats.query.all():
+        if not stats.count:
+            continue
+        total = combined.get(stats.metric)
+        if total is None:
+            combined[stats.metric] = {
+                "count": stats.count,
+                "sum": stats.sum,
+                "min": stats.min,
+                "max": stats.max,
+                "first_timestamp": stats.first_timestamp,
+                "last_timestamp": stats.last_timestamp
+            }
+            continue
+        total["count"] += stats.count
+        total["sum"] += stats.sum
+        total["min"] = min(total["min"], stats.min)
+        total["max"] = max(total["max"], stats.max)
+        total["first_timestamp"] = min(total["first_timestamp"], stats.first_timestamp)
+        total["last_timestamp"] = max(total["last_timestamp"], stats.last_timestamp)
+
+    return {metric: _stats_dict(total) for metric, total in combined.items()}
+
+
+def _stats_dict(total):
+    if total is None:
+        return {"count": 0, "stats": {}}
+    return {
+        "count": total["count"],
+        "stats": {
+            "min": total["min"],
+            "max": total["max"],
+            "avg": total["sum"] / total["count"],
+            "first_record": total["first_timestamp"].replace(tzinfo=timezone.utc).timestamp(),
+            "last_record": total["last_timestamp"].replace(tzinfo=timezone.utc).timestamp()
+        }
+    }
@@ -0,0 +1,93 @@
+import json
+import math
+import threading
+
+TELEMETRY_VERSION = 1
+
+
+def decode_telemetry(payload):
+    """Parse a compact telemetry message into (device_id, boot id, first sequence number, timestamps, {metric: values})
+
+    A message carries one or more samples taken by a device, for example two:
+
+        {"v": 1, "d": "pi-kitchen", "b": "5f2c9e1a", "s": 1042, "t": [1700000000.0, 1700000002.0],
+         "m": {"temperature": [22.5, 22.6], "humidity": [41.0, null]}}
+
+    Samples are numbered s, s + 1, ... in order, counting from 0 since the device started under
+    boot id b; every metric list is as long as t, with null where a metric was not read.
+    device_id is None when the message does not name the device.
+    Raises ValueError when the message is malformed.
+    """
+    try:
+        message = json.loads(payload)
+        version = message["v"]
+        if version != TELEMETRY_VERSION:
+            raise ValueError(f"unsupported telemetry version {version}")
+        device_id = message.get("d")
+        if device_id is not None and (not isinstance(device_id, str) or not device_id):
+            raise ValueError(f"invalid device id {device_id!r}")
+        boot = message["b"]
+        if not isinstance(boot, str) or not boot:
+            raise ValueError(f"invalid boot id {boot!r}")
+        sequence = message["s"]
+        if not isinstance(sequence, int) or sequence < 0:
+            raise ValueError(f"invalid sequence number {sequence!r}")
+        if not isinstance(message["t"], list) or not isinstance(message["m"], dict):
+            raise ValueError("t must be a list and m an object")
+        timestamps = [float(timestamp) for timestamp in message["t"]]
+        if not timestamps or not all(math.isfinite(timestamp) for timestamp in timestamps):
+            raise ValueError("timestamps must be a non-empty list of numbers")
+        metrics = {}
+        for metric, values in message["m"].items():
+            if not isinstance(values, list) or len(values) != len(timestamps):
+                raise ValueError(f"{metric} must have one value per timestamp")
+            metrics[metric] = [None if value is None else float(value) for value in values]
+            if not all(value is None or math.isfinite(value) for value in metrics[metric]):
+                raise ValueError(f"{metric} has a value that is not a finite number")
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"malformed telemetry message: {str(e)}")
+    return device_id, boot, sequence, timestamps, metrics
+
+
+class SequenceTracker:
+    """Tells new samples from redelivered ones by the per-device sequence number
+
+    Remembers the boot id and last sequence number seen from each device. A message that starts
+    past the next expected number means messages were lost in between, and one that starts at or
+    before the last number is a redelivery. A new boot id means the device restarted and began
+    counting again, whatever its clock says.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+        self.gaps = 0
+        self.duplicates = 0
+        self.restarts = 0
+
+    def accept(self, device_id, boot, sequence, count):
+        """Return how many of the leading count samples of a message were already seen"""
+        with self._lock:
+            last = self._last.get(device_id)
+            skip = 0
+            if last is not None:
+                last_boot, last_sequence = last
+                if boot != last_boot:
+                    self.restarts += 1
+                elif sequence > last_sequence + 1:
+                    self.gaps += sequence - last_sequence - 1
+                elif sequence <= last_sequence:
+                    skip = min(count, last_sequence - sequence + 1)
+                    self.duplicates += skip
+            if skip < count:
+                self._last[device_id] = (boot, sequence + count - 1)
+        return skip
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._last),
+                "gaps": self.gaps,
+                "duplicates": self.duplicates,
+                "restarts": self.restarts
+            }
@@ -0,0 +1,262 @@
+import math
+import weakref
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Default latency buckets in seconds, from 100 µs to 10 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _ThreadToken:
+    """Held only by one thread's local storage, so it is released when that thread ends"""
+    __slots__ = ("__weakref__",)
+
+
+class _Cells:
+    """Per-thread accumulator cells
+
+    Each thread only ever writes its own cell, so updates need no lock and are never lost;
+    a scrape sums all cells. A lock is only taken the first time a thread touches the metric.
+    When a thread ends its cell is retired, and the next scrape or new thread folds it into a
+    base total, so thread-per-request serving does not grow the cells with every request.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._cells = {}
+        self._retired = deque()
+        self._base = [0.0] * size
+        self._lock = threading.Lock()
+
+    def cell(self):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = [0.0] * self._size
+            token = _ThreadToken()
+            self._local.cell = cell
+            self._local.token = token
+            with self._lock:
+                self._fold()
+                self._cells[id(cell)] = cell
+            weakref.finalize(token, self._retired.append, cell)
+        return cell
+
+    def _fold(self):
+        # Caller holds the lock. Retired cells belong to ended threads, so they no longer change
+        while self._retired:
+            cell = self._retired.popleft()
+            del self._cells[id(cell)]
+            for index, value in enumerate(cell):
+                self._base[index] += value
+
+    def totals(self):
+        with self._lock:
+            self._fold()
+            cells = list(self._cells.values())
+            totals = list(self._base)
+        for cell in cells:
+            for index, value in enumerate(cell):
+                totals[index] += value
+        return totals
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Unlabelled metrics are reported from the start, even before the first update
+            self.labels()
+        if register:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Return the child for a set of label values, creating it on first use"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _labelled_children(self):
+        return [(tuple(zip(self.labelnames, values)), child) for values, child in list(self._children.items())]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, either incremented directly or read from a function at scrape time"""
+    kind = "counter"
+
+    class Child:
+        def __init__(self):
+            self._cells = _Cells(1)
+            self._function = None
+
+        def inc(self, amount=1):
+            self._cells.cell()[0] += amount
+
+        def set_function(self, function):
+            self._function = function
+
+        def value(self):
+            return self._function() if self._function else self._cells.totals()[0]
+
+    def __init__(self, name, documentation, labelnames=(), function=None, register=True):
+        super().__init__(name, documentation, labelnames, register)
+        if function is not None:
+            self.labels().set_function(function)
+
+    def _new_child(self):
+        return Counter.Child()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        lines = []
+        for labels, child in self._labelled_children():
+            try:
+                value = child.value()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(float(value))}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, either set directly or read from a function at scrape time"""
+    kind = "gauge"
+
+    class Child:
+        def __init__(self, function=None):
+            self._value = 0.0
+            self._function = function
+
+        def set(self, value):
+            self._value = value
+
+        def set_function(self, function):
+            self._function = function
+
+        def value(self):
+            return self._function() if self._function else self._value
+
+    def __init__(self, name, documentation, labelnames=(), function=None, register=True):
+        super().__init__(name, documentation, labelnames, register)
+        if function is not None:
+            self.labels().set_function(function)
+
+    def _new_child(self):
+        return Gauge.Child()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self):
+        lines = []
+        for labels, child in self._labelled_children():
+            try:
+                value = child.value()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(float(value))}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed, pre-defined buckets"""
+    kind = "histogram"
+
+    class Child:
+        def __init__(self, buckets):
+            self._buckets = buckets
+            # One cell per bucket plus +Inf, then sum and count
+            self._cells = _Cells(len(buckets) + 3)
+
+        def observe(self, value):
+            cell = self._cells.cell()
+            cell[bisect_left(self._buckets, value)] += 1
+            cell[-2] += value
+            cell[-1] += 1
+
+        def totals(self):
+            return self._cells.totals()
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, register=True):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, register)
+
+    def _new_child(self):
+        return Histogram.Child(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        lines = []
+        for labels, child in self._labelled_children():
+            totals = child.totals()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), totals):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', _format_value(float(bound))),))} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(totals[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(totals[-1])}")
+        return lines
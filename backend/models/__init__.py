@@ -1,40 +1,98 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timezone
+from .storage import RoutingSession
 
 # Initialize the SQLAlchemy extension
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def use_writer_session():
+    """Route db.session in the current app context to the writer connection
+
+    Only the ingest writer thread, and startup code that runs before it, should write.
+    """
+    db.session().info["writer"] = True
+
+# Device id used for readings from the original single-device topics
+DEFAULT_DEVICE_ID = 'default'
+
+# Metrics served by the history and stats endpoints
+SENSOR_METRICS = ('temperature', 'humidity')
 
 # Define database models
-class TemperatureData(db.Model):
-    __tablename__ = 'temperature_data'
-    
+class SensorReading(db.Model):
+    """One sensor sample, keyed by device, metric and timestamp"""
+    __tablename__ = 'sensor_readings'
+    __table_args__ = (
+        # Covers range scans and latest-value lookups per device/metric without touching the table
+        db.Index('ix_sensor_readings_device_metric_timestamp', 'device_id', 'metric', 'timestamp', 'value'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(64), nullable=False, default=DEFAULT_DEVICE_ID)
+    metric = db.Column(db.String(32), nullable=False)
     value = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    
+
     def __repr__(self):
-        return f'<TemperatureData id={self.id} value={self.value} timestamp={self.timestamp}>'
-    
+        return f'<SensorReading id={self.id} device={self.device_id} metric={self.metric} value={self.value} timestamp={self.timestamp}>'
+
     def to_dict(self):
         return {
             'id': self.id,
             'value': self.value,
-            'timestamp': self.timestamp.timestamp()
+            'timestamp': self.timestamp.replace(tzinfo=timezone.utc).timestamp()
         }
 
-class HumidityData(db.Model):
-    __tablename__ = 'humidity_data'
-    
+
+class SensorRollup(db.Model):
+    """Pre-aggregated sensor values per device, metric, resolution and time bucket"""
+    __tablename__ = 'sensor_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'metric', 'resolution', 'bucket_start', name='uq_sensor_rollups_bucket'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    value = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    
+    device_id = db.Column(db.String(64), nullable=False, default=DEFAULT_DEVICE_ID)
+    metric = db.Column(db.String(32), nullable=False)
+    resolution = db.Column(db.String(4), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum = db.Column(db.Float, nullable=False, default=0.0)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+    first = db.Column(db.Float, nullable=False)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last = db.Column(db.Float, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+
     def __repr__(self):
-        return f'<HumidityData id={self.id} value={self.value} timestamp={self.timestamp}>'
-    
+        return f'<SensorRollup {self.device_id}/{self.metric}/{self.resolution} bucket={self.bucket_start} count={self.count}>'
+
     def to_dict(self):
         return {
-            'id': self.id,
-            'value': self.value,
-            'timestamp': self.timestamp.timestamp()
-        }
\ No newline at end of file
+            'timestamp': self.bucket_start.replace(tzinfo=timezone.utc).timestamp(),
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'avg': self.sum / self.count if self.count else None,
+            'first': self.first,
+            'last': self.last
+        }
+
+
+class SensorStats(db.Model):
+    """Running totals for one device and metric, updated as samples are ingested"""
+    __tablename__ = 'sensor_stats'
+
+    device_id = db.Column(db.String(64), primary_key=True, default=DEFAULT_DEVICE_ID)
+    metric = db.Column(db.String(32), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum = db.Column(db.Float, nullable=False, default=0.0)
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+    first_timestamp = db.Column(db.DateTime)
+    last_timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<SensorStats device={self.device_id} metric={self.metric} count={self.count}>'
@@ -0,0 +1,79 @@
+import sqlalchemy as sa
+from flask_sqlalchemy.session import Session
+
+# Bind key of the read-only connection pool
+READER_BIND = "reader"
+
+
+class RoutingSession(Session):
+    """Session that sends everything to the single writer connection when marked as the writer's,
+    and everything else to the read-only pool
+
+    A session is routed as a whole, so reads inside a write transaction see its own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self.info.get("writer") and READER_BIND in self._db.engines:
+            return self._db.engines[READER_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def is_sqlite_file(uri):
+    """Whether a database URI points to an SQLite file, the only case where separate connections share data"""
+    url = sa.engine.make_url(uri)
+    return (
+        url.get_backend_name() == "sqlite"
+        and url.database not in (None, "", ":memory:")
+        and url.query.get("mode") != "memory"
+    )
+
+
+def storage_options(app):
+    """Split an SQLite file database into a one-connection writer engine and a read-only pool
+
+    Must run before db.init_app. Other databases are left as configured.
+    """
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if not is_sqlite_file(uri):
+        return False
+
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(options, pool_size=1, max_overflow=0)
+    app.config.setdefault("SQLALCHEMY_BINDS", {})[READER_BIND] = dict(
+        options,
+        url=uri,
+        pool_size=app.config["SQLITE_READ_POOL_SIZE"],
+        max_overflow=0
+    )
+    return True
+
+
+def tune_engines(app, db):
+    """Set WAL mode and the connection pragmas on every new SQLite connection
+
+    Must run after db.init_app, before the first connection is opened.
+    """
+    pragmas = [
+        "PRAGMA synchronous = NORMAL",
+        f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_KB'])}",
+        f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        "PRAGMA temp_store = MEMORY"
+    ]
+
+    def listener(extra):
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas + extra:
+                cursor.execute(pragma)
+            cursor.close()
+        return on_connect
+
+    with app.app_context():
+        engines = db.engines
+        if engines[None].dialect.name != "sqlite":
+            return
+        # Readers never block the writer, or each other, in WAL mode
+        writer_pragmas = ["PRAGMA journal_mode = WAL"] if READER_BIND in engines else []
+        sa.event.listen(engines[None], "connect", listener(writer_pragmas))
+        if READER_BIND in engines:
+            sa.event.listen(engines[READER_BIND], "connect", listener(["PRAGMA query_only = ON"]))
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import hmac
+import threading
+from collections import Counter
+import sqlalchemy as sa
+from flask import request, g
+from flask.json.provider import DefaultJSONProvider
+
+# Timing of the request running on this thread; only touched while profiling is enabled
+_request = threading.local()
+
+# MQTT callbacks at least this slow are logged; infinite until profiling is enabled
+_slow_callback_seconds = float("inf")
+
+# One sampling profile at a time per process
+_sampling = threading.Lock()
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, adding the time spent encoding to the running request's serialization time"""
+
+    def dumps(self, obj, **kwargs):
+        if not getattr(_request, "active", False):
+            return super().dumps(obj, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            _request.serialize += time.perf_counter() - started
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["profiling_started"].pop()
+    if getattr(_request, "active", False):
+        _request.db += time.perf_counter() - started
+        _request.queries += 1
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("profiling_started"):
+        context.connection.info["profiling_started"].pop()
+
+
+def _start_request():
+    _request.active = True
+    _request.db = 0.0
+    _request.queries = 0
+    _request.serialize = 0.0
+    g.profiling_started = time.perf_counter()
+
+
+def _finish_request(response, slow_seconds):
+    total = time.perf_counter() - g.profiling_started
+    _request.active = False
+    app_seconds = max(0.0, total - _request.db - _request.serialize)
+    response.headers["Server-Timing"] = (
+        f'db;dur={_request.db * 1000:.2f};desc="{_request.queries} queries", '
+        f"serialize;dur={_request.serialize * 1000:.2f}, app;dur={app_seconds * 1000:.2f}, total;dur={total * 1000:.2f}"
+    )
+    if slow_seconds and total >= slow_seconds:
+        print(f"Slow request {request.method} {request.full_path.rstrip('?')} -> {response.status_code} took {total * 1000:.0f} ms "
+              f"(db {_request.db * 1000:.0f} ms in {_request.queries} queries, serialize {_request.serialize * 1000:.0f} ms, "
+              f"app {app_seconds * 1000:.0f} ms)")
+    return response
+
+
+def install_profiling(app, db):
+    """Time every request by database, JSON serialization and remaining handler time
+
+    Adds a Server-Timing header to each response and logs requests slower than
+    PROFILING_SLOW_REQUEST_MS and MQTT callbacks slower than PROFILING_SLOW_CALLBACK_MS. Nothing
+    is hooked unless PROFILING_ENABLED is set, so a disabled profiler costs nothing per request.
+    Database time covers statement execution as seen by the driver; fetching rows that the
+    statement did not already produce, and building ORM objects from them, count as handler time.
+    """
+    global _slow_callback_seconds
+    if not app.config['PROFILING_ENABLED']:
+        return False
+
+    app.json = TimedJSONProvider(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            sa.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+            sa.event.listen(engine, "handle_error", _handle_error)
+
+    slow_seconds = app.config['PROFILING_SLOW_REQUEST_MS'] / 1000.0
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(response, slow_seconds))
+
+    slow_callback_ms = app.config['PROFILING_SLOW_CALLBACK_MS']
+    _slow_callback_seconds = slow_callback_ms / 1000.0 if slow_callback_ms else float("inf")
+    print(f"Profiling enabled (slow requests from {app.config['PROFILING_SLOW_REQUEST_MS']} ms, slow callbacks from {slow_callback_ms} ms)")
+    return True
+
+
+def observe_callback(name, seconds):
+    """Log an MQTT callback that took at least PROFILING_SLOW_CALLBACK_MS"""
+    if seconds >= _slow_callback_seconds:
+        print(f"Slow MQTT callback for {name} took {seconds * 1000:.1f} ms")
+
+
+def authorized(token):
+    """Whether the request carries the profiling token, as a bearer token or ?token="""
+    if not token:
+        return False
+    header = request.headers.get("Authorization", "")
+    supplied = header[len("Bearer "):] if header.startswith("Bearer ") else request.args.get("token", "")
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(seconds, interval=0.005, thread_filter=None):
+    """Sample the stack of every other thread for a number of seconds and return them in collapsed form
+
+    Each line is "thread;outermost frame;...;innermost frame count", the input format of
+    flamegraph.pl and speedscope. Returns None when another profile is already running.
+    """
+    if not _sampling.acquire(blocking=False):
+        return None
+    try:
+        stacks = Counter()
+        own = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, f"thread-{ident}")
+                if thread_filter and thread_filter not in name:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(name.replace(" ", "_"))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    finally:
+        _sampling.release()
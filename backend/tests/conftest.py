@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import tempfile
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# app.py builds its app on import from the environment: a throwaway database, no broker and no checkpoint
+os.environ.update(
+    DATABASE_URI=f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='iot-tests-'), 'test.db')}",
+    FLASK_DEBUG="false",
+    MQTT_ENABLED="false",
+    STATE_CHECKPOINT_PATH="",
+    INGEST_FLUSH_INTERVAL_MS="20"
+)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app import app
+    return app
+
+
+@pytest.fixture
+def routes(app):
+    from blueprints.mqtt import routes
+    return routes
+
+
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def flush(routes):
+    """Return a function that blocks until every queued row has been committed"""
+    def flush():
+        while routes.ingest_queue.stats()["depth"]:
+            time.sleep(0.005)
+        # Any batch taken before the queue emptied is committed before a task runs
+        routes.ingest_queue.submit(lambda: None).result()
+    return flush
+
+
+@pytest.fixture
+def device(request):
+    """A device id of its own for each test, since the tests share one database"""
+    return f"test-{request.node.name}"[:64]
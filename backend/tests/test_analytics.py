@@ -0,0 +1,63 @@
+import pytest
+from blueprints.mqtt.analytics import SlidingWindow, StreamAnalytics, ThresholdRule, parse_rules
+
+
+def feed(analytics, samples, device="pi", metric="humidity"):
+    for timestamp, value in samples:
+        analytics.add(device, metric, value, timestamp)
+    return [(event["state"], event["timestamp"]) for event in reversed(analytics.events(device))]
+
+
+def test_sliding_window_drops_old_samples_from_the_aggregates():
+    window = SlidingWindow(10)
+    for timestamp, value in [(0, 5.0), (4, 1.0), (8, 3.0), (12, 2.0)]:
+        window.add(timestamp, value)
+    assert window.summary() == {"count": 3, "mean": 2.0, "min": 1.0, "max": 3.0, "rate": 0.125}
+    window.expire(30)
+    assert window.summary()["count"] == 0
+
+
+def test_hovering_at_the_threshold_raises_once_and_clears_below_the_clear_level():
+    rule = ThresholdRule("humid", "humidity", above=70, clear=65)
+    analytics = StreamAnalytics(rules=[rule])
+    events = feed(analytics, [(0, 69.0), (1, 71.0), (2, 69.5), (3, 70.5), (4, 66.0), (5, 64.0), (6, 71.0)])
+    assert events == [("raised", 1), ("cleared", 5), ("raised", 6)]
+    assert analytics.alerts() == [{"rule": "humid", "device_id": "pi", "metric": "humidity", "since": 6}]
+
+
+def test_a_rule_only_raises_once_the_value_stayed_beyond_it_for_long_enough():
+    rule = ThresholdRule("cold", "temperature", below=15, for_seconds=10)
+    analytics = StreamAnalytics(rules=[rule])
+    samples = [(0, 14.0), (5, 14.5), (8, 15.5), (9, 14.0), (18, 14.0), (19, 14.0)]
+    assert feed(analytics, samples, metric="temperature") == [("raised", 19)]
+    assert analytics.events("pi")[0]["since"] == 9
+
+
+def test_rules_only_apply_to_their_devices():
+    rule = ThresholdRule("humid", "humidity", above=70, devices=["kitchen"])
+    analytics = StreamAnalytics(rules=[rule])
+    assert feed(analytics, [(0, 80.0)], device="garage") == []
+    assert feed(analytics, [(0, 80.0)], device="kitchen") == [("raised", 0)]
+
+
+def test_rules_are_parsed_from_json():
+    rules = parse_rules('[{"name": "humid", "metric": "humidity", "above": 70, "clear": 65, "for_seconds": 300},'
+                        ' {"metric": "temperature", "below": 15}]')
+    assert [rule.to_dict() for rule in rules] == [
+        {"name": "humid", "metric": "humidity", "above": 70.0, "clear": 65.0, "for_seconds": 300.0, "devices": None},
+        {"name": "rule2", "metric": "temperature", "below": 15.0, "clear": 15.0, "for_seconds": 0.0, "devices": None}
+    ]
+
+
+@pytest.mark.parametrize("text, message", [
+    ('[{"name": "humid", "metric": "humidity", "above": 70, "for": 300}]', "Rule humid: unknown keys for"),
+    ('[{"metric": "humidity", "abve": 70}]', "Rule rule1: unknown keys abve"),
+    ('[{"name": "humid", "above": 70}]', "Rule humid: metric is required"),
+    ('[{"name": "humid", "metric": "humidity", "above": 70, "below": 10}]', "Rule humid: exactly one"),
+    ('[{"name": "humid", "metric": "humidity", "above": 70, "clear": 75}]', "Rule humid: clear must"),
+    ('[{"name": "humid", "metric": "humidity", "above": "high"}]', "Rule humid: above, below"),
+    ('["humid"]', "Rule rule1: must be an object")
+])
+def test_invalid_rules_are_reported_by_name(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_rules(text)
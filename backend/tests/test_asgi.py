@@ -0,0 +1,122 @@
+import json
+import time
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def asgi(app):
+    import asgi
+    return asgi
+
+
+def request(path, query=""):
+    return {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "root_path": "",
+            "query_string": query.encode(), "headers": [(b"host", b"test")], "scheme": "http",
+            "server": ("test", 80), "client": ("test", 1234), "http_version": "1.1", "asgi": {"version": "3.0"}}
+
+
+async def call(asgi, scope, until=None):
+    """Run one request; the client disconnects once a body chunk contains until"""
+    messages = []
+    disconnect = asyncio.Event()
+
+    async def receive():
+        if not hasattr(receive, "sent"):
+            receive.sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if until is not None and until.encode() in message.get("body", b""):
+            disconnect.set()
+
+    await asyncio.wait_for(asgi.app(scope, receive, send), 5)
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return messages[0]["status"], body
+
+
+def test_snapshot_long_poll_times_out_with_the_current_snapshot(asgi, routes):
+    since = routes.latest_state.version
+    started = time.perf_counter()
+    status, body = asyncio.run(call(asgi, request("/api/mqtt/snapshot", f"since={since}&timeout=0.2")))
+    assert status == 200
+    assert time.perf_counter() - started >= 0.2
+    assert json.loads(body) == json.loads(json.dumps(routes.snapshot_payload("default")))
+
+
+def test_snapshot_long_poll_returns_on_an_update(asgi, routes, device):
+    since = routes.latest_state.version
+
+    async def poll():
+        waiting = asyncio.create_task(call(asgi, request("/api/mqtt/snapshot", f"since={since}&timeout=5&device_id={device}")))
+        await asyncio.sleep(0.1)
+        routes.latest_state.update(device, "light", state="on", timestamp=time.time())
+        return await waiting
+
+    status, body = asyncio.run(poll())
+    assert status == 200
+    assert json.loads(body)["light"]["state"] == "on"
+
+
+def test_stream_sends_the_state_and_then_updates(asgi, routes, device):
+    routes.latest_state.update(device, "temperature", value=20.0, timestamp=time.time())
+
+    async def stream():
+        reading = asyncio.create_task(call(asgi, request("/api/mqtt/stream", f"devices={device}&topics=temperature"), until="21.5"))
+        await asyncio.sleep(0.1)
+        routes.latest_state.update(device, "temperature", value=21.5, timestamp=time.time())
+        return await reading
+
+    status, body = asyncio.run(stream())
+    assert status == 200
+    events = [event for event in body.decode().split("\n\n") if event.startswith("event:")]
+    assert [json.loads(event.split("data: ", 1)[1])["temperature"] for event in events] == [20.0, 21.5]
+
+
+def test_other_routes_are_served_by_flask(asgi):
+    status, body = asyncio.run(call(asgi, request("/api/mqtt/status")))
+    assert status == 200
+    assert "connected" in json.loads(body)
+
+
+def test_a_client_created_after_startup_is_driven_by_the_event_loop(asgi, routes, monkeypatch):
+    started = []
+
+    class FakeLoop:
+        def __init__(self, client, host, port):
+            self.client = client
+
+        async def run(self):
+            started.append(self.client)
+            await asyncio.Event().wait()
+
+    monkeypatch.setattr(asgi, "AsyncioMqttLoop", FakeLoop)
+    monkeypatch.setattr(routes, "client", None)
+
+    async def serve():
+        messages = asyncio.Queue()
+        await messages.put({"type": "lifespan.startup"})
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        lifespan = asyncio.create_task(asgi.app({"type": "lifespan"}, messages.get, send))
+        await asyncio.sleep(0.05)
+        # As on a worker elected leader later: the client is created on the election thread
+        client = object()
+        await asyncio.to_thread(routes.mqtt_loop_hook, client)
+        await asyncio.to_thread(routes.mqtt_loop_hook, client)
+        await asyncio.sleep(0.05)
+        await messages.put({"type": "lifespan.shutdown"})
+        await lifespan
+        return client, sent
+
+    client, sent = asyncio.run(serve())
+    assert started == [client]
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert routes.mqtt_loop_hook is None
+    asgi.mqtt_tasks.clear()
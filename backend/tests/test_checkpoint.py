@@ -0,0 +1,36 @@
+from blueprints.mqtt.checkpoint import StateCheckpoint
+from blueprints.mqtt.state import LatestStateStore
+
+
+def test_state_is_restored_with_its_versions(tmp_path):
+    path = str(tmp_path / "state.json")
+    store = LatestStateStore()
+    store.update("pi", "light", state="on", timestamp=1.0)
+    store.update("pi", "temperature", value=21.5, timestamp=2.0)
+    checkpoint = StateCheckpoint(path, store)
+    assert checkpoint.save()
+    # Nothing changed since, so nothing is written
+    assert not checkpoint.save()
+
+    restored = LatestStateStore()
+    assert StateCheckpoint(path, restored).restore() == 2
+    assert restored.get("pi", "light")["state"] == "on"
+    assert restored.get("pi", "temperature")["value"] == 21.5
+    # New updates are numbered after everything saved
+    assert restored.update("pi", "light", state="off", timestamp=3.0)["version"] > store.version
+
+
+def test_a_store_with_state_is_not_overwritten(tmp_path):
+    path = str(tmp_path / "state.json")
+    saved = LatestStateStore()
+    saved.update("pi", "light", state="on", timestamp=1.0)
+    StateCheckpoint(path, saved).save()
+
+    live = LatestStateStore()
+    live.update("pi", "light", state="off", timestamp=2.0)
+    assert StateCheckpoint(path, live).restore() == 0
+    assert live.get("pi", "light")["state"] == "off"
+
+
+def test_missing_checkpoint_restores_nothing(tmp_path):
+    assert StateCheckpoint(str(tmp_path / "none.json"), LatestStateStore()).restore() == 0
@@ -0,0 +1,81 @@
+import pytest
+from blueprints.mqtt import sharedstate
+from blueprints.mqtt.cluster import Cluster
+from blueprints.mqtt.sharedstate import SharedSegment, SharedStateStore, U64
+
+# Arguments for every operation a follower forwards to the leader
+OP_ARGS = {
+    "queue_command": {"device_id": "default", "kind": "light", "payload": "on", "state": {"state": "on"}},
+    "command_stats": {},
+    "command_trace": {"command_id": 1, "wait": 0.0},
+    "mqtt_status": {},
+    "retention_stats": {},
+    "retention_run": {},
+    "analytics_series": {"device_id": None, "metric": None},
+    "analytics_events": {"device_id": None, "limit": 10},
+    "publish_message": {"topic": "test", "value": "1"},
+    "stats_rebuild": {}
+}
+
+
+@pytest.fixture(scope="module")
+def cluster(app, tmp_path_factory):
+    """A leader serving the app's operations on its control socket, and a follower calling it"""
+    from blueprints.mqtt import routes
+    directory = str(tmp_path_factory.mktemp("cluster"))
+    elected = []
+    leader = Cluster(directory, routes.leader_ops, on_elected=lambda: elected.append(True), app=app)
+    leader.start()
+    assert elected
+    follower = Cluster(directory, routes.leader_ops, on_elected=None, app=app)
+    yield follower
+    leader._server.shutdown()
+    leader._server.server_close()
+
+
+def test_every_leader_op_is_covered(routes):
+    assert set(OP_ARGS) == set(routes.leader_ops)
+
+
+@pytest.mark.parametrize("op", sorted(OP_ARGS))
+def test_forwarded_ops_run_in_the_leader_app_context(cluster, op):
+    payload, status = cluster.call(op, OP_ARGS[op])
+    # Without MQTT or retention some ops report 503 or 404, but none may fail outright
+    assert status in (200, 404, 503), payload
+
+
+def test_forwarded_stats_rebuild_returns_the_stats(cluster, routes, app):
+    payload, status = cluster.call("stats_rebuild")
+    assert status == 200
+    with app.app_context():
+        assert payload == routes.get_stats()
+
+
+def test_a_slot_left_mid_write_is_skipped_by_readers_and_repaired_by_the_next_leader(tmp_path, monkeypatch):
+    segment = SharedSegment(str(tmp_path / "state.shm"), slots=8, log_size=8)
+    store = SharedStateStore(segment)
+    store.writable = True
+    store.update("pi", "temperature", value=20.0, timestamp=1.0)
+    store.update("pi", "humidity", value=40.0, timestamp=1.0)
+    # The leader died between making the counters odd and writing the slots
+    torn, taken = store.used_slots()[0], (store.used_slots()[1] + 1) % 8
+    offset = store._slot_offset(torn)
+    segment.write_u64(offset, segment.read_u64(offset) + 1)
+    segment.write_u64(store._slot_offset(taken), 1)
+    data = offset + sharedstate.SLOT_HEADER.size + sharedstate.KEY_SIZE
+    segment.mm[data:data + 8] = b"{\"valu\x00\x00"
+    monkeypatch.setattr(sharedstate, "READ_ATTEMPTS", 10)
+
+    follower = SharedStateStore(segment)
+    assert follower.read_slot(torn) is None
+    assert follower.get("pi", "humidity")["value"] == 40.0
+
+    leader = SharedStateStore(segment)
+    assert leader.recover() == 2
+    leader.writable = True
+    assert leader.get("pi", "temperature") is None
+    assert leader.devices() == {"pi": {"humidity": leader.get("pi", "humidity")}}
+    leader.update("pi", "temperature", value=21.0, timestamp=2.0)
+    assert leader.used_slots()[0] == torn
+    assert len(leader.used_slots()) == 2
+    assert U64.unpack_from(segment.mm, store._slot_offset(taken))[0] % 2 == 0
@@ -0,0 +1,48 @@
+import gzip
+import time
+import pytest
+from blueprints.mqtt.columnar import COLUMNAR_MIMETYPE, HEADER, encode_columnar, decode_columnar
+
+
+def test_columns_round_trip():
+    timestamps = [1700000000.125, 1700000001.5, 1700000002.0]
+    values = [21.5, -3.25, 1e6]
+    payload = encode_columnar(timestamps, values)
+    assert len(payload) == HEADER.size + 12 * len(timestamps)
+    decoded_timestamps, decoded_values = decode_columnar(payload)
+    # Timestamps keep float64 precision, values are float32
+    assert list(decoded_timestamps) == timestamps
+    assert list(decoded_values) == values
+
+
+def test_an_empty_history_round_trips():
+    assert [list(column) for column in decode_columnar(encode_columnar([], []))] == [[], []]
+
+
+def test_other_payloads_are_rejected():
+    with pytest.raises(ValueError):
+        decode_columnar(b"JSON" + bytes(HEADER.size))
+
+
+@pytest.fixture
+def history(routes, flush, device):
+    now = time.time()
+    samples = [(20.0 + index / 4, now - 300 + index) for index in range(300)]
+    routes.ingest_queue.put_many([(device, "temperature", value, timestamp) for value, timestamp in samples])
+    flush()
+    return samples
+
+
+def test_history_is_served_as_columns_with_gzip_and_etag(client, history, device):
+    url = f"/api/mqtt/temperature/history?device_id={device}&limit=300"
+    response = client.get(url, headers={"Accept": COLUMNAR_MIMETYPE, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.mimetype == COLUMNAR_MIMETYPE
+    assert response.headers["Content-Encoding"] == "gzip"
+    timestamps, values = decode_columnar(gzip.decompress(response.data))
+    assert list(values) == [value for value, _ in reversed(history)]
+    assert list(timestamps) == pytest.approx([timestamp for _, timestamp in reversed(history)], abs=0.001)
+
+    # ?format=columnar asks for the same body
+    same = client.get(url + "&format=columnar", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert same.status_code == 304
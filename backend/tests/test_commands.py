@@ -0,0 +1,80 @@
+import time
+import threading
+import pytest
+from blueprints.mqtt.commands import CommandTracker, split_command_id
+
+
+def ack(command_id, delay=0.0):
+    now = time.time()
+    return {"command_id": command_id, "received_at": now, "actuated_at": now + delay, "sent_at": now + delay}
+
+
+def test_traced_command_is_acknowledged_with_stage_latencies():
+    tracker = CommandTracker()
+    tracker.queued(1, "pi", "light", "on")
+    tracker.published(1, traced=True)
+    assert tracker.get(1)["status"] == "published"
+
+    record = tracker.acknowledged("pi", ack(1, delay=0.01), time.time())
+    assert record["status"] == "acknowledged"
+    assert record["latency_ms"]["device_to_actuated"] == pytest.approx(10, abs=0.01)
+    # Another device cannot acknowledge it, nor can it be acknowledged twice
+    assert tracker.acknowledged("other", ack(1), time.time()) is None
+    assert tracker.acknowledged("pi", ack(1), time.time()) is None
+
+
+def test_newer_commands_coalesce_and_supersede_older_ones():
+    tracker = CommandTracker()
+    for command_id in (1, 2, 3):
+        tracker.queued(command_id, "pi", "motion", f"left {command_id}")
+    tracker.published(2, traced=True)
+    assert tracker.get(1)["status"] == "coalesced"
+    assert tracker.get(1)["replaced_by"] == 2
+
+    tracker.published(3, traced=True)
+    tracker.acknowledged("pi", ack(3), time.time())
+    assert tracker.get(2)["status"] == "superseded"
+    assert tracker.stats()["statuses"] == {"coalesced": 1, "superseded": 1, "acknowledged": 1}
+
+
+def test_untraced_command_that_fails_to_publish_is_dropped():
+    tracker = CommandTracker()
+    tracker.queued(1, "pi", "light", "on")
+    tracker.published(1, traced=False)
+    done = []
+    waiter = threading.Thread(target=lambda: done.append(tracker.wait(1, 5)))
+    waiter.start()
+
+    # publish_command marks it published before handing it to the client, which then fails
+    tracker.dropped(1)
+    waiter.join(5)
+    assert done and done[0]["status"] in ("published", "dropped")
+    assert tracker.get(1)["status"] == "dropped"
+    # The device's open commands are still consistent
+    tracker.queued(2, "pi", "light", "off")
+    tracker.published(2, traced=True)
+    assert tracker.acknowledged("pi", ack(2), time.time())["status"] == "acknowledged"
+
+
+def test_waiting_for_a_dropped_traced_command_returns_at_once():
+    tracker = CommandTracker()
+    tracker.queued(1, "pi", "light", "on")
+    tracker.published(1, traced=True)
+    threading.Timer(0.05, tracker.dropped, (1,)).start()
+    started = time.monotonic()
+    assert tracker.wait(1, 5)["status"] == "dropped"
+    assert time.monotonic() - started < 1
+
+
+def test_oldest_commands_are_forgotten():
+    tracker = CommandTracker(max_commands=2)
+    for command_id in (1, 2, 3):
+        tracker.queued(command_id, "pi", "light", "on")
+    assert tracker.get(1) is None
+    tracker.published(3, traced=True)
+    assert tracker.get(2)["status"] == "coalesced"
+
+
+def test_split_command_id():
+    assert split_command_id("left 45 #12") == ("left 45", 12)
+    assert split_command_id("on") == ("on", None)
@@ -0,0 +1,51 @@
+import json
+import time
+from blueprints.mqtt.events import EventBus, Subscriber
+
+
+def test_undelivered_updates_are_replaced_by_newer_ones():
+    subscriber = Subscriber()
+    subscriber.offer("pi", "light", {"state": "on"})
+    subscriber.offer("pi", "motion", {"angle": 10})
+    subscriber.offer("pi", "light", {"state": "off"})
+    assert subscriber.wait(0) == [(("pi", "motion"), {"angle": 10}), (("pi", "light"), {"state": "off"})]
+    assert subscriber.coalesced == 1
+    assert subscriber.wait(0.01) == []
+
+
+def test_the_bus_only_delivers_what_a_subscriber_asked_for():
+    bus = EventBus()
+    lights = bus.subscribe(topics=["light"])
+    kitchen = bus.subscribe(devices=["kitchen"])
+    bus.publish("light", {"state": "on"}, "garage")
+    bus.publish("temperature", {"temperature": 21.0}, "kitchen")
+    assert lights.wait(0) == [(("garage", "light"), {"state": "on"})]
+    assert kitchen.wait(0) == [(("kitchen", "temperature"), {"temperature": 21.0})]
+
+    bus.unsubscribe(lights)
+    assert lights.wait(1) is None
+    assert bus.stats() == {"subscribers": 1, "published": 2, "coalesced": 0}
+
+
+def test_stream_starts_with_the_state_and_pushes_changes(routes, client, device):
+    routes.latest_state.update(device, "light", state="on", timestamp=time.time())
+    subscribers = routes.event_bus.stats()["subscribers"]
+    response = client.get(f"/api/mqtt/stream?topics=light&devices={device}", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = response.iter_encoded()
+    assert next(chunks) == b"retry: 2000\n\n"
+    assert json.loads(next(chunks).decode().split("data: ", 1)[1])["state"] == "on"
+
+    routes.latest_state.update(device, "light", state="off", timestamp=time.time())
+    event, data = next(chunks).decode().strip().split("\n")
+    assert event == "event: light"
+    payload = json.loads(data[len("data: "):])
+    assert (payload["state"], payload["device_id"]) == ("off", device)
+
+    response.close()
+    assert routes.event_bus.stats()["subscribers"] == subscribers
+
+
+def test_stream_rejects_unknown_topics(client):
+    response = client.get("/api/mqtt/stream?topics=light,smell")
+    assert response.status_code == 400
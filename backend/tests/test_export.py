@@ -0,0 +1,59 @@
+import json
+import time
+import pytest
+
+
+@pytest.fixture
+def readings(routes, flush, device):
+    """Seven readings a second apart, two of them sharing a timestamp"""
+    now = time.time() - 60
+    timestamps = [now, now + 1, now + 2, now + 2, now + 3, now + 4, now + 5]
+    routes.ingest_queue.put_many([(device, "temperature", float(value), timestamp) for value, timestamp in enumerate(timestamps)])
+    flush()
+    return timestamps
+
+
+def export(client, device, **args):
+    response = client.get("/api/mqtt/export", query_string=dict(metric="temperature", device_id=device, **args))
+    assert response.status_code == 200
+    return response.get_data(as_text=True).splitlines()
+
+
+def test_pages_follow_each_other_without_gaps_or_repeats(client, readings, device):
+    values, cursor, pages = [], None, 0
+    while True:
+        lines = export(client, device, limit=3, **({"cursor": cursor} if cursor else {}))
+        rows = [json.loads(line) for line in lines]
+        pages += 1
+        cursor = rows.pop().get("next_cursor") if "next_cursor" in rows[-1] else None
+        values += [row["value"] for row in rows]
+        if cursor is None:
+            break
+    assert values == [float(value) for value in range(7)]
+    assert pages == 3
+
+
+def test_cursor_follows_the_last_row_streamed_while_readings_arrive(client, routes, flush, readings, device):
+    first = [json.loads(line) for line in export(client, device, limit=2)]
+    # A late reading lands inside the first page's range before the next page is asked for
+    routes.ingest_queue.put(device, "temperature", 99.0, readings[0] + 0.5)
+    flush()
+    second = [json.loads(line) for line in export(client, device, limit=2, cursor=first[-1]["next_cursor"])]
+    assert [row["value"] for row in first[:-1]] == [0.0, 1.0]
+    assert [row["value"] for row in second[:-1]] == [2.0, 3.0]
+
+
+def test_csv_pages_end_with_a_cursor_comment(client, readings, device):
+    lines = export(client, device, format="csv", limit=6)
+    assert lines[0] == "id,device_id,metric,value,timestamp"
+    assert len(lines) == 8
+    assert lines[-1].startswith("# next_cursor: ")
+    rest = export(client, device, format="csv", limit=6, cursor=lines[-1].split(": ", 1)[1])
+    assert len(rest) == 2
+    assert float(rest[1].split(",")[4]) == pytest.approx(readings[-1], abs=0.001)
+
+
+def test_an_export_without_limit_has_no_cursor(client, readings, device):
+    lines = export(client, device)
+    assert len(lines) == 7
+    assert json.loads(lines[0])["timestamp"] == pytest.approx(readings[0], abs=0.001)
@@ -0,0 +1,46 @@
+import time
+from datetime import datetime
+import pytest
+from models import db, SensorReading
+from blueprints.mqtt.columnar import COLUMNAR_MIMETYPE, decode_columnar
+
+
+@pytest.fixture
+def local_time(monkeypatch):
+    """Run the test in a time zone away from UTC, where naive datetimes read as local time would be off"""
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def store_directly(routes, device_id, samples):
+    """Insert rows behind the hot cache's back, so history has to be read from the database"""
+    def insert():
+        db.session.add_all(SensorReading(device_id=device_id, metric="temperature", value=value,
+                                         timestamp=datetime.utcfromtimestamp(timestamp))
+                           for value, timestamp in samples)
+        db.session.commit()
+    routes.ingest_queue.submit(insert).result()
+
+
+def test_database_and_hot_cache_history_agree_on_timestamps(routes, client, flush, device, local_time):
+    now = round(time.time(), 3)
+    samples = [(20.0, now - 2), (21.0, now - 1)]
+    store_directly(routes, f"{device}-db", samples)
+    routes.ingest_queue.put_many([(f"{device}-hot", "temperature", value, timestamp) for value, timestamp in samples])
+    flush()
+
+    expected = [timestamp for _, timestamp in reversed(samples)]
+    hits = routes.hot_cache.hits
+    for source in ("db", "hot"):
+        url = f"/api/mqtt/temperature/history?device_id={device}-{source}&limit=2"
+        data = client.get(url).get_json()["data"]
+        assert [row["timestamp"] for row in data] == pytest.approx(expected)
+
+        timestamps, values = decode_columnar(client.get(url, headers={"Accept": COLUMNAR_MIMETYPE}).data)
+        assert list(timestamps) == pytest.approx(expected)
+        assert list(values) == [21.0, 20.0]
+    # The hot cache answered the second device only
+    assert routes.hot_cache.hits == hits + 2
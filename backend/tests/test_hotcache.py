@@ -0,0 +1,39 @@
+import time
+from blueprints.mqtt.hotcache import HotCache
+
+
+def test_window_is_answered_only_when_complete():
+    cache = HotCache(capacity=3, max_series=4)
+    cache.add("d", "temperature", [(1, 20.0, 100.0), (2, 21.0, 101.0)])
+    # Nothing before the first sample is known to be held
+    assert cache.query("d", "temperature", start_time=99.0, limit=10) is None
+    assert cache.query("d", "temperature", start_time=100.5, limit=10) == [(2, 101.0, 21.0)]
+
+    cache.add("d", "temperature", [(3, 22.0, 102.0), (4, 23.0, 103.0)])
+    # Evicting the oldest sample moves the complete bound up to it
+    assert cache.query("d", "temperature", start_time=100.0, limit=10) is None
+    assert len(cache.query("d", "temperature", start_time=100.5, limit=10)) == 3
+    assert [row[0] for row in cache.query("d", "temperature", limit=2)] == [4, 3]
+
+
+def test_trim_drops_samples_before_the_cutoff():
+    cache = HotCache(capacity=5)
+    cache.add("d", "temperature", [(i, float(i), 100.0 + i) for i in range(4)])
+    cache.trim(102.0)
+    assert [row[0] for row in cache.query("d", "temperature", start_time=100.5, limit=10)] == [3, 2]
+
+
+def test_a_new_leader_preloads_a_fresh_hot_cache_that_commits_keep_current(app, routes, flush, device):
+    now = time.time()
+    routes.ingest_queue.put_many([(device, "temperature", 20.0 + i, now - 10 + i) for i in range(3)])
+    flush()
+
+    # What become_leader does on a promoted follower
+    previous = routes.hot_cache
+    routes.build_hot_cache(app)
+    assert routes.hot_cache is not previous
+    assert [row[2] for row in routes.hot_cache.query(device, "temperature", limit=3)] == [22.0, 21.0, 20.0]
+
+    routes.ingest_queue.put(device, "temperature", 30.0, now)
+    flush()
+    assert [row[2] for row in routes.hot_cache.query(device, "temperature", limit=2)] == [30.0, 22.0]
@@ -0,0 +1,59 @@
+import time
+from models import db, SensorReading, SensorStats
+from blueprints.mqtt.ingest import IngestQueue
+
+
+def stored(app, device_id, metric="temperature"):
+    with app.app_context():
+        rows = SensorReading.query.filter_by(device_id=device_id, metric=metric).order_by(SensorReading.timestamp).all()
+        return [row.value for row in rows]
+
+
+def test_queued_rows_are_committed_with_their_stats(app, routes, flush, device):
+    now = time.time()
+    routes.ingest_queue.put_many([(device, "temperature", 20.0 + i, now - 10 + i) for i in range(5)])
+    flush()
+
+    assert stored(app, device) == [20.0, 21.0, 22.0, 23.0, 24.0]
+    with app.app_context():
+        stats = db.session.get(SensorStats, (device, "temperature"))
+        assert stats.count == 5
+        assert stats.sum == 110.0
+
+
+def test_non_finite_readings_are_rejected(app, routes, flush, device):
+    now = time.time()
+    assert routes.handle_sensor("temperature", device, "21.5", now - 1) is None
+    for payload in ("nan", "inf", "-Infinity"):
+        assert routes.handle_sensor("temperature", device, payload, now) is False
+    flush()
+
+    assert routes.latest_state.get(device, "temperature")["value"] == 21.5
+    assert stored(app, device) == [21.5]
+
+
+def test_a_bad_row_does_not_cost_the_rest_of_the_batch(app, routes, flush, device):
+    now = time.time()
+    failed = routes.ingest_queue.failed
+    rows = [(f"{device}-{i}", "temperature", 20.0 + i, now) for i in range(7)]
+    # NaN is stored as NULL, which the NOT NULL constraint rejects
+    rows.insert(3, (device, "temperature", float("nan"), now))
+    routes.ingest_queue.put_many(rows)
+    flush()
+
+    assert routes.ingest_queue.failed == failed + 1
+    for i in range(7):
+        assert stored(app, f"{device}-{i}") == [20.0 + i]
+        # The committed rows still reach the hot cache
+        assert routes.hot_cache.query(f"{device}-{i}", "temperature", limit=1)[0][2] == 20.0 + i
+
+
+def test_overflow_policies():
+    newest = IngestQueue(max_size=2, overflow_policy="drop_newest")
+    assert [newest.put("d", "temperature", value, value) for value in (1.0, 2.0, 3.0)] == [True, True, False]
+    assert [row[2] for row in newest._rows] == [1.0, 2.0]
+
+    oldest = IngestQueue(max_size=2, overflow_policy="drop_oldest")
+    assert oldest.put_many([("d", "temperature", value, value) for value in (1.0, 2.0, 3.0)]) == 3
+    assert [row[2] for row in oldest._rows] == [2.0, 3.0]
+    assert oldest.dropped == 1
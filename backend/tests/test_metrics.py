@@ -0,0 +1,36 @@
+import gc
+import threading
+from metrics import Counter, Histogram
+
+
+def run_threads(count, target):
+    for _ in range(count):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+
+def test_cells_of_finished_threads_are_folded_into_the_total():
+    counter = Counter("test_requests_total", "Requests", register=False)
+    histogram = Histogram("test_duration_seconds", "Durations", buckets=(0.1, 1.0), register=False)
+
+    def request():
+        counter.inc()
+        histogram.observe(0.5)
+    run_threads(200, request)
+    counter.inc(2)
+
+    child = counter.labels()
+    assert child.value() == 202
+    assert histogram.labels().totals() == [0, 200, 0, 100.0, 200]
+    # Only this thread's cell is left once the totals were read
+    assert len(child._cells._cells) == 1
+    assert len(histogram.labels()._cells._cells) == 0
+
+
+def test_labelled_counter_renders_every_child():
+    counter = Counter("test_messages_total", "Messages", ["topic"], register=False)
+    run_threads(3, lambda: counter.labels("a").inc())
+    counter.labels("b").inc(5)
+    assert sorted(counter.samples()) == ['test_messages_total{topic="a"} 3', 'test_messages_total{topic="b"} 5']
@@ -0,0 +1,76 @@
+import threading
+import pytest
+from flask import Flask
+from models import db, SensorReading, SensorRollup, use_writer_session
+from models.storage import storage_options
+from blueprints.mqtt.migrations import migrate_schema
+from blueprints.mqtt.cluster import startup_lock
+
+LEGACY_ROWS = {
+    "temperature_data": [(20.0, "2024-01-01 00:00:10.000000"), (21.0, "2024-01-01 00:00:40.000000"), (23.0, "2024-01-01 00:01:10.000000")],
+    "humidity_data": [(40.0, "2024-01-01 00:00:20.000000")]
+}
+
+
+@pytest.fixture
+def legacy_app(app, tmp_path):
+    """A second app on a database with per-metric tables and rollups without device ids"""
+    legacy = Flask("legacy")
+    legacy.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'legacy.db'}", SQLALCHEMY_ENGINE_OPTIONS={},
+                         SQLITE_READ_POOL_SIZE=2)
+    storage_options(legacy)
+    db.init_app(legacy)
+    with legacy.app_context():
+        use_writer_session()
+        for table, rows in LEGACY_ROWS.items():
+            db.session.execute(db.text(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, value FLOAT NOT NULL, timestamp DATETIME NOT NULL)"))
+            for value, timestamp in rows:
+                db.session.execute(db.text(f"INSERT INTO {table} (value, timestamp) VALUES (:value, :timestamp)"),
+                                   {"value": value, "timestamp": timestamp})
+        db.session.execute(db.text("CREATE TABLE sensor_rollups (id INTEGER PRIMARY KEY, metric VARCHAR(32), bucket_start DATETIME)"))
+        db.session.commit()
+    return legacy
+
+
+def test_legacy_tables_are_moved_into_sensor_readings_and_dropped(legacy_app):
+    with legacy_app.app_context():
+        use_writer_session()
+        assert migrate_schema() is True
+
+        tables = set(db.session.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars())
+        assert not tables & set(LEGACY_ROWS)
+        rows = SensorReading.query.order_by(SensorReading.id).all()
+        assert [(row.device_id, row.metric, row.value) for row in rows] == [
+            ("default", "temperature", 20.0), ("default", "temperature", 21.0), ("default", "temperature", 23.0),
+            ("default", "humidity", 40.0)
+        ]
+        assert rows[0].to_dict()["timestamp"] == 1704067210.0
+
+        # The outdated rollups were dropped and rebuilt from the moved rows
+        minutes = SensorRollup.query.filter_by(metric="temperature", resolution="1m").order_by(SensorRollup.bucket_start).all()
+        assert [(rollup.count, rollup.min, rollup.max) for rollup in minutes] == [(2, 20.0, 21.0), (1, 23.0, 23.0)]
+
+    # Nothing left to do on the next startup
+    with legacy_app.app_context():
+        use_writer_session()
+        assert migrate_schema() is False
+        assert SensorReading.query.count() == 4
+
+
+def test_workers_starting_together_migrate_once(legacy_app, tmp_path):
+    results = []
+
+    def start_worker():
+        with legacy_app.app_context(), startup_lock(str(tmp_path / "cluster")) as first:
+            use_writer_session()
+            results.append((first, migrate_schema()))
+
+    workers = [threading.Thread(target=start_worker) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert results == [(True, True), (False, False)]
+    with legacy_app.app_context():
+        assert SensorReading.query.count() == 4
@@ -0,0 +1,60 @@
+import threading
+from flask import Flask, jsonify
+from models import db, SensorReading
+from models.storage import storage_options
+from profiling import install_profiling, sample_stacks
+
+
+def test_requests_get_a_server_timing_breakdown(tmp_path):
+    profiled = Flask("profiled")
+    profiled.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'profiled.db'}", SQLALCHEMY_ENGINE_OPTIONS={},
+                           SQLITE_READ_POOL_SIZE=2, PROFILING_ENABLED=True, PROFILING_SLOW_REQUEST_MS=0,
+                           PROFILING_SLOW_CALLBACK_MS=0)
+    storage_options(profiled)
+    db.init_app(profiled)
+    with profiled.app_context():
+        db.create_all()
+    assert install_profiling(profiled, db)
+
+    @profiled.route("/readings")
+    def readings():
+        return jsonify([reading.to_dict() for reading in SensorReading.query.limit(10).all()])
+
+    response = profiled.test_client().get("/readings")
+    timing = dict(part.split(";", 1) for part in response.headers["Server-Timing"].split(", "))
+    assert set(timing) == {"db", "serialize", "app", "total"}
+    assert 'desc="1 queries"' in timing["db"]
+
+
+def test_disabled_profiling_hooks_nothing(app, client):
+    assert not app.config['PROFILING_ENABLED']
+    assert "Server-Timing" not in client.get("/api/mqtt/status").headers
+
+
+def test_sampling_names_the_thread_and_its_frames():
+    stop = threading.Event()
+
+    def wait_for_stop():
+        stop.wait()
+
+    worker = threading.Thread(target=wait_for_stop, name="sampled worker")
+    worker.start()
+    try:
+        stacks = sample_stacks(0.05, interval=0.01, thread_filter="sampled")
+    finally:
+        stop.set()
+        worker.join()
+    lines = stacks.splitlines()
+    assert lines and all(line.startswith("sampled_worker;") for line in lines)
+    assert "test_profiling.py:wait_for_stop" in lines[0]
+    assert int(lines[0].rsplit(" ", 1)[1]) >= 1
+
+
+def test_profile_endpoint_needs_the_token(app, client, monkeypatch):
+    assert client.get("/debug/profile").status_code == 404
+    monkeypatch.setitem(app.config, "PROFILING_TOKEN", "secret")
+    assert client.get("/debug/profile?seconds=0.1").status_code == 403
+    response = client.get("/debug/profile?seconds=0.1", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    # Every thread of the process is sampled, the database writer included
+    assert any(line.startswith("ingest-writer;") for line in response.get_data(as_text=True).splitlines())
@@ -0,0 +1,54 @@
+import time
+from blueprints.mqtt.resultcache import ResultCache
+
+
+def test_only_entries_whose_range_holds_a_new_sample_are_dropped():
+    cache = ResultCache(max_bytes=10000)
+    cache.put("past", b"x", 1, ("d", "temperature"), low=0, high=100)
+    cache.put("latest", b"y", 1, ("d", "temperature"), low=100, high=float("inf"))
+    cache.put("other", b"z", 1, ("e", "temperature"), low=0, high=float("inf"))
+
+    cache.invalidate(("d", "temperature"), [150.0])
+    assert cache.get("past") == b"x"
+    assert cache.get("latest") is None
+    assert cache.get("other") == b"z"
+
+
+def test_a_result_computed_across_an_invalidation_is_not_cached():
+    cache = ResultCache(max_bytes=10000)
+    generation = cache.generation("s")
+    cache.invalidate("s", [1.0])
+    cache.put("key", b"stale", 5, "s", generation=generation)
+    assert cache.get("key") is None
+
+
+def test_entries_are_evicted_least_recently_used_first():
+    cache = ResultCache(max_bytes=3 * (100 + 256))
+    for key in ("a", "b", "c"):
+        cache.put(key, key, 100, "s")
+    cache.get("a")
+    cache.put("d", "d", 100, "s")
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in ("a", "c", "d")] == ["a", "c", "d"]
+    assert cache.evictions == 1
+
+
+def test_committed_samples_invalidate_cached_history_and_stats(routes, client, flush, device):
+    now = time.time()
+    routes.ingest_queue.put_many([(device, "temperature", 20.0, now - 100)])
+    flush()
+
+    latest = f"/api/mqtt/temperature/history?device_id={device}&limit=10"
+    past = f"/api/mqtt/temperature/history?device_id={device}&end_time={now - 50}"
+    assert client.get(latest).get_json()["count"] == 1
+    assert client.get(past).get_json()["count"] == 1
+    stats = client.get("/api/mqtt/stats").get_json()
+    hits = routes.result_cache.hits
+
+    routes.ingest_queue.put(device, "temperature", 21.0, now)
+    flush()
+    assert client.get(latest).get_json()["count"] == 2
+    # A closed window the new sample is not in stays cached
+    assert client.get(past).get_json()["count"] == 1
+    assert routes.result_cache.hits == hits + 1
+    assert client.get("/api/mqtt/stats").get_json() != stats
@@ -0,0 +1,24 @@
+import time
+from blueprints.mqtt.retention import RetentionWorker
+
+
+def test_pruned_readings_leave_the_hot_cache_and_cached_results(routes, client, flush, device):
+    now = time.time()
+    old = [(device, "temperature", 10.0 + i, now - 3 * 86400 + i) for i in range(5)]
+    recent = [(device, "temperature", 20.0 + i, now - 60 + i) for i in range(3)]
+    routes.ingest_queue.put_many(old + recent)
+    flush()
+
+    # Starts after the oldest row, so the hot cache can answer it
+    url = f"/api/mqtt/temperature/history?device_id={device}&start_time={now - 3 * 86400 + 0.5}"
+    assert client.get(url).get_json()["count"] == 7
+    hits = routes.hot_cache.hits
+    assert hits
+
+    worker = RetentionWorker(routes.ingest_queue, raw_days=1, on_pruned=routes.clear_pruned)
+    assert worker.run_once()["raw_rows_pruned"] == 5
+
+    data = client.get(url).get_json()["data"]
+    assert [row["value"] for row in data] == [22.0, 21.0, 20.0]
+    # Still answered from the hot cache, which no longer holds the deleted rows
+    assert routes.hot_cache.hits == hits + 1
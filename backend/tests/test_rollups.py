@@ -0,0 +1,43 @@
+import pytest
+from blueprints.mqtt.rollups import rebuild_rollups
+
+# Two minutes of samples, the first minute split over two batches
+START = 1700000040.0
+BATCHES = [
+    [(20.0, START + 5), (26.0, START + 20)],
+    [(23.0, START + 50), (30.0, START + 70), (28.0, START + 110)]
+]
+
+
+@pytest.fixture
+def rolled_up(routes, flush, device):
+    for batch in BATCHES:
+        routes.ingest_queue.put_many([(device, "temperature", value, timestamp) for value, timestamp in batch])
+        flush()
+
+
+def buckets(client, device, resolution):
+    response = client.get(f"/api/mqtt/temperature/history?device_id={device}&resolution={resolution}&start_time={START}")
+    assert response.status_code == 200
+    return response.get_json()["data"]
+
+
+def test_batches_are_merged_into_minute_buckets(client, rolled_up, device):
+    assert buckets(client, device, "1m") == [
+        {"timestamp": START + 60, "count": 2, "min": 28.0, "max": 30.0, "avg": 29.0, "first": 30.0, "last": 28.0},
+        {"timestamp": START, "count": 3, "min": 20.0, "max": 26.0, "avg": 23.0, "first": 20.0, "last": 23.0}
+    ]
+    hour, = buckets(client, device, "1h")
+    assert (hour["count"], hour["first"], hour["last"]) == (5, 20.0, 28.0)
+
+
+def test_a_rebuild_gives_the_same_buckets(routes, client, rolled_up, device):
+    before = {resolution: buckets(client, device, resolution) for resolution in ("1m", "1h", "1d")}
+    routes.ingest_queue.submit(rebuild_rollups).result()
+    routes.result_cache.clear()
+    assert {resolution: buckets(client, device, resolution) for resolution in ("1m", "1h", "1d")} == before
+
+
+def test_an_unknown_resolution_is_rejected(client):
+    response = client.get("/api/mqtt/temperature/history?resolution=5m")
+    assert response.status_code == 400
@@ -0,0 +1,49 @@
+import json
+import time
+import pytest
+from models import SensorReading
+from blueprints.mqtt.telemetry import decode_telemetry, SequenceTracker
+
+
+def message(sequence, timestamps, device="pi", boot="boot-1", **metrics):
+    return json.dumps({"v": 1, "d": device, "b": boot, "s": sequence, "t": timestamps, "m": metrics})
+
+
+@pytest.mark.parametrize("payload", [
+    '{"v": 2, "b": "a", "s": 0, "t": [1], "m": {}}',
+    '{"v": 1, "s": 0, "t": [1], "m": {}}',
+    '{"v": 1, "b": "a", "s": -1, "t": [1], "m": {}}',
+    '{"v": 1, "b": "a", "s": 0, "t": "1", "m": {}}',
+    '{"v": 1, "b": "a", "s": 0, "t": [1, 2], "m": {"temperature": [1]}}',
+    '{"v": 1, "b": "a", "s": 0, "t": [1], "m": {"temperature": ["nan"]}}',
+    'not json'
+])
+def test_malformed_messages_are_rejected(payload):
+    with pytest.raises(ValueError):
+        decode_telemetry(payload)
+
+
+def test_sequence_numbers_spot_gaps_redeliveries_and_restarts():
+    tracker = SequenceTracker()
+    assert tracker.accept("pi", "a", 0, 2) == 0
+    assert tracker.accept("pi", "a", 1, 2) == 1
+    assert tracker.accept("pi", "a", 5, 1) == 0
+    # Restarted with its clock behind: still a new run, not a redelivery
+    assert tracker.accept("pi", "b", 0, 1) == 0
+    assert tracker.accept("pi", "b", 0, 1) == 1
+    assert tracker.stats() == {"devices": 1, "gaps": 2, "duplicates": 2, "restarts": 1}
+
+
+def test_batches_are_stored_once_and_re_anchored_when_the_clock_is_off(app, routes, flush, device):
+    now = time.time()
+    routes.handle_telemetry(device, message(0, [now - 2, now - 1], device, temperature=[20.0, 21.0], co2=[400, 410]), now)
+    # Redelivered, then a device without a synced clock
+    routes.handle_telemetry(device, message(0, [now - 2, now - 1], device, temperature=[20.0, 21.0]), now)
+    routes.handle_telemetry(device, message(2, [1000.0, 1001.0], device, temperature=[22.0, None]), now)
+    flush()
+
+    with app.app_context():
+        rows = SensorReading.query.filter_by(device_id=device).order_by(SensorReading.timestamp).all()
+    assert [row.value for row in rows] == [20.0, 21.0, 22.0]
+    assert rows[-1].to_dict()["timestamp"] == pytest.approx(now - 1, abs=0.01)
+    assert routes.latest_state.get(device, "temperature")["value"] == 22.0
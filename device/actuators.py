@@ -0,0 +1,127 @@
+import time
+import threading
+from collections import deque
+
+
+class Mailbox:
+    """Single-slot mailbox: a new command replaces one that has not been taken yet"""
+
+    def __init__(self):
+        self._command = None
+        self._cond = threading.Condition()
+        self.superseded = 0
+
+    def put(self, command):
+        with self._cond:
+            if self._command is not None:
+                self.superseded += 1
+            self._command = command
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Return the pending command, waiting up to timeout seconds for one, or None"""
+        with self._cond:
+            if self._command is None:
+                self._cond.wait(timeout)
+            command, self._command = self._command, None
+            return command
+
+
+class LatencyStats:
+    """Recent command-to-actuation latencies"""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return {
+            "count": len(ordered),
+            "p50_ms": ordered[len(ordered) // 2] * 1000,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max_ms": ordered[-1] * 1000
+        }
+
+
+class ActuatorWorker:
+    """Applies commands for one output on its own thread, always acting on the newest command
+
+    Commands are (value, received_at, command_id, received_wall) tuples, where received_at is the
+    time.monotonic() at which the MQTT message arrived. handle(worker, value, received_at) performs
+    the actuation. A long-running handler should poll worker.mailbox between steps and, when a newer
+    command arrives, return it instead of finishing; the worker then starts on it straight away.
+    on_actuated(command_id, received_wall, actuated_wall) runs when a command carrying an id starts
+    the output, with wall-clock times for the acknowledgement.
+    """
+
+    def __init__(self, name, handle, idle=None, idle_after=None, on_actuated=None):
+        self.name = name
+        self.mailbox = Mailbox()
+        self.latency = LatencyStats()
+        self.completion = LatencyStats()
+        self.applied = 0
+        self.redirected = 0
+        self._handle = handle
+        self._idle = idle
+        self._idle_after = idle_after
+        self._on_actuated = on_actuated
+        self._current = None
+        self._thread = threading.Thread(target=self._run, name=f"actuator-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, value, command_id=None):
+        """Queue a command from the MQTT callback; never blocks"""
+        self.mailbox.put((value, time.monotonic(), command_id, time.time()))
+
+    def actuated(self, received_at):
+        """Record that the output started moving for a command"""
+        self.latency.add(time.monotonic() - received_at)
+        current, self._current = self._current, None
+        if current is not None and current[0] is not None and self._on_actuated:
+            try:
+                self._on_actuated(current[0], current[1], time.time())
+            except Exception as e:
+                print(f"{self.name} acknowledgement failed: {e}")
+
+    def _run(self):
+        pending = None
+        while True:
+            command = pending or self.mailbox.take(self._idle_after)
+            pending = None
+            if command is None:
+                # Nothing new for a while, let the output rest
+                if self._idle:
+                    self._idle()
+                command = self.mailbox.take()
+
+            value, received_at, command_id, received_wall = command
+            self._current = (command_id, received_wall)
+            try:
+                pending = self._handle(self, value, received_at)
+                self.applied += 1
+                if pending is None:
+                    self.completion.add(time.monotonic() - received_at)
+                else:
+                    self.redirected += 1
+            except Exception as e:
+                print(f"{self.name} actuator failed: {e}")
+
+    def stats(self):
+        return {
+            "applied": self.applied,
+            "superseded": self.mailbox.superseded,
+            "redirected": self.redirected,
+            "latency": self.latency.summary(),
+            "completion": self.completion.summary()
+        }
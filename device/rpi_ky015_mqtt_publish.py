@@ -3,9 +3,14 @@ import time
 import sys
 import threading
 import os
+import json
+from functools import partial
 import paho.mqtt.client as mqtt
 import RPi.GPIO as GPIO
 import dht11
+from spool import Spool
+from telemetry import TelemetryBatcher
+from actuators import ActuatorWorker
 
 # === Load Configuration from Environment Variables ===
 # Get environment variables with defaults
@@ -17,12 +22,37 @@ TEMP_TOPIC = os.environ.get("TEMP_TOPIC", "sensors/temperature")
 HUMIDITY_TOPIC = os.environ.get("HUMIDITY_TOPIC", "sensors/humidity")
 CONTROL_TOPIC = os.environ.get("CONTROL_TOPIC", "light")
 MOTION_TOPIC = os.environ.get("MOTION_TOPIC", "motion")
+# Actuations of commands carrying an id are acknowledged here
+ACK_TOPIC = os.environ.get("ACK_TOPIC", "ack")
+BACKFILL_TOPIC = os.environ.get("BACKFILL_TOPIC", "sensors/backfill")
+
+# "plain" publishes each reading as a bare number on TEMP_TOPIC/HUMIDITY_TOPIC; "compact" publishes
+# batches of TELEMETRY_BATCH_SIZE samples, with sequence numbers and timestamps, on TELEMETRY_TOPIC
+TELEMETRY_FORMAT = os.environ.get("TELEMETRY_FORMAT", "plain").lower()
+TELEMETRY_TOPIC = os.environ.get("TELEMETRY_TOPIC", "sensors/telemetry")
+TELEMETRY_BATCH_SIZE = int(os.environ.get("TELEMETRY_BATCH_SIZE", "1"))
+TELEMETRY_QOS = int(os.environ.get("TELEMETRY_QOS", "1"))
+DEVICE_ID = os.environ.get("DEVICE_ID", "default")
 
 DHT_PIN = int(os.environ.get("DHT_PIN", "17"))
 LIGHT_GPIO_PIN = int(os.environ.get("LIGHT_GPIO_PIN", "27"))
 SERVO_PIN = int(os.environ.get("SERVO_PIN", "24"))
 READ_INTERVAL = int(os.environ.get("READ_INTERVAL", "2"))
 
+# Servo motion is interpolated in steps of SERVO_STEP_DEGREES (0 jumps straight to the target)
+SERVO_STEP_DEGREES = float(os.environ.get("SERVO_STEP_DEGREES", "5"))
+SERVO_STEP_INTERVAL = float(os.environ.get("SERVO_STEP_INTERVAL", "0.02"))
+# Seconds the servo holds its position before the PWM signal is switched off to stop jitter
+SERVO_HOLD_TIME = float(os.environ.get("SERVO_HOLD_TIME", "0.5"))
+ACTUATOR_STATS_INTERVAL = int(os.environ.get("ACTUATOR_STATS_INTERVAL", "60"))
+
+# Readings taken while disconnected are spooled to disk and replayed after reconnecting
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", str(50 * 1024 * 1024)))
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", str(1024 * 1024)))
+REPLAY_BATCH_SIZE = int(os.environ.get("REPLAY_BATCH_SIZE", "100"))
+REPLAY_BATCHES_PER_SECOND = float(os.environ.get("REPLAY_BATCHES_PER_SECOND", "2"))
+
 # Print configuration
 print("\n=== Configuration ===")
 print(f"BROKER_ADDRESS: {BROKER_ADDRESS}")
@@ -32,10 +62,22 @@ print(f"TEMP_TOPIC: {TEMP_TOPIC}")
 print(f"HUMIDITY_TOPIC: {HUMIDITY_TOPIC}")
 print(f"CONTROL_TOPIC: {CONTROL_TOPIC}")
 print(f"MOTION_TOPIC: {MOTION_TOPIC}")
+print(f"ACK_TOPIC: {ACK_TOPIC}")
+print(f"BACKFILL_TOPIC: {BACKFILL_TOPIC}")
+print(f"TELEMETRY_FORMAT: {TELEMETRY_FORMAT}")
+print(f"TELEMETRY_TOPIC: {TELEMETRY_TOPIC}")
+print(f"TELEMETRY_BATCH_SIZE: {TELEMETRY_BATCH_SIZE}")
+print(f"DEVICE_ID: {DEVICE_ID}")
 print(f"DHT_PIN: {DHT_PIN}")
 print(f"LIGHT_GPIO_PIN: {LIGHT_GPIO_PIN}")
 print(f"SERVO_PIN: {SERVO_PIN}")
 print(f"READ_INTERVAL: {READ_INTERVAL}")
+print(f"SERVO_STEP_DEGREES: {SERVO_STEP_DEGREES}")
+print(f"SERVO_STEP_INTERVAL: {SERVO_STEP_INTERVAL}")
+print(f"SPOOL_DIR: {SPOOL_DIR}")
+print(f"SPOOL_MAX_BYTES: {SPOOL_MAX_BYTES}")
+print(f"REPLAY_BATCH_SIZE: {REPLAY_BATCH_SIZE}")
+print(f"REPLAY_BATCHES_PER_SECOND: {REPLAY_BATCHES_PER_SECOND}")
 print("===================\n")
 
 # === GPIO Setup ===
@@ -47,14 +89,69 @@ GPIO.setup(SERVO_PIN, GPIO.OUT)
 servo_pwm = GPIO.PWM(SERVO_PIN, 50)  
 servo_pwm.start(7.5)
 
-# === Helper: Move Servo ===
-def set_servo_angle(angle):
-    duty = 2.5 + (angle / 18.0)
-    servo_pwm.ChangeDutyCycle(duty)
-    print(f"Servo moved to {angle}°")
-    time.sleep(0.5)
+# === Actuator Workers ===
+# Each output has its own thread fed by a latest-wins mailbox, so on_message never blocks
+servo_position = {"angle": 90.0}
+
+def move_servo(worker, target, received_at):
+    """Step the servo towards target, switching to a newer target as soon as one arrives"""
+    current = servo_position["angle"]
+    while True:
+        if SERVO_STEP_DEGREES > 0:
+            current += max(-SERVO_STEP_DEGREES, min(SERVO_STEP_DEGREES, target - current))
+        else:
+            current = target
+        servo_pwm.ChangeDutyCycle(2.5 + (current / 18.0))
+        servo_position["angle"] = current
+        if received_at is not None:
+            worker.actuated(received_at)
+            received_at = None
+        if current == target:
+            print(f"Servo moved to {target}°")
+            return None
+        newer = worker.mailbox.take(SERVO_STEP_INTERVAL)
+        if newer is not None:
+            return newer
+
+def rest_servo():
     servo_pwm.ChangeDutyCycle(0)
 
+def switch_light(worker, state, received_at):
+    GPIO.output(LIGHT_GPIO_PIN, GPIO.HIGH if state == "on" else GPIO.LOW)
+    worker.actuated(received_at)
+    print(f"Light turned {state.upper()}")
+
+# Set in main(), used to acknowledge commands from the actuator threads
+mqtt_client = None
+
+def publish_ack(kind, command_id, received_at, actuated_at):
+    """Tell the backend when a command arrived and when its output started, by the wall clock"""
+    if mqtt_client is not None and mqtt_client.is_connected():
+        mqtt_client.publish(ACK_TOPIC, json.dumps({
+            "command_id": command_id,
+            "kind": kind,
+            "received_at": received_at,
+            "actuated_at": actuated_at,
+            "sent_at": time.time()
+        }))
+
+servo_worker = ActuatorWorker("servo", move_servo, idle=rest_servo, idle_after=SERVO_HOLD_TIME,
+                              on_actuated=partial(publish_ack, "motion")).start()
+light_worker = ActuatorWorker("light", switch_light, on_actuated=partial(publish_ack, "light")).start()
+
+def report_actuator_stats():
+    for worker in (light_worker, servo_worker):
+        stats = worker.stats()
+        if not stats["applied"]:
+            continue
+        latency = stats["latency"]
+        line = (f"{worker.name}: {stats['applied']} applied, {stats['superseded']} superseded, "
+                f"{stats['redirected']} redirected mid-motion, latency p50 {latency['p50_ms']:.1f} ms "
+                f"p99 {latency['p99_ms']:.1f} ms max {latency['max_ms']:.1f} ms")
+        if stats["completion"]:
+            line += f", time to target p50 {stats['completion']['p50_ms']:.0f} ms"
+        print(line)
+
 # === MQTT Callbacks ===
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -62,6 +159,8 @@ def on_connect(client, userdata, flags, rc):
         client.subscribe(CONTROL_TOPIC)
         client.subscribe(MOTION_TOPIC)
         print(f"Subscribed to topics: {CONTROL_TOPIC}, {MOTION_TOPIC}")
+        # Retained, so the backend knows to tag commands with ids even if it starts later
+        client.publish(ACK_TOPIC, json.dumps({"ready": True, "timestamp": time.time()}), qos=1, retain=True)
     else:
         print(f"Failed to connect: code {rc}")
 
@@ -70,13 +169,15 @@ def on_message(client, userdata, msg):
     topic = msg.topic
     print(f"Received on '{topic}': {payload}")
 
+    # Commands from the backend end in " #<command id>" once it knows this device acknowledges them
+    command_id = None
+    command, separator, tag = payload.rpartition(" #")
+    if separator and tag.isdigit():
+        payload, command_id = command.strip(), int(tag)
+
     if topic == CONTROL_TOPIC:
-        if payload == "on":
-            GPIO.output(LIGHT_GPIO_PIN, GPIO.HIGH)
-            print("Light turned ON")
-        elif payload == "off":
-            GPIO.output(LIGHT_GPIO_PIN, GPIO.LOW)
-            print("Light turned OFF")
+        if payload in ("on", "off"):
+            light_worker.submit(payload, command_id)
         else:
             print("Unknown light command")
 
@@ -88,7 +189,7 @@ def on_message(client, userdata, msg):
                 if 0 <= value <= 90:
                     angle = 90 - value if direction == "left" else 90 + value
                     angle = max(0, min(180, angle))
-                    set_servo_angle(angle)
+                    servo_worker.submit(angle, command_id)
                 else:
                     print("Angle out of range (0–90 from center)")
             except Exception as e:
@@ -96,7 +197,35 @@ def on_message(client, userdata, msg):
         else:
             print("Unknown motion command")
 
+def on_disconnect(client, userdata, rc):
+    print(f"Disconnected from MQTT broker (code {rc}), spooling readings until reconnected")
+
 # === Sensor Reading and Publishing ===
+spool = Spool(SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES, segment_bytes=SPOOL_SEGMENT_BYTES)
+
+def publish_reading(client, topic, metric, value, timestamp):
+    """Publish a live reading, or spool it with its timestamp if it cannot be sent"""
+    if client.is_connected():
+        info = client.publish(topic, str(value))
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            return
+    spool.append(timestamp, metric, value)
+
+telemetry = TelemetryBatcher(DEVICE_ID, batch_size=TELEMETRY_BATCH_SIZE)
+
+def publish_telemetry(client, samples):
+    """Publish samples as one compact message, or spool every reading in them if it cannot be sent"""
+    if not samples:
+        return
+    if client.is_connected():
+        info = client.publish(TELEMETRY_TOPIC, telemetry.encode(samples), qos=TELEMETRY_QOS)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            telemetry.sent(len(samples))
+            return
+    for timestamp, readings in samples:
+        for metric, value in readings.items():
+            spool.append(timestamp, metric, value)
+
 def sensor_loop(client):
     print(f"Starting sensor publishing every {READ_INTERVAL} seconds...")
     sensor = dht11.DHT11(pin=DHT_PIN)
@@ -105,36 +234,97 @@ def sensor_loop(client):
         if result.is_valid():
             temperature = result.temperature
             humidity = result.humidity
+            timestamp = time.time()
             print(f"Temperature: {temperature}°C, Humidity: {humidity}%")
-            client.publish(TEMP_TOPIC, str(temperature))
-            client.publish(HUMIDITY_TOPIC, str(humidity))
+            if TELEMETRY_FORMAT == "compact":
+                if telemetry.add(timestamp, {"temperature": temperature, "humidity": humidity}):
+                    publish_telemetry(client, telemetry.take())
+            else:
+                publish_reading(client, TEMP_TOPIC, "temperature", temperature, timestamp)
+                publish_reading(client, HUMIDITY_TOPIC, "humidity", humidity, timestamp)
         else:
             print("Sensor read failed. Retrying...")
         time.sleep(READ_INTERVAL)
 
+# === Spool Replay ===
+def replay_segment(client, position):
+    """Replay the oldest spooled segment from a (sequence, offset) position and return where to resume"""
+    sequence, readings = spool.oldest_segment()
+    start = position[1] if position[0] == sequence else 0
+    print(f"Replaying {len(readings) - start} spooled readings from segment {sequence}")
+
+    for offset in range(start, len(readings), REPLAY_BATCH_SIZE):
+        batch = readings[offset:offset + REPLAY_BATCH_SIZE]
+        payload = json.dumps({"readings": [
+            {"metric": metric, "value": value, "timestamp": timestamp} for timestamp, metric, value in batch
+        ]})
+        info = client.publish(BACKFILL_TOPIC, payload, qos=1)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            info.wait_for_publish(timeout=10)
+        if not info.is_published():
+            print("Replay interrupted, will resume after reconnecting")
+            return (sequence, offset)
+        time.sleep(1.0 / REPLAY_BATCHES_PER_SECOND)
+    spool.remove_segment(sequence)
+    return (None, 0)
+
+def replay_loop(client):
+    """Send spooled readings to BACKFILL_TOPIC in rate-limited batches while connected
+
+    Each batch is published with QoS 1 and must be acknowledged before the next one is sent;
+    a segment is deleted only once every batch in it has been acknowledged.
+    """
+    position = (None, 0)
+    while True:
+        if not client.is_connected() or not spool.pending():
+            time.sleep(1)
+            continue
+        try:
+            position = replay_segment(client, position)
+        except Exception as e:
+            # e.g. the segment was dropped for SPOOL_MAX_BYTES while being read; start over from the oldest one
+            print(f"Error replaying spooled readings: {str(e)}")
+            position = (None, 0)
+            time.sleep(1)
+
 # === Main Function ===
 def main():
+    global mqtt_client
     client = mqtt.Client(transport="websockets" if USE_WEBSOCKETS else "tcp")
+    mqtt_client = client
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
 
     try:
-        client.connect(BROKER_ADDRESS, BROKER_PORT, 60)
+        # Connect in the background, so readings are spooled even if the broker is down at boot
+        client.connect_async(BROKER_ADDRESS, BROKER_PORT, 60)
         client.loop_start()
 
         sensor_thread = threading.Thread(target=sensor_loop, args=(client,))
         sensor_thread.daemon = True
         sensor_thread.start()
 
+        replay_thread = threading.Thread(target=replay_loop, args=(client,))
+        replay_thread.daemon = True
+        replay_thread.start()
+
         print("Press Ctrl+C to exit")
+        last_report = time.monotonic()
         while True:
             time.sleep(1)
+            if time.monotonic() - last_report >= ACTUATOR_STATS_INTERVAL:
+                report_actuator_stats()
+                last_report = time.monotonic()
 
     except KeyboardInterrupt:
         print("\nExiting program...")
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        # Send or spool a partly filled telemetry batch rather than lose it
+        publish_telemetry(client, telemetry.take())
         GPIO.output(LIGHT_GPIO_PIN, GPIO.LOW)
         servo_pwm.stop()
         GPIO.cleanup()
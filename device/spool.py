@@ -0,0 +1,99 @@
+import os
+import threading
+
+
+class Spool:
+    """Append-only, size-capped on-disk queue of sensor readings
+
+    Readings are appended as "timestamp metric value" lines to the newest segment file. Segments
+    are only ever appended to and deleted whole, never rewritten, which keeps SD card wear low.
+    When the total size passes max_bytes the oldest segment is dropped. Delivery is
+    at-least-once: a segment is deleted only after all of it has been replayed.
+    """
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            int(name[len("segment-"):-len(".log")])
+            for name in os.listdir(directory)
+            if name.startswith("segment-") and name.endswith(".log")
+        )
+        self._next_sequence = self._segments[-1] + 1 if self._segments else 0
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"segment-{sequence:010d}.log")
+
+    def _size(self):
+        return sum(os.path.getsize(self._path(sequence)) for sequence in self._segments)
+
+    def _rotate(self):
+        """Close the segment being written, so the next append starts a new one"""
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def append(self, timestamp, metric, value):
+        """Store one reading taken while it could not be published"""
+        line = f"{timestamp:.3f} {metric} {value}\n"
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._rotate()
+                sequence = self._next_sequence
+                self._next_sequence += 1
+                self._segments.append(sequence)
+                self._file = open(self._path(sequence), "a")
+
+            self._file.write(line)
+            self._file.flush()
+
+            while len(self._segments) > 1 and self._size() > self.max_bytes:
+                oldest = self._segments.pop(0)
+                path = self._path(oldest)
+                with open(path) as f:
+                    self.dropped += sum(1 for _ in f)
+                os.remove(path)
+                print(f"Spool is full, dropped oldest segment {oldest}")
+
+    def pending(self):
+        with self._lock:
+            return bool(self._segments)
+
+    def oldest_segment(self):
+        """Return (sequence, readings) for the oldest segment, or None when the spool is empty
+
+        The segment being written is closed first, so new readings go to a fresh one while it is replayed.
+        """
+        with self._lock:
+            if not self._segments:
+                return None
+            sequence = self._segments[0]
+            if len(self._segments) == 1:
+                self._rotate()
+
+        readings = []
+        with open(self._path(sequence)) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 3:
+                    # Torn write from a power cut
+                    continue
+                try:
+                    readings.append((float(parts[0]), parts[1], float(parts[2])))
+                except ValueError:
+                    continue
+        return sequence, readings
+
+    def remove_segment(self, sequence):
+        """Delete a segment once all of its readings have been delivered"""
+        with self._lock:
+            if sequence in self._segments:
+                self._segments.remove(sequence)
+                os.remove(self._path(sequence))